@@ -0,0 +1,250 @@
+"""
+End to end benchmark of a storage, a worker and clients on one host.
+
+The synthetic origin, the storage and the worker run as subprocesses,
+the clients run in this process. The urls are crawled twice: a cold
+pass with an empty cache and a warm pass served by the storage. For
+each pass it reports pages/s, p50/p99 latency seen by clients and cache
+hit ratio, and for each node its cpu time and peak rss. Results are
+printed as json, to be compared across commits.
+
+Nodes discover each other by multicast, so `--ip` must be an interface
+with multicast enabled (loopback usually isn't).
+
+Usage:
+    python benchmarks/e2e.py --ip 172.30.10.2 --urls 200 --output bench.json
+"""
+from argparse import ArgumentParser
+from typing import Dict, List
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.client import Client    # noqa: E402
+from src.utils.metrics import REGISTRY, Histogram    # noqa: E402
+
+
+def spawn(args: List[str], cwd: str, log, overrides: dict = None) -> subprocess.Popen:
+    # settings read overrides from the environment, so children of nodes get them too
+    env = {**os.environ, 'PYTHONPATH': ROOT}
+    if overrides:
+        env['BROOD_SETTINGS'] = json.dumps(overrides)
+    return subprocess.Popen([sys.executable, *args], cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop(proc: subprocess.Popen, timeout: float = 5) -> dict:
+    """
+    Interrupt a node and return the cpu time and peak rss it used.
+    """
+    proc.send_signal(signal.SIGINT)
+    deadline = time.time() + timeout
+    while True:
+        pid, _, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.time() > deadline:
+            proc.kill()
+            _, _, usage = os.wait4(proc.pid, 0)
+            break
+        time.sleep(0.05)
+    proc.returncode = -1
+    return {
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        'max_rss_kb': usage.ru_maxrss,
+    }
+
+
+def scrape(ip: str, port: int) -> Dict[str, float]:
+    """
+    Return the samples served by a metrics endpoint, by name and labels.
+    """
+    try:
+        with urllib.request.urlopen(f'http://{ip}:{port}/metrics', timeout=5) as res:
+            text = res.read().decode('utf8')
+    except OSError:
+        return {}
+
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def quantile(hist: Histogram, q: float) -> float:
+    """
+    Estimate a quantile of a histogram, interpolating in its bucket.
+    """
+    with hist.lock:
+        totals = [0] * (len(hist.bounds) + 1)
+        for counts, _ in hist.values.values():
+            totals = [t + c for t, c in zip(totals, counts)]
+
+    rank, seen = q * sum(totals), 0
+    for i, count in enumerate(totals):
+        if count and seen + count >= rank:
+            low = hist.bounds[i - 1] if i > 0 else 0.0
+            high = hist.bounds[i] if i < len(hist.bounds) else low
+            return round(low + (high - low) * (rank - seen) / count, 6)
+        seen += count
+    return 0.0
+
+
+def reset_metrics():
+    for metric in REGISTRY.metrics.values():
+        with metric.lock:
+            metric.values.clear()
+
+
+def run_pass(name: str, urls: List[str], args, workdir: str) -> dict:
+    """
+    Crawl urls with `args.clients` clients and return their stats.
+    """
+    reset_metrics()
+    clients = []
+    for i in range(args.clients):
+        url_file = os.path.join(workdir, f'urls-{name}-{i}.txt')
+        with open(url_file, 'w') as f:
+            f.writelines(f'{url}\n' for url in urls[i::args.clients])
+        # requests as fast as workers take them, not one per second
+        clients.append(Client(args.ip, url_file, -1, 1, 'files', args.max_age, request_interval=0))
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    threads = [threading.Thread(target=c.start, daemon=True) for c in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(max(0.0, started + args.timeout - time.time()))
+    elapsed = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    responses = REGISTRY.metrics['client_responses_total'].values
+    hits = sum(v for k, v in responses.items() if ('hit', 'True') in k)
+    pages = sum(responses.values())
+    latency = REGISTRY.metrics['client_request_seconds']
+
+    return {
+        'name': name,
+        'completed': not any(t.is_alive() for t in threads),
+        'pages': int(pages),
+        'seconds': round(elapsed, 3),
+        'pages_per_second': round(pages / elapsed, 3) if elapsed else 0.0,
+        'latency_p50': quantile(latency, 0.5),
+        'latency_p99': quantile(latency, 0.99),
+        'hit_ratio': round(hits / pages, 4) if pages else 0.0,
+        'bytes_in': int(sum(REGISTRY.metrics['client_bytes_in_total'].values.values())),
+        'client_cpu_seconds': round(
+            after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime, 3),
+    }
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--ip', type=str, default='127.0.0.1', help='Interface IP address, with multicast')
+    parser.add_argument('--urls', type=int, default=200, help='Distinct pages to crawl')
+    parser.add_argument('--clients', type=int, default=4, help='Clients crawling in parallel')
+    parser.add_argument('--hosts', type=int, default=4, help='Hosts simulated by the origin')
+    parser.add_argument('--size', type=int, default=16 * 1024, help='Bytes per page')
+    parser.add_argument('--fanout', type=int, default=10, help='Links per page')
+    parser.add_argument('--latency', type=float, default=0.05, help='Origin latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Origin latency jitter in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of origin 503s')
+    parser.add_argument('--processes', type=int, default=1, help='Processes of the worker')
+    parser.add_argument('--max-age', type=float, help='Max age of cached pages')
+    parser.add_argument('--timeout', type=float, default=600, help='Max seconds per pass')
+    parser.add_argument(
+        '--set', action='append', default=[], metavar='SETTING=JSON',
+        help='Override a setting of storage and worker, e.g. WORKER_HOST_RATE=50'
+    )
+    parser.add_argument('--base-port', type=int, default=9100, help='First port used by nodes')
+    parser.add_argument('--output', type=str, help='File to write results, default stdout')
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.set:
+        key, value = item.split('=', 1)
+        overrides[key] = json.loads(value)
+
+    port = args.base_port
+    origin_port, storage_port, worker_port = port, port + args.hosts, port + args.hosts + 2
+    storage_metrics, worker_metrics = worker_port + 1, worker_port + 2
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix='brood-bench-')
+    os.chdir(workdir)
+    log = open(os.path.join(workdir, 'nodes.log'), 'w')
+
+    nodes = {
+        'origin': spawn([
+            os.path.join(ROOT, 'benchmarks', 'origin.py'), '--ip', args.ip,
+            '--port', str(origin_port), '--hosts', str(args.hosts), '--pages', str(args.urls),
+            '--size', str(args.size), '--fanout', str(args.fanout), '--latency', str(args.latency),
+            '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+        ], workdir, log),
+        'storage': spawn([
+            os.path.join(ROOT, 'run_storage.py'), '--ip', args.ip, '--port', str(storage_port),
+            '--cache', 'cache', '--metrics-port', str(storage_metrics),
+        ], workdir, log, overrides),
+        'worker': spawn([
+            os.path.join(ROOT, 'run_worker.py'), '--ip', args.ip, '--port', str(worker_port),
+            '--processes', str(args.processes), '--metrics-port', str(worker_metrics),
+        ], workdir, log, overrides),
+    }
+
+    # let nodes bind and discover each other
+    time.sleep(3)
+
+    urls = [
+        f'http://{args.ip}:{origin_port + i % args.hosts}/p/{i}'
+        for i in range(args.urls)
+    ]
+    results = {
+        'commit': commit(),
+        'started_at': time.time(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'set')},
+        'settings': overrides,
+        'passes': [],
+    }
+    try:
+        for name in ('cold', 'warm'):
+            results['passes'].append(run_pass(name, urls, args, workdir))
+            results['passes'][-1]['worker'] = {
+                k: v for k, v in scrape(args.ip, worker_metrics).items()
+                if k.startswith(('worker_fetches_total', 'worker_responses_total'))
+            }
+    finally:
+        results['client'] = {'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        for name, proc in nodes.items():
+            results[name] = stop(proc)
+        log.close()
+
+    results['workdir'] = workdir
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
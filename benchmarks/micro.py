@@ -0,0 +1,223 @@
+"""
+Micro-benchmarks of the data structures in the hot path of nodes.
+
+Drives `Cache`, `UrlFeeder`, `RequestsMonitor` and `HTMLParser.links`
+with generated urls and html at each of the given sizes, and reports
+per operation: ops/s, memory blocks still allocated after the run per
+op and, with `--trace`, tracemalloc peak bytes per op (much slower).
+A run stops after `--budget` seconds, so quadratic costs show up as
+falling ops/s instead of a hang. Results are printed as json.
+
+Usage:
+    python benchmarks/micro.py --sizes 1000,10000,100000 --output micro.json
+"""
+from argparse import ArgumentParser
+from typing import Callable, List
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.utils.client import UrlFeeder  # noqa: E402
+from src.utils.html import HTMLParser   # noqa: E402
+from src.utils.storage import Cache     # noqa: E402
+from src.utils.worker import HostScheduler, RequestsMonitor   # noqa: E402
+
+
+def urls(n: int, hosts: int = 100) -> List[str]:
+    return [f'http://host{i % hosts}.example.com/section/{i // hosts}/page-{i}.html' for i in range(n)]
+
+
+def html(links: int) -> str:
+    body = ''.join(
+        f'<p>Paragraph {i} <a href="{url}">link</a></p>\n'
+        for i, url in enumerate(urls(links))
+    )
+    return f'<html><head><title>Fixture</title></head><body>\n{body}</body></html>\n'
+
+
+class Bench:
+    """
+    Collect the measures of each operation of the benchmarks.
+    """
+
+    def __init__(self, budget: float, trace: bool):
+        self.budget = budget
+        self.trace = trace
+        self.results = []
+
+    def run(self, name: str, size: int, op: Callable[[int], object], n: int = None, unit: int = 1):
+        """
+        Call op(i) for i in range(n) until done or out of time budget.
+        Each call counts as `unit` operations.
+        """
+        n = size if n is None else n
+        if self.trace:
+            tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        started = time.perf_counter()
+
+        calls = 0
+        for i in range(n):
+            op(i)
+            calls += 1
+            if calls % 256 == 0 and time.perf_counter() - started > self.budget:
+                break
+
+        elapsed = time.perf_counter() - started
+        blocks = sys.getallocatedblocks() - blocks
+        ops = calls * unit
+        result = {
+            'name': name,
+            'size': size,
+            'ops': ops,
+            'seconds': round(elapsed, 6),
+            'ops_per_second': round(ops / elapsed, 1) if elapsed else None,
+            'blocks_per_op': round(blocks / ops, 3) if ops else None,
+            'complete': calls == n,
+        }
+        if self.trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['peak_bytes_per_op'] = round(peak / ops, 1) if ops else None
+        self.results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+
+class FakeStorage:
+    """
+    Stand-in of a storage connection for the monitor.
+    """
+    sid = 'bench'
+
+    def deadline(self) -> float:
+        return 60.0
+
+    def hedge_delay(self) -> float:
+        return 60.0
+
+
+def bench_cache(bench: Bench, size: int):
+    folder = f'cache-{size}'
+    cache = Cache(folder)
+    keys = urls(size)
+    content = b'<html>' + b'x' * 2048 + b'</html>'
+    meta = {'status': 200, 'fetched_at': time.time(), 'charset': 'utf-8'}
+
+    # distinct contents, same ones are stored once
+    bench.run('cache.set', size, lambda i: cache.set(keys[i], content + b'%d' % i, meta))
+    bench.run('cache.get', size, lambda i: cache.get(keys[i]))
+    bench.run('cache.get_meta', size, lambda i: cache.get_meta(keys[i]))
+    bench.run('cache.get miss', size, lambda i: cache.get(keys[i] + '-miss'))
+    bench.run('cache.set duplicate', size, lambda i: cache.set(keys[i] + '-dup', content, meta))
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_feeder(bench: Bench, size: int, workdir: str):
+    url_file = os.path.join(workdir, f'urls-{size}.txt')
+    with open(url_file, 'w') as f:
+        f.writelines(f'{url}\n' for url in urls(size))
+
+    feeder = UrlFeeder(url_file, -1)
+    fed = []
+    url = urls(1)[0]
+    bench.run('feeder.feed', size, lambda i: fed.append(feeder.feed()))
+    bench.run('feeder.append', size, lambda i: feeder.append(url))
+    bench.run('feeder.done', size, lambda i: feeder.done(fed[i][0]), len(fed))
+    os.remove(url_file)
+
+
+def bench_monitor(bench: Bench, size: int):
+    monitor = RequestsMonitor()
+    # politeness isn't measured here, let every host be fetched at once
+    monitor.scheduler = HostScheduler(rate=1e9, burst=1e9)
+    storage = FakeStorage()
+    keys = urls(size)
+
+    # each stage moves the requests the previous one got to move in budget
+    bench.run('monitor.add_new', size, lambda i: monitor.add_new(b'conn', i, keys[i]))
+    bench.run('monitor.new_next', size, lambda i: monitor.new_next(storage), len(monitor.new))
+    rids = list(monitor.caching)
+    bench.run(
+        'monitor.move_caching_to_scrapping', size,
+        lambda i: monitor.move_caching_to_scrapping(rids[i]), len(rids))
+
+    def scrap(i):
+        rid = monitor.scrapping_next(0)
+        monitor.move_scrapping_to_ready(rid, b'<html></html>', 'utf-8', 200, {})
+
+    bench.run('monitor.scrapping_next+ready', size, scrap, len(monitor.scrapping))
+    bench.run('monitor.ready_next', size, lambda i: monitor.ready_next(), len(monitor.ready))
+
+    # queues of monitors are shared by class
+    for queue in (monitor.new, monitor.caching, monitor.scrapping, monitor.ready, monitor.in_course):
+        queue.clear()
+
+
+def bench_links(bench: Bench, size: int):
+    content = html(size)
+    # a single document with `size` links, repeated while in budget
+    bench.run('html.links', size, lambda i: HTMLParser.links(content), n=max(1, 10 ** 5 // size), unit=size)
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    benches = ('cache', 'feeder', 'monitor', 'links')
+
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='1000,10000,100000', help='Comma separated element counts')
+    parser.add_argument('--only', type=str, default=','.join(benches), help='Comma separated benchmarks to run')
+    parser.add_argument('--budget', type=float, default=10.0, help='Max seconds per operation and size')
+    parser.add_argument('--trace', action='store_true', help='Measure peak memory with tracemalloc')
+    parser.add_argument('--output', type=str, help='File to write results, default stdout')
+    args = parser.parse_args()
+
+    sizes = [int(float(s)) for s in args.sizes.split(',')]
+    only = args.only.split(',')
+    bench = Bench(args.budget, args.trace)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix='brood-micro-')
+    # Cache works relative to the current folder
+    os.chdir(workdir)
+
+    started_at = time.time()
+    for size in sizes:
+        if 'cache' in only:
+            bench_cache(bench, size)
+        if 'feeder' in only:
+            bench_feeder(bench, size, workdir)
+        if 'monitor' in only:
+            bench_monitor(bench, size)
+        if 'links' in only:
+            bench_links(bench, size)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps({
+        'commit': commit(),
+        'started_at': started_at,
+        'python': sys.version.split()[0],
+        'params': {'sizes': sizes, 'budget': args.budget, 'trace': args.trace},
+        'results': bench.results,
+    }, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
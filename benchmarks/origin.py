@@ -0,0 +1,104 @@
+"""
+Synthetic origin server for benchmarks.
+
+Serves `/p/<n>` html pages of a given size with `fanout` links to other
+pages, after a configurable latency, failing with 503 at a given rate.
+Pages are generated from their number, so every run serves the same
+site. Listening on several ports makes it look like several hosts to
+the per host scheduling of workers.
+"""
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import threading
+import time
+
+
+FILLER = (
+    'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do '
+    'eiusmod tempor incididunt ut labore et dolore magna aliqua. '
+)
+
+
+def page(host: str, n: int, pages: int, size: int, fanout: int) -> bytes:
+    """
+    Return the html of page n, with links to `fanout` other pages and
+    padded up to `size` bytes.
+    """
+    rand = random.Random(n)
+    links = ''.join(
+        f'<a href="http://{host}/p/{rand.randrange(pages)}">page</a>\n'
+        for _ in range(fanout)
+    )
+    head = f'<html><head><title>Page {n}</title></head><body>\n{links}<p>'
+    tail = '</p></body></html>\n'
+    padding = max(0, size - len(head) - len(tail))
+    filler = (FILLER * (padding // len(FILLER) + 1))[:padding]
+    return (head + filler + tail).encode('utf8')
+
+
+def make_handler(pages: int, size: int, fanout: int, latency: float, jitter: float, error_rate: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+            if self.path == '/robots.txt':
+                self._reply(404, b'')
+                return
+            if random.random() < error_rate:
+                self._reply(503, b'busy')
+                return
+            try:
+                n = int(self.path.rsplit('/', 1)[1])
+            except ValueError:
+                self._reply(404, b'not found')
+                return
+            self._reply(200, page(self.headers.get('Host', ''), n, pages, size, fanout))
+
+        def _reply(self, status: int, body: bytes):
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(ip, port, hosts=1, pages=1000, size=16 * 1024, fanout=10, latency=0.05, jitter=0.0, error_rate=0.0):
+    """
+    Serve the site on ports `port` to `port + hosts - 1`, blocking.
+    """
+    handler = make_handler(pages, size, fanout, latency, jitter, error_rate)
+    ThreadingHTTPServer.daemon_threads = True
+    servers = [ThreadingHTTPServer((ip, port + i), handler) for i in range(hosts)]
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    servers[0].serve_forever()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--ip', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--hosts', type=int, default=1, help='Ports to listen, one per simulated host')
+    parser.add_argument('--pages', type=int, default=1000, help='Pages in the site')
+    parser.add_argument('--size', type=int, default=16 * 1024, help='Bytes per page')
+    parser.add_argument('--fanout', type=int, default=10, help='Links per page')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds before replying')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Max seconds added to or removed from latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of 503 responses')
+    args = parser.parse_args()
+
+    try:
+        serve(
+            args.ip, args.port, args.hosts, args.pages, args.size, args.fanout,
+            args.latency, args.jitter, args.error_rate
+        )
+    except KeyboardInterrupt:
+        pass
@@ -25,11 +25,54 @@ parser.add_argument(
     help='Max depth scrapping urls in file. Default 3'
 )
 
+parser.add_argument(
+    '--output', type=str, default='files', choices=('files', 'segments', 'warc'),
+    help='How results are saved: one file per url, packed segments or '
+         'compressed WARC archives with a CDX index. Default files'
+)
+
+parser.add_argument(
+    '--max-age', type=float,
+    help='Max age in seconds of cached pages, older ones are revalidated. '
+         'Default any age'
+)
+
+parser.add_argument(
+    '--metrics-port', type=int,
+    help='Port to serve metrics in Prometheus text format. Default none'
+)
+
+parser.add_argument(
+    '--prefetch', type=int, default=0,
+    help='Links per page that workers may fetch and cache before they are '
+         'requested. Default 0, no prefetch'
+)
+
+parser.add_argument(
+    '--frontier', action='store_true',
+    help='If present urls are leased from a frontier node, shared with other '
+         'clients, and the file only seeds it'
+)
+
+parser.add_argument(
+    '--checkpoint', type=str, default='checkpoint',
+    help='Folder to save the state of the crawl, unused with a frontier. '
+         'Default checkpoint'
+)
+parser.add_argument(
+    '--resume', action='store_true',
+    help='If present the crawl saved in checkpoint folder is resumed '
+         'instead of starting from file'
+)
+
 args = parser.parse_args()
 
-client = Client(args.ip, args.file, args.n, args.depth)
+client = Client(
+    args.ip, args.file, args.n, args.depth, args.output, args.max_age, args.metrics_port,
+    args.prefetch, args.frontier, args.checkpoint, args.resume)
 
 try:
     client.start()
 except KeyboardInterrupt:
     print('>>> Stopped by user!')
+    client.stop()
@@ -0,0 +1,38 @@
+"""
+Main entry point for run a frontier node.
+"""
+from argparse import ArgumentParser
+
+from src.frontier import Frontier
+
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    '--ip', type=str, required=True,
+    help='Interface IP address'
+)
+parser.add_argument(
+    '--port', type=int, required=True,
+    help='Port to listen clients connections'
+)
+parser.add_argument(
+    '--metrics-port', type=int,
+    help='Port to serve metrics in Prometheus text format. Default none'
+)
+parser.add_argument(
+    '--checkpoint', type=str, default='checkpoint',
+    help='Folder to save the state of the crawl. Default checkpoint'
+)
+parser.add_argument(
+    '--resume', action='store_true',
+    help='If present the crawl saved in checkpoint folder is resumed'
+)
+args = parser.parse_args()
+
+frontier = Frontier(args.ip, args.port, args.metrics_port, args.checkpoint, args.resume)
+
+try:
+    frontier.start()
+except KeyboardInterrupt:
+    print('>>> Stopped by user!')
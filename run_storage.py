@@ -24,9 +24,13 @@ parser.add_argument(
     '--update', action='store_true',
     help='If present this storage will update his cache'
 )
+parser.add_argument(
+    '--metrics-port', type=int,
+    help='Port to serve metrics in Prometheus text format. Default none'
+)
 args = parser.parse_args()
 
-storage = Storage(args.ip, args.port, args.cache, args.update)
+storage = Storage(args.ip, args.port, args.cache, args.update, args.metrics_port)
 
 try:
     storage.start()
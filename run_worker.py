@@ -3,7 +3,8 @@ Main entry point for run a worker node.
 """
 from argparse import ArgumentParser
 
-from src.worker import Worker
+from src import settings
+from src.worker import Worker, WorkerFront
 
 
 parser = ArgumentParser()
@@ -16,12 +17,26 @@ parser.add_argument(
     '--port', type=int,
     help='Port to bind'
 )
+parser.add_argument(
+    '--processes', type=int, default=settings.WORKER_PROCESSES,
+    help='Worker processes behind the port, one per core is a good choice'
+)
+parser.add_argument(
+    '--metrics-port', type=int,
+    help='Port to serve metrics in Prometheus text format, children of a '
+         'multi-process worker use the next ones. Default none'
+)
 
-args = parser.parse_args()
+# children of a multi-process worker are spawned importing this module
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-worker = Worker(args.ip, args.port)
+    if args.processes > 1:
+        worker = WorkerFront(args.ip, args.port, args.processes, args.metrics_port)
+    else:
+        worker = Worker(args.ip, args.port, metrics_port=args.metrics_port)
 
-try:
-    worker.start()
-except KeyboardInterrupt:
-    print('>>> Stopped by user!')
+    try:
+        worker.start()
+    except KeyboardInterrupt:
+        print('>>> Stopped by user!')
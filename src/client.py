@@ -1,16 +1,21 @@
 """
 Client class.
 """
+from collections import deque
 import logging
 import threading
 import time
 
 import zmq
 
-from src.utils.client import UrlFeeder, WorkerDisc
-from src.utils.functions import random_id, pipe
-from src.utils.storage import Cache
+from src import settings
+from src.utils.client import UrlFeeder, WorkerDisc, FrontierDisc, WorkerConn, choose_worker
+from src.utils.checkpoint import Checkpoint
+from src.utils.functions import random_id, pipe, pack_msg, unpack_msg
+from src.utils.results import make_writer
 from src.utils.html import HTMLParser, URLParser
+from src.utils.metrics import REGISTRY
+from src.utils.url import canonicalize
 
 
 logging.basicConfig(
@@ -19,37 +24,79 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+REQUESTS = REGISTRY.counter('client_requests_total', 'Requests sent to workers')
+RESPONSES = REGISTRY.counter('client_responses_total', 'Responses received from workers by hit')
+BYTES_IN = REGISTRY.counter('client_bytes_in_total', 'Bytes of pages received')
+FAILURES = REGISTRY.counter('client_failures_total', 'Error responses received from workers by hit')
+REQUEST_SECONDS = REGISTRY.histogram(
+    'client_request_seconds', 'Time from sending a request to receiving its page')
+
 
 class Client:
     """
     Represent a client node in the system.
     Send requests with url and expects the HTML code.
+
+    With a frontier, urls are leased from the frontier node instead of
+    taken from the own file, which only seeds it, and the links found
+    are reported back to it, so clients split the crawl between them.
+    Otherwise the urls found and crawled are saved to a checkpoint, if
+    given, from which a killed client can resume its crawl.
     """
 
-    def __init__(self, ip, url_file, n, depth):
+    def __init__(
+        self, ip, url_file, n, depth, output='files', max_age=None, metrics_port=None,
+        prefetch=0, frontier=False, checkpoint=None, resume=False,
+        request_interval=settings.CLIENT_REQUEST_INTERVAL
+    ):
         self.id = random_id()
         self.inter_ip = ip
         self.ctx = zmq.Context()
 
-        self.sender_sock = None     # talk to workers
         self.pipe_sock = None       # talk to discovering service
 
-        self.workers = {}           # workers discovered so far
+        self.workers = {}           # connections to workers discovered so far
 
         self.discoverer = None      # discovering service
 
         self.feeder = UrlFeeder(url_file, n)
         self.depth = depth
+        self.max_age = max_age      # max age in seconds of cached pages
+        self.metrics_port = metrics_port
+        self.prefetch = prefetch    # links per page workers may prefetch
+        self.request_interval = request_interval    # seconds to wait after each request
 
         self.url_depths = {}
-        self.cache = Cache(cache_folder='result')
+        self.written = deque()              # urls saved by writer, to checkpoint or report
+        self.writer = make_writer(          # save results in background
+            output, on_written=self.written.extend if checkpoint or frontier else None)
+
+        self.frontier = frontier        # take urls from a frontier node
+        self.frontier_sock = None       # talk to frontier
+        self.frontier_pipe = None       # talk to frontier discovering service
+        self.frontier_id = None         # frontier in use
+        self.frontier_addr = None
+        self.frontier_pendant = None    # urls left in frontier, None until known
+        self.seeds = self.feeder.drain() if frontier else []
+        self.leases = {}                # url -> id of its lease in frontier
+        self.unreported = {}            # url -> links found, reported once it's written
+        self.lease_at = 0.0             # when to ask frontier for more urls
+
+        # the frontier keeps the state of the crawl instead
+        self.checkpoint = Checkpoint(checkpoint) if checkpoint and not frontier else None
+        if self.checkpoint is not None:
+            self._load_checkpoint(resume)
 
     def start(self):
         """
         Start client services and bind its interfaces.
         """
-        self.sender_sock = self.ctx.socket(zmq.DEALER)
-        # self.pipe_sock.setsockopt_string(zmq.IDENTITY, self.id)
+        self.writer.start()
+
+        if self.metrics_port is not None:
+            REGISTRY.gauge('client_pendant_urls', 'Urls not scrapped yet').track(
+                lambda: len(self.feeder))
+            REGISTRY.serve(self.inter_ip, self.metrics_port)
 
         self.pipe_sock, pipe_sock = pipe(self.ctx)
 
@@ -63,10 +110,33 @@ class Client:
 
         poller = zmq.Poller()
         poller.register(self.pipe_sock, zmq.POLLIN)
-        poller.register(self.sender_sock, zmq.POLLIN | zmq.POLLOUT)
+
+        if self.frontier:
+            self.frontier_sock = self.ctx.socket(zmq.DEALER)
+            self.frontier_pipe, pipe_sock = pipe(self.ctx)
+            threading.Thread(
+                target=FrontierDisc(self.inter_ip, pipe_sock).start,
+                name='Frontier-Discoverer',
+                daemon=True
+            ).start()
+            logging.info('Frontier discovering service started...')
+            poller.register(self.frontier_pipe, zmq.POLLIN)
+            poller.register(self.frontier_sock, zmq.POLLIN)
 
         while True:
-            socks = dict(poller.poll())
+            # wake up to ask frontier for urls even if nothing happens
+            socks = dict(poller.poll(1000 if self.frontier else None))
+            self._handle_written()
+            if self.checkpoint is not None:
+                self.checkpoint.tick()
+
+            if self.frontier:
+                if self.frontier_pipe in socks:
+                    self._frontier_update(self.frontier_pipe.recv_json(zmq.DONTWAIT))
+                if self.frontier_sock in socks:
+                    res, _ = unpack_msg(self.frontier_sock.recv_multipart(zmq.DONTWAIT))
+                    self._add_leases(res)
+                self._lease()
 
             # process the updates from workers discovering service
             if self.pipe_sock in socks:
@@ -83,74 +153,257 @@ class Client:
                         continue
 
                 # worker is not longer accessible, close the connection
+                # and request again what it didn't answer
                 if action == 'delete':
-                    self.sender_sock.disconnect('tcp://%s:%d' % self.workers[wid])
-                    self.workers.pop(wid)
-                    logging.info(f'Removed worker {wid}')
+                    conn = self.workers.pop(wid)
+                    poller.unregister(conn.sock)
+                    conn.close()
+                    for rid in conn.sent:
+                        self.feeder.retry(rid)
+                    logging.info(f'Removed worker {wid}, {len(conn.sent)} requests retried')
 
                 # new worker, establish a connection
                 elif action == 'add':
-                    self.sender_sock.connect('tcp://%s:%d' % addr)
-                    self.workers[wid] = addr
+                    conn = WorkerConn(wid, self.ctx.socket(zmq.DEALER), addr)
+                    conn.set_load(msg['load'])
+                    poller.register(conn.sock, zmq.POLLIN | zmq.POLLOUT)
+                    self.workers[wid] = conn
                     logging.info(f'Added worker {wid}: {addr}')
 
                 # worker changed his interface, update the conection
                 elif action == 'update':
-                    self.sender_sock.disconnect('tcp://%s:%d' % self.workers[wid])
-                    self.sender_sock.connect('tcp://%s:%d' % addr)
-                    old_addr, self.workers[wid] = self.workers[wid], addr
+                    conn = self.workers[wid]
+                    old_addr = conn.addr
+                    conn.connect(addr)
                     logging.info(f'Updated worker {wid}: {old_addr} -> {addr}')
 
-            if self.sender_sock in socks:
-                event = socks[self.sender_sock]
+                # worker announced its load
+                elif action == 'load':
+                    self.workers[wid].set_load(msg['load'])
 
-                # process the responses from workers
-                if event in (zmq.POLLIN, zmq.POLLIN | zmq.POLLOUT):
+            # process the responses from workers
+            for conn in self.workers.values():
+                if socks.get(conn.sock, 0) & zmq.POLLIN:
                     try:
-                        res = self.sender_sock.recv_json(zmq.DONTWAIT)
+                        res, content = unpack_msg(conn.sock.recv_multipart(zmq.DONTWAIT))
                     except zmq.error.Again:
                         pass
                     else:
-                        if 'url' in res:
-                            self.feeder.done(res['url'])
-                            if res['url'] not in self.url_depths:
-                                self.url_depths[res['url']] = 0
-                            depth = self.url_depths[res['url']]
+                        rid = res.get('rid')
+                        conn.sent.discard(rid)
+                        done = self.feeder.done(rid) if rid is not None else None
+                        # a timed out request is still useful if its url wasn't answered
+                        if done is None and rid is not None:
+                            done = self.feeder.late(rid)
+                            if done is not None:
+                                logging.info(f'Late reply of {done[0]}, used')
+                        if done is not None and content is not None:
+                            url, elapsed = done
+                            REQUEST_SECONDS.observe(elapsed)
+                            RESPONSES.inc(hit=bool(res.get('hit')))
+                            BYTES_IN.inc(len(content))
+                            if url not in self.url_depths:
+                                self.url_depths[url] = 0
+                            depth = self.url_depths[url]
 
+                            links = []
                             if depth + 1 < self.depth:
                                 # Get urls in html content
-                                next_urls = HTMLParser.links(res['content'])
+                                next_urls = HTMLParser.links(
+                                    content.decode(res.get('charset') or 'utf8', 'replace'))
+                                links = self._same_host(url, next_urls)
 
+                            if self.frontier:
+                                # the frontier forgets the url, so it must be written first
+                                self.unreported[url] = links
+                            else:
                                 # Add html urls to buffer
-                                for nurl in next_urls:
-                                    if res['url'] == URLParser.netloc(nurl) and self.cache.get(nurl) is None:
+                                for nurl in links:
+                                    if nurl not in self.url_depths and nurl not in self.writer:
                                         self.feeder.append(nurl)
                                         self.url_depths[nurl] = depth + 1
+                                        if self.checkpoint is not None:
+                                            self.checkpoint.add(nurl, depth + 1)
 
-                            self._save(res['url'], res['content'])
-                            logging.info(f'Received {res["url"]}. Missing: {len(self.feeder)}')
+                            self._save(url, content, {
+                                'status': res.get('status'),
+                                'headers': res.get('headers'),
+                                'fetched_at': res.get('fetched_at'),
+                                'charset': res.get('charset'),
+                            })
+                            logging.info(f'Received {url}. Missing: {len(self.feeder)}')
+                        elif done is not None and 'error' in res:
+                            # failed urls aren't requested again
+                            url, elapsed = done
+                            REQUEST_SECONDS.observe(elapsed)
+                            FAILURES.inc(hit=bool(res.get('hit')))
+                            if self.frontier:
+                                self._report(url, [])
+                            if self.checkpoint is not None:
+                                self.checkpoint.done(url)
+                            logging.warning(f'Failed {url}: {res["error"]}. Missing: {len(self.feeder)}')
+                        elif done is None:
+                            logging.info(f'Ignored reply of late or unknown request {rid}')
                         else:
-                            logging.warning(f'Received: {res.get("error", "error")}')
-
-                # make a request to workers
-                if event in (zmq.POLLOUT, zmq.POLLIN | zmq.POLLOUT) and self.workers:
-                    url = self.feeder.feed()
-                    if url:
-                        self.sender_sock.send_json(
-                            {
-                                'id': self.id,
-                                'url': url,
-                            }
-                        )
-                        logging.info(f'Requested {url}')
-                        time.sleep(1)
-
-            if not self.feeder:
+                            # neither content nor error, request it again
+                            self.feeder.append(done[0])
+                            logging.warning(f'Bad reply of {done[0]}, requested again')
+
+            # make a request to the less loaded of the workers
+            writable = [conn for conn in self.workers.values() if socks.get(conn.sock, 0) & zmq.POLLOUT]
+            if writable:
+                # forget requests timed out, they are fed again
+                for conn in writable:
+                    conn.sent.intersection_update(self.feeder.pendant)
+                pendant = self.feeder.feed()
+                if pendant:
+                    rid, url = pendant
+                    req = {
+                        'rid': rid,
+                        'url': url,
+                    }
+                    if self.max_age is not None:
+                        req['max_age'] = self.max_age
+                    # levels of links that will be followed from this page
+                    levels = self.depth - self.url_depths.get(url, 0) - 1
+                    if self.prefetch and levels > 0:
+                        req['prefetch'] = {'depth': levels, 'budget': self.prefetch}
+                    conn = choose_worker(writable)
+                    conn.sock.send_multipart(pack_msg(req))
+                    conn.sent.add(rid)
+                    REQUESTS.inc()
+                    logging.debug('Requested %s to %s', url, conn.wid)
+                    if self.request_interval:
+                        time.sleep(self.request_interval)
+
+            # with a frontier, the urls leased to other clients may add more
+            if not self.feeder and (not self.frontier or self.frontier_pendant == 0):
+                self.stop()
                 logging.info('>>> Done!')
                 break
 
-    def _save(self, url: str, content: str):
+    @staticmethod
+    def _same_host(url: str, links: list) -> list:
+        """
+        Return the canonical form of links to the host of url.
+        """
+        host = URLParser.netloc(url)
+        same = []
+        for link in links:
+            try:
+                link = canonicalize(link)
+            except ValueError:
+                continue
+            if URLParser.netloc(link) == host:
+                same.append(link)
+        return same
+
+    def stop(self):
+        """
+        Write the results received and save the checkpoint or tell the
+        frontier, so a resumed crawl only asks for what wasn't written.
+        """
+        self.writer.close()
+        self._handle_written()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+    def _handle_written(self):
+        """
+        Mark as crawled the urls already written by the writer, in the
+        checkpoint or the frontier.
+        """
+        while self.written:
+            url = self.written.popleft()
+            if self.checkpoint is not None:
+                self.checkpoint.done(url)
+            if self.frontier:
+                self._report(url, self.unreported.pop(url, []))
+
+    def _load_checkpoint(self, resume: bool):
+        """
+        Take the urls left from checkpoint if resuming, otherwise start
+        a new checkpoint with the urls in file.
+        """
+        if resume:
+            self.url_depths, done = self.checkpoint.load()
+            self.feeder.drain()
+            for url in self.url_depths:
+                if url not in done:
+                    self.feeder.append(url)
+            return
+
+        self.checkpoint.reset()
+        for url in self.feeder.buffer:
+            self.url_depths[url] = 0
+            self.checkpoint.add(url, 0)
+
+    def _frontier_update(self, msg: dict):
+        """
+        Follow the frontier in use, the first one discovered.
+        """
+        action = msg['action']
+        fid = msg['peer']
+
+        if action == 'add' and self.frontier_id is None:
+            self.frontier_id, self.frontier_addr = fid, tuple(msg['addr'])
+            self.frontier_sock.connect('tcp://%s:%d' % self.frontier_addr)
+            # urls already in frontier are ignored, so clients can share seeds
+            self.frontier_sock.send_multipart(pack_msg({'type': 'seed', 'urls': self.seeds}))
+            self.lease_at = 0.0
+            logging.info(f'Using frontier {fid}: {self.frontier_addr}')
+
+        elif action == 'delete' and fid == self.frontier_id:
+            # urls in buffer are still crawled, their leases are lost
+            self.frontier_sock.disconnect('tcp://%s:%d' % self.frontier_addr)
+            self.frontier_id = self.frontier_addr = self.frontier_pendant = None
+            self.leases.clear()
+            logging.info(f'Removed frontier {fid}')
+
+        elif action == 'update' and fid == self.frontier_id:
+            self.frontier_sock.disconnect('tcp://%s:%d' % self.frontier_addr)
+            self.frontier_addr = tuple(msg['addr'])
+            self.frontier_sock.connect('tcp://%s:%d' % self.frontier_addr)
+            logging.info(f'Updated frontier {fid}: {self.frontier_addr}')
+
+    def _lease(self):
+        """
+        Ask frontier for urls when few are left to request.
+        """
+        if (
+            self.frontier_id is None or len(self.feeder) >= settings.FRONTIER_BATCH or
+            time.time() < self.lease_at
+        ):
+            return
+
+        self.frontier_sock.send_multipart(pack_msg({
+            'type': 'lease',
+            'n': settings.FRONTIER_BATCH - len(self.feeder),
+        }))
+        # don't ask again until the reply, or after a lease time if lost
+        self.lease_at = time.time() + settings.FRONTIER_LEASE_TIME
+
+    def _add_leases(self, res: dict):
+        for lid, url, depth in res['leases']:
+            self.leases[url] = lid
+            self.url_depths[url] = depth
+            self.feeder.append(url)
+
+        self.frontier_pendant = res['pendant']
+        self.lease_at = time.time()
+        if not res['leases']:
+            self.lease_at += settings.FRONTIER_RETRY_INTERVAL
+
+    def _report(self, url: str, links: list):
+        """
+        Tell frontier an url was crawled and the links found in it.
+        """
+        lid = self.leases.pop(url, None)
+        if lid is not None and self.frontier_id is not None:
+            self.frontier_sock.send_multipart(pack_msg({'type': 'done', 'lid': lid, 'links': links}))
+
+    def _save(self, url: str, content: bytes, meta: dict = None):
         """
         How must be saved html code received
         """
-        Cache(cache_folder='result').set(url, content)
+        self.writer.put(url, content, meta)
@@ -0,0 +1,124 @@
+import threading
+import logging
+
+import zmq
+
+from src.settings import FRONTIER_MCAST_ADDR
+from src.utils.frontier import UrlFrontier
+from src.utils.checkpoint import Checkpoint
+from src.utils.metrics import REGISTRY
+from src.utils.udp import UDPSender
+from src.utils.functions import random_id, pack_msg, unpack_msg
+
+logging.basicConfig(
+    # format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
+    format='[%(levelname)s]: %(message)s',
+    level=logging.INFO
+)
+
+REQUESTS = REGISTRY.counter('frontier_requests_total', 'Requests handled by type')
+LEASED = REGISTRY.counter('frontier_leased_total', 'Urls leased to clients')
+DONE = REGISTRY.counter('frontier_done_total', 'Leased urls reported by clients, by whether in time')
+
+
+class Frontier:
+    """
+    Represents a frontier node in the system.
+    Owns the urls of a crawl, so clients split the work instead of
+    repeating it: clients seed it with their urls, lease batches of them
+    and report the links found in each page.
+    """
+
+    def __init__(self, ip, port, metrics_port=None, checkpoint=None, resume=False):
+        self.address = (ip, port)
+        self.metrics_port = metrics_port
+        self.ctx = zmq.Context()
+        self.id = random_id()
+        self.ping_sender = None
+        self.router_sock = None     # talk to clients
+
+        self.checkpoint = Checkpoint(checkpoint) if checkpoint else None
+        self.frontier = UrlFrontier(checkpoint=self.checkpoint)
+        if self.checkpoint is not None:
+            if resume:
+                self.frontier.restore()
+            else:
+                self.checkpoint.reset()
+
+    def init_ping_sender(self):
+        self.ping_sender = UDPSender(
+            'f',
+            self.id,
+            self.address[1],
+            self.address[0],
+            FRONTIER_MCAST_ADDR,
+            lambda: (len(self.frontier.queue), len(self.frontier.leases), 0)
+        )
+        threading.Thread(
+            target=self.ping_sender.start,
+            name='Ping-Clients',
+            daemon=True
+        ).start()
+        logging.info(f'Frontier {self.id}: Ping service started...')
+
+    def serve_metrics(self):
+        size = REGISTRY.gauge('frontier_urls', 'Urls in the frontier by state')
+        size.track(lambda: len(self.frontier.queue), state='queued')
+        size.track(lambda: len(self.frontier.leases), state='leased')
+        size.track(lambda: len(self.frontier.seen), state='seen')
+        REGISTRY.gauge('frontier_expired_leases', 'Leases expired before being reported').track(
+            lambda: self.frontier.expired)
+
+        REGISTRY.serve(self.address[0], self.metrics_port)
+        logging.info(f'Frontier {self.id}: Metrics served at {self.address[0]}:{self.metrics_port}')
+
+    def start(self):
+        """
+        Start frontier service
+        """
+        self.router_sock = self.ctx.socket(zmq.ROUTER)
+        self.router_sock.bind('tcp://%s:%s' % self.address)
+        if self.metrics_port is not None:
+            self.serve_metrics()
+        self.init_ping_sender()
+
+        logging.info(f'Frontier {self.id}: Router service started...')
+
+        while True:
+            if self.checkpoint is not None:
+                self.checkpoint.tick()
+            if not self.router_sock.poll(1000):
+                continue
+
+            conn_id, *frames = self.router_sock.recv_multipart()
+            try:
+                req, _ = unpack_msg(frames)
+                res = self._handle_request(req)
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f'Bad request from {conn_id}')
+                continue
+
+            if res is not None:
+                self.router_sock.send_multipart([conn_id, *pack_msg(res)])
+
+    def _handle_request(self, req: dict):
+        REQUESTS.inc(type=req['type'])
+
+        if req['type'] == 'seed':
+            added = sum(self.frontier.add(url) for url in req['urls'])
+            logging.info(f'Frontier {self.id}: Seeded {added} new urls of {len(req["urls"])}')
+
+        elif req['type'] == 'lease':
+            leases = self.frontier.lease(int(req['n']))
+            LEASED.inc(len(leases))
+            return {
+                'type': 'leases',
+                'leases': leases,
+                'pendant': len(self.frontier),
+            }
+
+        elif req['type'] == 'done':
+            in_time = self.frontier.done(int(req['lid']), req.get('links', ()))
+            DONE.inc(in_time=in_time)
+
+        return None
@@ -1,7 +1,21 @@
 """
 Settings of the system.
+
+Any of them can be overridden with a json object in the `BROOD_SETTINGS`
+environment variable, which child processes inherit.
 """
-PEER_EXPIRY = 5.0
+import json
+import os
+
+PEER_EXPIRY = 5.0               # seconds of silence after which a peer is removed anyway
+PEER_PHI_THRESHOLD = 8.0        # suspicion of a silent peer to remove it
+PEER_HISTORY = 100              # intervals between beacons kept per peer
+PEER_MIN_STD = 0.2              # min deviation of intervals, to not remove peers on jitter
+PEER_ACCEPTABLE_PAUSE = 1.0     # seconds of silence tolerated over the usual, as gc or GIL stalls
+PEER_SUSPICIONS = 2             # consecutive checks a peer is suspected before removing it
+PEER_REAP_INTERVAL = 0.1        # seconds between checks of silent peers
+BEACON_INTERVAL = 0.2           # seconds between beacons
+BEACON_MAX_SIZE = 512           # bytes read of a beacon
 
 WORKER_MCAST_GROUP = '224.1.1.1'
 WORKER_MCAST_PORT = 4040
@@ -9,7 +23,6 @@ WORKER_MCAST_ADDR = (
     WORKER_MCAST_GROUP,
     WORKER_MCAST_PORT
 )
-WORKER_PING_SIZE = 12
 WORKER_REQ_EXPIRY = 2   # request that worker makes to cache expiry time
 
 PUB_SUB_CHANNEL_NAME = 'DB-UPDATE'
@@ -19,4 +32,89 @@ STORAGE_MCAST_ADDR = (
     STORAGE_MCAST_GROUP,
     STORAGE_MCAST_PORT
 )
-STORAGE_PING_SIZE = 12
+
+FRONTIER_MCAST_GROUP = '226.1.1.1'
+FRONTIER_MCAST_PORT = 4042
+FRONTIER_MCAST_ADDR = (
+    FRONTIER_MCAST_GROUP,
+    FRONTIER_MCAST_PORT
+)
+FRONTIER_LEASE_TIME = 60.0      # seconds a client has to crawl a leased url
+FRONTIER_BATCH = 16             # urls leased to a client at once
+FRONTIER_RETRY_INTERVAL = 1.0   # seconds before asking again for urls
+CLIENT_REQUEST_INTERVAL = 1.0   # seconds a client waits after sending a request
+
+RESULT_QUEUE_SIZE = 1024        # results waiting to be written by client
+RESULT_BATCH_SIZE = 64
+RESULT_FLUSH_INTERVAL = 0.5
+RESULT_SEGMENT_SIZE = 64 * 1024 * 1024
+RESULT_WARC_COMPRESSION = 6
+RESULT_READ_SIZE = 1024 * 1024
+
+CHECKPOINT_INTERVAL = 1.0           # seconds between writes of the crawl log
+CHECKPOINT_COMPACT_SIZE = 100000    # log lines merged into a new snapshot
+
+DNS_TTL = 300.0             # seconds a resolved host is cached by workers
+DNS_NEGATIVE_TTL = 30.0     # seconds a failed resolution is cached
+DNS_WORKERS = 4             # concurrent lookups
+DNS_TIMEOUT = 5.0           # seconds a fetch waits for the resolution of its host
+
+WORKER_SCRAPPERS = 8        # fetch threads per worker
+WORKER_HOST_RATE = 1.0      # fetches per second to a single host
+WORKER_HOST_BURST = 2.0
+WORKER_ROBOTS = True        # honor robots.txt crawl-delay
+WORKER_ROBOTS_TIMEOUT = 5.0
+WORKER_MAX_BODY_SIZE = 10 * 1024 * 1024     # bigger pages are aborted
+WORKER_CHUNK_SIZE = 64 * 1024
+WORKER_CONTENT_TYPES = (
+    'text/html',
+    'application/xhtml+xml',
+)
+
+WORKER_CONNECT_TIMEOUT = 5.0
+WORKER_READ_TIMEOUT = 15.0      # max seconds between bytes received
+WORKER_FETCH_DEADLINE = 60.0    # max seconds downloading a page
+WORKER_MAX_RETRY_AFTER = 300.0
+WORKER_RETRY_POLICIES = {   # error class: (max retries, base delay, max delay)
+    'connect': (3, 1.0, 30.0),
+    'timeout': (2, 2.0, 60.0),
+    'server': (2, 5.0, 120.0),
+    'throttled': (3, 10.0, 300.0),
+}
+
+WORKER_MIN_REQ_EXPIRY = 0.05    # lower bound of adaptive cache expiry time
+WORKER_DEADLINE_FACTOR = 2.0    # cache expiry time as multiple of p99 latency
+WORKER_LATENCY_SAMPLES = 256    # latencies kept per storage
+WORKER_LATENCY_MIN_SAMPLES = 20
+WORKER_HEDGE = True             # ask a second storage after p95 latency
+WORKER_STORAGE_POLICY = 'ewma'  # or 'least_outstanding', 'round_robin'
+WORKER_EWMA_INITIAL = 0.1       # latency assumed for a new storage
+WORKER_EWMA_DECAY = 10.0        # seconds for latency EWMA to forget a peak
+WORKER_POLL_TIMEOUT = 50        # ms
+WORKER_PROCESSES = 1            # child worker processes behind one front
+WORKER_READY = b'READY'         # child to front: ready to take requests
+WORKER_DROPPED = b'DROPPED'     # child to front: a request won't be answered
+WORKER_RESPAWN_INTERVAL = 1.0   # seconds between checks of dead children
+STORAGE_READERS = 4             # threads serving cache lookups
+STORAGE_READY = b'READY'        # reader to storage: ready to take a lookup
+WORKER_MAX_REQUESTS = 10000     # requests held before stop reading clients
+WORKER_UPDATES_QUEUE = 1000     # cache updates waiting for a storage
+STORAGE_LOOKUPS_QUEUE = 10000   # lookups held before stop reading workers
+STORAGE_UPDATES_QUEUE = 10000   # updates waiting to be replicated
+STORAGE_MISSING_RETRY = 1.0     # seconds before asking another peer for a missing content
+STORAGE_MISSING_ATTEMPTS = 3    # peers asked for a missing content before it's a miss
+WORKER_PREFETCH_BUDGET = 20     # max links prefetched per page, 0 disables prefetch
+WORKER_PREFETCH_SEEN = 100000   # prefetched urls remembered to not repeat them
+WORKER_PREFETCH_PAGES = 100     # pages waiting for their links to be extracted
+STORAGE_MAX_BYTES = 10 * 1024 ** 3  # bytes of contents kept, None for no limit
+STORAGE_MAX_ENTRIES = 1000000   # entries kept, None for no limit
+STORAGE_TTL = None              # seconds an entry is kept, None for ever
+STORAGE_EVICT_INTERVAL = 1.0    # seconds between eviction rounds
+STORAGE_EVICT_SAMPLES = 16      # entries sampled to pick the least recently used
+STORAGE_LOW_WATERMARK = 0.9     # fraction of the limits evicted down to
+STORAGE_DISK_FULL_SHRINK = 0.9  # fraction of stored bytes kept when the disk is full
+WORKER_NEGATIVE_TTL = 600.0     # seconds a failed url is answered with its error
+WORKER_NEGATIVE_SIZE = 100000   # failed urls remembered by a worker
+WORKER_METRICS_HOSTS = 20       # busiest hosts labelled in fetch metrics, the rest as 'other'
+
+globals().update(json.loads(os.environ.get('BROOD_SETTINGS') or '{}'))
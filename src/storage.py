@@ -1,15 +1,25 @@
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import deque
+import errno
 import threading
 import logging
+import time
 
 import zmq
 
 from src.settings import (
-    STORAGE_MCAST_ADDR
+    STORAGE_MCAST_ADDR, STORAGE_READERS, STORAGE_READY,
+    STORAGE_LOOKUPS_QUEUE, STORAGE_UPDATES_QUEUE, STORAGE_MAX_BYTES,
+    STORAGE_MAX_ENTRIES, STORAGE_TTL, STORAGE_EVICT_INTERVAL, STORAGE_EVICT_SAMPLES,
+    STORAGE_LOW_WATERMARK, STORAGE_DISK_FULL_SHRINK, STORAGE_MISSING_RETRY,
+    STORAGE_MISSING_ATTEMPTS
 )
 from src.utils.storage import Cache
+from src.utils.queues import BoundedQueue
+from src.utils.metrics import REGISTRY
 from src.utils.worker import StorageDisc
 from src.utils.udp import UDPSender
-from src.utils.functions import random_id, pipe
+from src.utils.functions import random_id, pipe, pack_msg, unpack_msg
 
 logging.basicConfig(
     # format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
@@ -17,19 +27,39 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+REQUESTS = REGISTRY.counter('storage_requests_total', 'Requests handled by type')
+LOOKUPS = REGISTRY.counter('storage_lookups_total', 'Cache lookups by hit')
+LOOKUP_SECONDS = REGISTRY.histogram('storage_lookup_seconds', 'Time reading an entry from cache')
+LOOKUP_WAIT_SECONDS = REGISTRY.histogram(
+    'storage_lookup_wait_seconds', 'Time lookups waited for a free reader')
+BYTES_IN = REGISTRY.counter('storage_bytes_in_total', 'Bytes of pages written to cache')
+BYTES_OUT = REGISTRY.counter('storage_bytes_out_total', 'Bytes of pages sent to workers')
+DEDUPLICATED = REGISTRY.counter(
+    'storage_deduplicated_total', 'Updates whose content was already stored by another url')
+EVICTIONS = REGISTRY.counter('storage_evictions_total', 'Entries removed from cache by reason')
+WRITE_ERRORS = REGISTRY.counter('storage_write_errors_total', 'Updates that could not be written')
+
 
 class Storage:
     """
     Represents a storage node in the system.
     Manage url caching
+
+    Lookups are served by a pool of reader threads, so slow disk reads
+    don't queue behind each other, while updates and replication are
+    handled by the main thread. An evictor thread removes expired and
+    least recently used entries over the limits, and the main thread
+    tells peers to remove them too.
     """
 
-    def __init__(self, ip, port, cache_folder, update):
+    def __init__(self, ip, port, cache_folder, update, metrics_port=None):
         self.address = (ip, port)
+        self.metrics_port = metrics_port
         self.ctx = zmq.Context()
         self.id = random_id()
         self.ping_sender = None
         self.router_sock = None
+        self.readers_sock = None        # ROUTER sock to dispatch lookups to readers
 
         self.discoverer = None          # discovering service
         self.disc_sock = None           # PAIR sock to pipe discovering service
@@ -38,10 +68,25 @@ class Storage:
         self.storages = {}              # storages discovered
         self.storage_conns = {}
 
-        self.cache = Cache(cache_folder)
-
-        self.res_queue = []     # responses to deliver
-        self.upd_queue = []     # updates to deliver
+        self.cache = Cache(
+            cache_folder,
+            max_bytes=STORAGE_MAX_BYTES,
+            max_entries=STORAGE_MAX_ENTRIES,
+            ttl=STORAGE_TTL,
+            low_watermark=STORAGE_LOW_WATERMARK,
+            samples=STORAGE_EVICT_SAMPLES
+        )
+        self.evicted: Deque[str] = deque()  # urls evicted, to tell peers
+        self.evict_now = threading.Event()  # wake the evictor before time
+
+        self.idle_readers: Deque[bytes] = deque()
+        # lookups waiting for a reader, when full workers aren't read
+        self.lookups = BoundedQueue('lookups', STORAGE_LOOKUPS_QUEUE, policy='reject')
+        # updates to replicate, oldest are dropped if peers can't keep up
+        self.upd_queue = BoundedQueue('updates', STORAGE_UPDATES_QUEUE)
+        # contents linked by peers but not stored here, by url:
+        # [digest, meta, asked at, attempts]
+        self.missing: Dict[str, List] = {}
 
         self.update_cache = update     # storage should update his cache
 
@@ -51,7 +96,9 @@ class Storage:
             self.id,
             self.address[1],
             self.address[0],
-            STORAGE_MCAST_ADDR
+            STORAGE_MCAST_ADDR,
+            lambda: (
+                len(self.lookups), STORAGE_READERS - len(self.idle_readers), STORAGE_LOOKUPS_QUEUE)
         )
         threading.Thread(
             target=self.ping_sender.start,
@@ -80,11 +127,113 @@ class Storage:
         self.router_sock = self.ctx.socket(zmq.ROUTER)
         self.router_sock.bind('tcp://%s:%s' % self.address)
 
+    def init_readers(self):
+        endpoint = f'inproc://readers-{self.id}'
+        self.readers_sock = self.ctx.socket(zmq.ROUTER)
+        self.readers_sock.bind(endpoint)
+
+        for i in range(STORAGE_READERS):
+            threading.Thread(
+                target=self._reader,
+                args=(endpoint, ),
+                name=f'Reader-{i}',
+                daemon=True
+            ).start()
+        logging.info(f'Storage {self.id}: {STORAGE_READERS} readers started...')
+
+    def _reader(self, endpoint: str):
+        """
+        Serve lookups passed by the main thread, one at a time.
+        """
+        sock = self.ctx.socket(zmq.DEALER)
+        sock.connect(endpoint)
+        sock.send(STORAGE_READY)
+
+        while True:
+            conn_id, *frames = sock.recv_multipart()
+            started = time.time()
+            req = None
+            try:
+                req, _ = unpack_msg(frames)
+                res, content = self._handle_lookup(req)
+            except Exception:
+                # a bad lookup, as an url without host, is a miss
+                logging.exception(f'Storage {self.id}: Lookup failed')
+                if not isinstance(req, dict) or 'rid' not in req:
+                    # nothing to answer, only tell the reader is free again
+                    sock.send(STORAGE_READY)
+                    continue
+                res, content = {'rid': req['rid'], 'hit': False, 'meta': None}, None
+            LOOKUP_SECONDS.observe(time.time() - started)
+            LOOKUPS.inc(hit=res['hit'])
+            BYTES_OUT.inc(len(content) if content is not None else 0)
+
+            sock.send_multipart([conn_id, *pack_msg(res, content)])
+            logging.debug(
+                'Sended response to %s: %s [%shit]', conn_id, res['rid'], '' if res['hit'] else 'not ')
+
+    def init_evictor(self):
+        threading.Thread(
+            target=self._evictor,
+            name='Evictor',
+            daemon=True
+        ).start()
+        logging.info(f'Storage {self.id}: Evictor started...')
+
+    def _evictor(self):
+        """
+        Evict entries every `STORAGE_EVICT_INTERVAL` seconds, or as soon
+        as the disk is full.
+        """
+        while True:
+            self.evict_now.wait(STORAGE_EVICT_INTERVAL)
+            self.evict_now.clear()
+            # the cache is only bounded while this thread lives
+            try:
+                evicted = self.cache.evict()
+            except Exception:
+                logging.exception(f'Storage {self.id}: Eviction failed')
+                continue
+
+            for url, reason in evicted:
+                EVICTIONS.inc(reason=reason)
+                self.evicted.append(url)
+            if evicted:
+                logging.info(f'Storage {self.id}: Evicted {len(evicted)} entries')
+
+    def _dispatch_lookups(self):
+        while self.lookups and self.idle_readers:
+            queued_at, lookup = self.lookups.popleft()
+            LOOKUP_WAIT_SECONDS.observe(time.time() - queued_at)
+            self.readers_sock.send_multipart([self.idle_readers.popleft(), *lookup])
+
+    def serve_metrics(self):
+        depth = REGISTRY.gauge('storage_queue_depth', 'Items in each queue of the storage')
+        depth.track(lambda: len(self.lookups), queue='lookups')
+        depth.track(lambda: len(self.upd_queue), queue='updates')
+        REGISTRY.gauge(
+            'storage_dropped_updates', 'Updates not replicated because peers were too slow'
+        ).track(lambda: self.upd_queue.dropped)
+        REGISTRY.gauge('storage_idle_readers', 'Readers waiting for a lookup').track(
+            lambda: len(self.idle_readers))
+        REGISTRY.gauge('storage_bodies', 'Distinct contents stored').track(
+            lambda: len(self.cache.refs))
+        REGISTRY.gauge('storage_entries', 'Entries in cache').track(lambda: len(self.cache))
+        REGISTRY.gauge('storage_bytes', 'Bytes of distinct contents stored').track(
+            lambda: self.cache.bytes)
+
+        REGISTRY.serve(self.address[0], self.metrics_port)
+        logging.info(f'Storage {self.id}: Metrics served at {self.address[0]}:{self.metrics_port}')
+
     def start(self):
         """
         Start storage service
         """
         self.bind_router()
+        if self.metrics_port is not None:
+            self.serve_metrics()
+        self.init_readers()
+        self.init_evictor()
         self.init_discovering_service()
         self.init_ping_sender()
 
@@ -92,12 +241,21 @@ class Storage:
         poller.register(self.disc_sock, zmq.POLLIN)
         poller.register(self.updates_in_sock, zmq.POLLIN | zmq.POLLOUT)
         poller.register(self.updates_out_sock, zmq.POLLIN | zmq.POLLOUT)
-        poller.register(self.router_sock, zmq.POLLIN | zmq.POLLOUT)
+        poller.register(self.router_sock, zmq.POLLIN)
+        poller.register(self.readers_sock, zmq.POLLIN)
 
         logging.info(f'Storage {self.id}: Router service started...')
 
         while True:
-            socks = dict(poller.poll())
+            # stop reading workers while readers can't keep up
+            poller.register(self.router_sock, 0 if self.lookups.full else zmq.POLLIN)
+            # wake up to pass evictions even without traffic
+            socks = dict(poller.poll(1000))
+
+            # peers remove what was evicted here
+            while self.evicted:
+                self.upd_queue.append((self.evicted.popleft(), None, None, None))
+            self._ask_missing_again()
 
             # ========================================
 
@@ -112,6 +270,7 @@ class Storage:
                 try:
                     addr = (msg.get('addr')[0], msg.get('addr')[1] + 1)
                 except TypeError:
+                    addr = None
                     if action in ('add', 'update'):
                         logging.warning(f'Storage {sid}: update without address')
                         continue
@@ -121,6 +280,9 @@ class Storage:
 
                 # storage is not longer accessible, close the connection
                 if action == 'delete':
+                    # this storage itself is never connected
+                    if sid not in self.storages:
+                        continue
                     self.updates_in_sock.disconnect('tcp://%s:%d' % self.storages[sid])
                     self.storages.pop(sid)
                     try:
@@ -148,156 +310,346 @@ class Storage:
             if self.updates_in_sock in socks:
                 # handle update
                 if socks[self.updates_in_sock] in (zmq.POLLIN, zmq.POLLIN | zmq.POLLOUT):
-                    data = self.updates_in_sock.recv_json(zmq.DONTWAIT)
-                    self._handle_request(data)
+                    data, content = unpack_msg(self.updates_in_sock.recv_multipart(zmq.DONTWAIT))
+                    self._handle_request(data, content)
 
                 # if this node is new should request a full update
                 if socks[self.updates_in_sock] in (zmq.POLLOUT, zmq.POLLIN | zmq.POLLOUT):
                     if self.update_cache:
                         logging.info('Requesting full update...')
-                        self.updates_in_sock.send_json(
+                        # contents already stored aren't sent again
+                        self.updates_in_sock.send_multipart(pack_msg(
                             {
                                 'id': self.id,
                                 'new': True,
                                 'updateme': True,
-                            }
-                        )
+                            },
+                            b''.join(bytes.fromhex(digest) for digest in self.cache.digests())
+                        ))
                         # try:
-                        res = self.updates_in_sock.recv_json()
+                        res, content = unpack_msg(self.updates_in_sock.recv_multipart())
                         # except zmq.error.Again:
                             # pass
                         # else:
-                        while res['url'] is not None and res['content'] is not None:
-                            self._handle_request(res)
-                            res = self.updates_in_sock.recv_json()
+                        while res['url'] is not None:
+                            self._handle_request(res, content)
+                            res, content = unpack_msg(self.updates_in_sock.recv_multipart())
                         logging.info('Full update completed')
 
                         self.update_cache = False
                     else:
-                        self.updates_in_sock.send_json(
+                        self.updates_in_sock.send_multipart(pack_msg(
                             {
                                 'id': self.id,
                                 'new': True,
                                 'updateme': False
                             }
-                        )
+                        ))
 
             # ========================================
 
             # ROUTER sock for broadcast updates and send full updates
             if self.updates_out_sock in socks:
                 if socks[self.updates_out_sock] in (zmq.POLLOUT, zmq.POLLIN | zmq.POLLOUT):
-                    try:
-                        url, content = self.upd_queue.pop(0)
-                    except IndexError:
-                        pass
-                    else:
+                    update = self.upd_queue.popleft()
+                    if update is not None:
+                        url, content, meta, digest = update
+                        # without content only meta is refreshed, or the
+                        # entry is pointed to a content peers already have,
+                        # without meta either the entry was evicted
+                        header = {
+                            'url': url,
+                            'meta': meta,
+                            'spread': False,
+                        }
+                        if digest is not None:
+                            header['digest'] = digest
+                        elif content is None and meta is None:
+                            header = {'url': url, 'evict': True, 'spread': False}
+                        update = pack_msg(header, content)
+
                         c = 0
                         for conn_id in self.storage_conns.values():
-                            self.updates_out_sock.send(conn_id, zmq.SNDMORE)
-                            self.updates_out_sock.send_json(
-                                {
-                                    'url': url,
-                                    'content': content,
-                                    'spread': False,
-                                }
-                            )
+                            self.updates_out_sock.send_multipart([conn_id, *update])
                             c += 1
-                        logging.info(f'Updated {c} storages: {url}')
+                        logging.debug('Updated %d storages: %s', c, url)
 
-                # receive a full update request from new storage
+                # receive a full update request from new storage, or a
+                # request for a content missing in a peer
                 if socks[self.updates_out_sock] in (zmq.POLLIN, zmq.POLLIN | zmq.POLLOUT):
-                    conn_id = self.updates_out_sock.recv()
-                    data = self.updates_out_sock.recv_json()
-                    if data['new']:
+                    conn_id, *frames = self.updates_out_sock.recv_multipart()
+                    data, digests = unpack_msg(frames)
+                    if 'missing' in data:
+                        self._send_missing(conn_id, data)
+                    elif data['new']:
                         self.storage_conns[data['id']] = conn_id
                         if data['updateme']:
-                            for url, content in self.cache:
-                                self.updates_out_sock.send(conn_id, zmq.SNDMORE)
-                                self.updates_out_sock.send_json(
-                                    {
-                                        'url': url,
-                                        'content': content,
-                                        'spread': False,
-                                    }
-                                )
+                            self._full_update(conn_id, digests or b'')
                             # send empty update as end flag
-                            self.updates_out_sock.send(conn_id, zmq.SNDMORE)
-                            self.updates_out_sock.send_json(
+                            self.updates_out_sock.send_multipart([conn_id, *pack_msg(
                                 {
                                     'url': None,
-                                    'content': None,
                                     'spread': False,
                                 }
-                            )
-
+                            )])
 
             # ========================================
 
             if self.router_sock in socks:
-                if socks[self.router_sock] in (zmq.POLLIN, zmq.POLLIN | zmq.POLLOUT):
-                    conn_id = self.router_sock.recv(zmq.DONTWAIT)
-                    req = self.router_sock.recv_json(zmq.DONTWAIT)
-                    self.res_queue.append((conn_id, self._handle_request(req)))
-                    logging.info(
-                        f'Storage {self.id}: Processing incoming request...{req["url"]}')
-
-                if socks[self.router_sock] in (zmq.POLLOUT, zmq.POLLIN | zmq.POLLOUT):
-                    try:
-                        conn_id, res = self.res_queue.pop(0)
-                    except IndexError:
-                        pass
-                    else:
-                        if res is not None:
-                            self.router_sock.send(conn_id, zmq.SNDMORE)
-                            self.router_sock.send_json(res)
-                            logging.info(
-                                f'Sended response to {conn_id}: {res["url"]} '
-                                f'[{"" if res["hit"] else "not "}hit]'
-                            )
+                conn_id, *frames = self.router_sock.recv_multipart(zmq.DONTWAIT)
+                req, content = unpack_msg(frames)
+                logging.debug('Storage %s: Processing incoming request...%s', self.id, req['url'])
+
+                # lookups go to readers, updates are written here
+                if content is None and 'meta' not in req:
+                    REQUESTS.inc(type='lookup')
+                    self.lookups.append((time.time(), [conn_id, *frames]))
+                else:
+                    self._handle_request(req, content)
+
+            # pass responses of readers to workers
+            if self.readers_sock in socks:
+                reader_id, *frames = self.readers_sock.recv_multipart(zmq.DONTWAIT)
+                self.idle_readers.append(reader_id)
+                if frames != [STORAGE_READY]:
+                    self.router_sock.send_multipart(frames)
+
+            self._dispatch_lookups()
 
             # ========================================
 
-    def _handle_request(self, req: dict):
+    def _full_update(self, conn_id: bytes, digests: bytes):
+        """
+        Send every entry to a new storage, with its content unless it's
+        among the 16 bytes digests the storage already has.
+        """
+        sent = {digests[i:i + 16].hex() for i in range(0, len(digests), 16)}
+        for url, meta in self.cache:
+            digest = meta['digest']
+            header = {
+                'url': url,
+                'meta': meta,
+                'spread': False,
+                'digest': digest,
+            }
+            content = None
+            if digest not in sent:
+                content = self.cache.body(digest)
+                if content is None:
+                    continue
+                sent.add(digest)
+            self.updates_out_sock.send_multipart([conn_id, *pack_msg(header, content)])
+
+    def _handle_request(self, req: dict, content: bytes = None) -> Optional[Tuple[dict, bytes]]:
         """
+        Messages have a json header frame and, if there is content, a
+        second frame with the raw page bytes.
+
         request format:
             {
-                "id": "client-id",
+                "rid": 42,  // id of the request in worker
                 "url": "www.example.com"
             } -> for fetch
 
             {
                 "url": "www.example.com",
-                "content": "<h1>html code for www.example.com</h1>"
-            } -> for update
+                "meta": {"fetched_at": 1624233600.0, "etag": "\"abc\"", ...}
+            } + content -> for update
 
-        response format (only for fetch's):
             {
-                "id": "client-id",
                 "url": "www.example.com",
+                "meta": {"fetched_at": 1624233600.0, "error": "status 404", "ttl": 600.0, ...}
+            } + empty content -> for update with a failure, kept for its ttl
+
+            {
+                "url": "www.example.com",
+                "meta": {"fetched_at": 1624233600.0, "etag": "\"abc\"", ...},
+                "digest": "9f86d081884c7d659a2feaa0c55ad015"
+            } -> for link to a content already stored, between storages
+
+            {
+                "url": "www.example.com",
+                "meta": {"fetched_at": 1624233600.0, "etag": "\"abc\"", ...}
+            } -> for refresh metadata of a revalidated entry
+
+            {
+                "url": "www.example.com",
+                "evict": true
+            } -> for remove an entry evicted by a peer
+
+            {
+                "url": "www.example.com",
+                "meta": {"fetched_at": 1624233600.0, "etag": "\"abc\"", ...},
+                "missing": "9f86d081884c7d659a2feaa0c55ad015"
+            } -> for ask a peer the content of a link, between storages,
+                 answered with an update if the peer has it
+
+        response format (only for fetch's):
+            {
+                "rid": 42,
                 "hit": true,  // or false
-                "content": "<h1>html code for www.example.com</h1>"
-            }
+                "meta": {"fetched_at": 1624233600.0, ...}  // or null
+            } + content if hit
         """
 
-        if 'content' in req: # update request
-            url, content = req['url'], req['content']
+        if req.get('evict'): # evict request
+            REQUESTS.inc(type='evict')
+            self.missing.pop(req['url'], None)
+            if self.cache.remove(req['url']):
+                EVICTIONS.inc(reason='peer')
+                logging.debug('Evicted by peer: %s', req['url'])
 
-            self.cache.set(url, content)
+            return None # empty response
+        elif content is not None: # update request
+            url, meta = req['url'], req.get('meta')
+
+            # a failure never replaces a page, it's kept until it expires
+            if (meta or {}).get('error') is not None and self._has_page(url):
+                REQUESTS.inc(type='update')
+                logging.debug('Kept cached page of failed %s', url)
+                return None
+
+            # entries are named by hash, keep the url in their meta
+            try:
+                new = self.cache.set(url, content, meta or {})
+            except OSError as e:
+                self._write_failed(url, e)
+                return None
+            self.missing.pop(url, None)
+            REQUESTS.inc(type='update')
+            BYTES_IN.inc(len(content))
+            if not new:
+                DEDUPLICATED.inc()
             if req['spread']:
-                self.upd_queue.append((url, content))
+                # peers got the content when it was first stored
+                if new:
+                    self.upd_queue.append((url, content, meta, None))
+                else:
+                    self.upd_queue.append((url, None, meta, self.cache.digest(content)))
+
+            logging.debug('Updated cache: %s', url)
+
+            return None # empty response
+        elif 'digest' in req: # link request
+            url, meta = req['url'], req.get('meta')
+
+            REQUESTS.inc(type='link')
+            try:
+                linked = self.cache.link(url, req['digest'], meta)
+            except OSError as e:
+                self._write_failed(url, e)
+                return None
+            if linked:
+                self.missing.pop(url, None)
+            else:
+                # the content was lost on its way, ask peers for it
+                logging.debug('Missing content of %s: %s', url, req['digest'])
+                self._ask_missing(url, req['digest'], meta)
 
-            logging.info(f'Updated cache: {url}')
+            return None # empty response
+        elif 'meta' in req: # refresh request
+            url, meta = req['url'], req['meta']
+
+            REQUESTS.inc(type='refresh')
+            try:
+                touched = self.cache.touch(url, meta)
+            except OSError as e:
+                self._write_failed(url, e)
+                return None
+            if touched and req['spread']:
+                self.upd_queue.append((url, None, meta, None))
+
+            logging.debug('Refreshed cache: %s', url)
 
             return None # empty response
         else: # fetch request
-            url = req['url']
+            return self._handle_lookup(req)
+
+    def _ask_missing(self, url: str, digest: str, meta: dict, attempts: int = 0):
+        """
+        Ask a peer for the content of a link, the peer answers with a
+        normal update if it has the content.
+        """
+        if url not in self.missing and len(self.missing) >= STORAGE_UPDATES_QUEUE:
+            logging.debug('Too many missing contents, %s will be a miss', url)
+            return
+        self.missing[url] = [digest, meta, time.time(), attempts + 1]
+        try:
+            # DEALER round robins, every attempt goes to the next peer
+            self.updates_in_sock.send_multipart(pack_msg(
+                {
+                    'id': self.id,
+                    'missing': digest,
+                    'url': url,
+                    'meta': meta,
+                }
+            ), zmq.DONTWAIT)
+        except zmq.error.Again:
+            pass
+
+    def _ask_missing_again(self):
+        """
+        Ask again for the contents not received in time, and give up on
+        them after `STORAGE_MISSING_ATTEMPTS` peers.
+        """
+        now = time.time()
+        for url, (digest, meta, asked_at, attempts) in list(self.missing.items()):
+            if now - asked_at < STORAGE_MISSING_RETRY:
+                continue
+            if attempts >= STORAGE_MISSING_ATTEMPTS:
+                self.missing.pop(url)
+                logging.debug('No peer has the content of %s: %s', url, digest)
+            else:
+                self._ask_missing(url, digest, meta, attempts)
+
+    def _send_missing(self, conn_id: bytes, req: dict):
+        """
+        Send the content a peer is missing, if it's stored here.
+        """
+        REQUESTS.inc(type='missing')
+        content = self.cache.body(req['missing'])
+        if content is None:
+            return
+        self.updates_out_sock.send_multipart([conn_id, *pack_msg(
+            {
+                'url': req['url'],
+                'meta': req['meta'],
+                'spread': False,
+            },
+            content
+        )])
+
+    def _has_page(self, url: str) -> bool:
+        """
+        Check if there is a page, not a failure, cached for url.
+        """
+        meta = self.cache.get_meta(url)
+        return (
+            meta is not None and meta.get('error') is None and
+            self.cache.has_body(meta.get('digest'))
+        )
 
-            content = self.cache.get(url)
+    def _write_failed(self, url: str, error: OSError):
+        """
+        Drop an update that could not be written and, if the disk is
+        full, evict down to what it holds.
+        """
+        WRITE_ERRORS.inc()
+        logging.error(f'Storage {self.id}: Failed to write {url}: {error}')
+        if error.errno in (errno.ENOSPC, errno.EDQUOT):
+            self.cache.shrink(STORAGE_DISK_FULL_SHRINK)
+            logging.warning(
+                f'Storage {self.id}: Disk full, limit lowered to {self.cache.max_bytes} bytes')
+            self.evict_now.set()
+
+    def _handle_lookup(self, req: dict) -> Tuple[dict, Optional[bytes]]:
+        """
+        Answer a fetch request. Safe to call from reader threads.
+        """
+        content, meta = self.cache.get_entry(req['url'])
 
-            return {
-                'id': req['id'],
-                'url': url,
-                'hit': content is not None,
-                'content': content
-            }
+        return {
+            'rid': req['rid'],
+            'hit': content is not None,
+            'meta': meta,
+        }, content
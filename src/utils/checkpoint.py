@@ -0,0 +1,191 @@
+"""
+Checkpoints of the state of a crawl.
+"""
+from typing import Dict, Iterator, List, Set, Tuple
+import gzip
+import logging
+import os
+import threading
+import time
+
+from src import settings
+
+
+class Checkpoint:
+    """
+    Urls of a crawl, with the depth they were found at and if they were
+    crawled, saved as a gzip snapshot plus append logs.
+
+    Each change is a line appended to the current log, `a <depth> <url>`
+    when an url is found and `d <url>` when it's crawled, flushed every
+    `interval` seconds. After `compact_size` lines the log is rotated and
+    a background thread merges it into a new snapshot, renamed over the
+    old one before the log is removed. Lines are idempotent, so a log
+    replayed over the snapshot it was merged into loads the same state.
+    """
+    snapshot_name = 'snapshot.gz'
+
+    def __init__(
+        self,
+        folder: str = 'checkpoint',
+        interval: float = settings.CHECKPOINT_INTERVAL,
+        compact_size: int = settings.CHECKPOINT_COMPACT_SIZE
+    ):
+        self.path = f'./{folder}'
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.interval = interval
+        self.compact_size = compact_size
+        self.lines: List[str] = []      # changes not written yet
+        self.logged = 0                 # lines in current log
+        self.flushed_at = time.time()
+        self.log = None
+        self.number = max(self._logs(), default=-1) + 1
+        self.compactor = None
+
+    def _log_path(self, number: int) -> str:
+        return os.path.join(self.path, f'log-{number:08d}')
+
+    def _logs(self) -> List[int]:
+        return sorted(
+            int(f[4:]) for f in os.listdir(self.path)
+            if f.startswith('log-') and f[4:].isdigit()
+        )
+
+    def reset(self):
+        """
+        Remove the saved state, to start a new crawl.
+        """
+        self.close()
+        for number in self._logs():
+            os.remove(self._log_path(number))
+        try:
+            os.remove(os.path.join(self.path, self.snapshot_name))
+        except FileNotFoundError:
+            pass
+        self.lines.clear()
+        self.logged = 0
+
+    def add(self, url: str, depth: int):
+        self.lines.append(f'a {depth} {url}\n')
+
+    def done(self, url: str):
+        self.lines.append(f'd {url}\n')
+
+    def tick(self):
+        """
+        Flush changes if it's time to, call it often.
+        """
+        if time.time() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.time()
+        if not self.lines:
+            return
+
+        if self.log is None:
+            self.log = open(self._log_path(self.number), 'a', encoding='utf8')
+        self.log.write(''.join(self.lines))
+        self.log.flush()
+        self.logged += len(self.lines)
+        self.lines.clear()
+
+        if self.logged >= self.compact_size and not self._compacting():
+            self._rotate()
+
+    def close(self):
+        """
+        Flush changes and wait for a compaction in course.
+        """
+        self.flush()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self._compacting():
+            self.compactor.join()
+
+    def _compacting(self) -> bool:
+        return self.compactor is not None and self.compactor.is_alive()
+
+    def _rotate(self):
+        self.log.close()
+        self.log = None
+        self.logged = 0
+        self.number += 1
+        self.compactor = threading.Thread(
+            target=self._compact,
+            args=(self.number, ),
+            name='Checkpoint-Compactor',
+            daemon=True
+        )
+        self.compactor.start()
+
+    def _compact(self, until: int):
+        """
+        Merge the snapshot and the logs before `until` in a new snapshot.
+        """
+        started = time.time()
+        logs = [n for n in self._logs() if n < until]
+        depths, done = self._read(logs)
+
+        snapshot = os.path.join(self.path, self.snapshot_name)
+        tmp = f'{snapshot}.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf8', compresslevel=1) as fd:
+            for url, depth in depths.items():
+                fd.write(f'{depth} {int(url in done)} {url}\n')
+        os.replace(tmp, snapshot)
+
+        for number in logs:
+            os.remove(self._log_path(number))
+        logging.debug(
+            'Checkpoint of %d urls compacted in %.2fs', len(depths), time.time() - started)
+
+    def _read(self, logs: List[int]) -> Tuple[Dict[str, int], Set[str]]:
+        depths: Dict[str, int] = {}
+        done: Set[str] = set()
+
+        try:
+            with gzip.open(os.path.join(self.path, self.snapshot_name), 'rt', encoding='utf8') as fd:
+                for line in fd:
+                    depth, crawled, url = line[:-1].split(' ', 2)
+                    depths[url] = int(depth)
+                    if crawled == '1':
+                        done.add(url)
+        except FileNotFoundError:
+            pass
+
+        for number in logs:
+            for action, url, depth in self._entries(number):
+                if action == 'a':
+                    depths.setdefault(url, depth)
+                else:
+                    done.add(url)
+
+        return depths, done
+
+    def _entries(self, number: int) -> Iterator[Tuple[str, str, int]]:
+        with open(self._log_path(number), encoding='utf8') as fd:
+            for line in fd:
+                # the last line may be cut by a crash
+                if not line.endswith('\n'):
+                    break
+                if line.startswith('a '):
+                    _, depth, url = line[:-1].split(' ', 2)
+                    yield 'a', url, int(depth)
+                elif line.startswith('d '):
+                    yield 'd', line[2:-1], 0
+
+    def load(self) -> Tuple[Dict[str, int], Set[str]]:
+        """
+        Return the depth of every url found, in the order they were
+        found, and the urls already crawled.
+        """
+        started = time.time()
+        depths, done = self._read(self._logs())
+        logging.info(
+            f'Loaded checkpoint of {len(depths)} urls, {len(done)} crawled, '
+            f'in {time.time() - started:.2f}s'
+        )
+        return depths, done
@@ -1,111 +1,200 @@
 """
 Types for client nodes.
 """
-from typing import Optional, List, Tuple
+from typing import Optional, Dict, List, Set, Tuple
+from collections import OrderedDict
+import itertools
+import logging
+import random
 import time
 
 import zmq
 
 from src import settings
-from src.utils.common import DiscoveringInterface, Peer
+from src.utils.common import DiscoveringInterface
+from src.utils.url import canonicalize
 
 
 class WorkerDisc(DiscoveringInterface):
+    flag = 'w'
 
     def __init__(self, inter_ip, pipe: zmq.Socket):
         super().__init__(
             inter_ip,
             settings.WORKER_MCAST_ADDR,
-            settings.WORKER_PING_SIZE,
+            settings.BEACON_MAX_SIZE,
             pipe
         )
 
-    def handle_beacon(self, fd, event):
-        data, addr = self.udp.recv()
-        flag, wid, wport = data
-        addr = (addr[0], int(wport))
 
-        # print('new beacon:', data)
+class FrontierDisc(DiscoveringInterface):
+    flag = 'f'
 
-        if flag != 'w':
-            return
+    def __init__(self, inter_ip, pipe: zmq.Socket):
+        super().__init__(
+            inter_ip,
+            settings.FRONTIER_MCAST_ADDR,
+            settings.BEACON_MAX_SIZE,
+            pipe
+        )
 
-        if wid in self.peers:
-            self.peers[wid].is_alive()
-
-            if self.peers[wid].addr != addr:
-                print(self.peers[wid].addr, ':-->', addr)
-                self.peers[wid].update(addr)
-                self.pipe_sock.send_json(
-                    {
-                        'action': 'update',
-                        'peer': wid,
-                        'addr': addr,
-                    }
-                )
-        else:
-            self.peers[wid] = Peer(wid, (addr[0], int(wport)))
-            self.pipe_sock.send_json(
-                {
-                    'action': 'add',
-                    'peer': wid,
-                    'addr': [addr[0], int(wport)],
-                }
-            )
+
+class WorkerConn:
+    """
+    Connection of a client to a worker, with the requests it sent to
+    it and the load in the beacons of the worker.
+    """
+
+    def __init__(self, wid: str, sock: zmq.Socket, addr: Tuple[str, int]):
+        self.wid = wid
+        self.sock = sock
+        self.addr = addr
+        self.sent: Set[int] = set()     # ids of requests waiting response
+        self.queued = 0
+        self.inflight = 0
+        self.capacity = 0               # 0 if unknown
+
+        self.sock.connect('tcp://%s:%d' % addr)
+
+    def connect(self, addr: Tuple[str, int]):
+        self.sock.disconnect('tcp://%s:%d' % self.addr)
+        self.sock.connect('tcp://%s:%d' % addr)
+        self.addr = addr
+
+    def close(self):
+        self.sock.close(linger=0)
+
+    def set_load(self, load: dict):
+        self.queued, self.inflight, self.capacity = load['queued'], load['inflight'], load['capacity']
+
+    def score(self) -> float:
+        """
+        Share of the capacity of the worker in use, counting the
+        requests sent since its last beacon, lower is better.
+        """
+        busy = self.queued + self.inflight + len(self.sent)
+        return busy / self.capacity if self.capacity else float(busy)
+
+
+def choose_worker(conns: List[WorkerConn]) -> WorkerConn:
+    """
+    Choose the worker for next request, the less loaded of two random
+    ones (power of two choices), so clients don't all rush to the same.
+    """
+    if len(conns) == 1:
+        return conns[0]
+
+    a, b = random.sample(conns, 2)
+    return a if a.score() <= b.score() else b
 
 
 class UrlFeeder:
-    def __init__(self, fp: str, n: int, timeout: int = 30):
+    def __init__(self, fp: str, n: int, timeout: int = 30, expired_size: int = 10000):
         self.buffer: List[str] = []
-        self.pendant: List[Tuple[str, int]] = []
+        self.pendant: Dict[int, Tuple[str, float]] = {}     # rid -> (url, sent at)
+        # requests timed out, their replies may still arrive late
+        self.expired: Dict[int, Tuple[str, float]] = OrderedDict()
+        self.expired_size = expired_size
+        self.rids = itertools.count()
         self.timeout = timeout
 
         with open(fp, encoding='utf8') as f:
             c = 0
             for line in f:
-                if not line.startswith('#'):
-                    self.buffer.append(line[:-1])
-                    c += 1
-                    if c == n:
-                        break
-
-    def feed(self) -> Optional[str]:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                try:
+                    self.buffer.append(canonicalize(line))
+                except ValueError:
+                    logging.warning(f'Skipped bad url in {fp}: {line.strip()}')
+                    continue
+                c += 1
+                if c == n:
+                    break
+
+    def feed(self) -> Optional[Tuple[int, str]]:
         """
-        Return an url from buffer and keep track of pendant urls.
+        Return an url from buffer with the id of its request and keep
+        track of pendant urls.
         """
         # move expired url to buffer
         now = time.time()
-        for p in list(self.pendant):
-            if p[1] < now:
-                self.buffer.append(p[0])
-                self.pendant.remove(p)
+        for rid, (url, sent_at) in list(self.pendant.items()):
+            if sent_at + self.timeout < now:
+                self.buffer.append(url)
+                self.expired[rid] = self.pendant.pop(rid)
+                if len(self.expired) > self.expired_size:
+                    self.expired.popitem(last=False)
 
         # return to client an url
         try:
-            self.pendant.append(
-                (url := self.buffer.pop(0), time.time() + self.timeout))
-            return url
+            url = self.buffer.pop(0)
         except IndexError:  # buffer is empty
             return None
 
+        rid = next(self.rids)
+        self.pendant[rid] = (url, time.time())
+        return rid, url
+
     def append(self, url: str):
         """
         Add a new url to pending buffer
         """
         self.buffer.append(url)
 
-    def done(self, url: str):
+    def drain(self) -> List[str]:
+        """
+        Remove and return the urls in buffer.
         """
-        Confirmation that url has been scrapped.
+        urls, self.buffer = self.buffer, []
+        return urls
+
+    def done(self, rid: int) -> Optional[Tuple[str, float]]:
         """
-        for p in list(self.pendant):
-            if p[0] == url:
-                self.pendant.remove(p)
-                break
+        Confirmation that request rid has been scrapped, return its url
+        and the seconds it took, or None if it already timed out.
+        """
+        try:
+            url, sent_at = self.pendant.pop(rid)
+        except KeyError:
+            return None
+        return url, time.time() - sent_at
+
+    def late(self, rid: int) -> Optional[Tuple[str, float]]:
+        """
+        Confirmation of a request that already timed out, return its url
+        and the seconds it took if the url wasn't answered since, or
+        None if it was or rid is unknown.
+        """
+        try:
+            url, sent_at = self.expired.pop(rid)
+        except KeyError:
+            return None
+
+        # the url was fed again, take it back
+        if url in self.buffer:
+            self.buffer.remove(url)
+        else:
+            for again, (pendant_url, _) in self.pendant.items():
+                if pendant_url == url:
+                    del self.pendant[again]
+                    break
+            else:
+                return None
+        return url, time.time() - sent_at
+
+    def retry(self, rid: int):
+        """
+        Put back in buffer the url of a request that won't be answered.
+        """
+        try:
+            url, _ = self.pendant.pop(rid)
+        except KeyError:
+            return
+        self.buffer.append(url)
 
     def __len__(self):
         return len(self.buffer) + len(self.pendant)
 
     def __bool__(self):
         return self.__len__() > 0
-
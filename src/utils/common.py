@@ -2,7 +2,9 @@
 Common types for nodes.
 """
 from __future__ import annotations
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Deque
+from collections import deque
+import math
 import time
 
 import zmq
@@ -13,37 +15,108 @@ from src.utils.udp import UDPReceiver
 
 
 class Peer:
-
-    def __init__(self, uuid, addr: Tuple[str, int]):
+    """
+    A node known by its beacons.
+
+    Failure detection is phi accrual: from the mean and deviation of the
+    last intervals between beacons, `phi` is -log10 of the probability
+    that the next beacon is still to come after the current silence, so
+    it grows the longer a peer is silent compared with its usual
+    rhythm, instead of waiting a fixed expiry time. A pause margin and
+    a min deviation keep a sender stalled by the GIL or the gc alive.
+    """
+    __slots__ = (
+        'uuid', 'addr', 'last_seen', 'intervals', 'total', 'squares', 'load', 'suspicions')
+
+    def __init__(self, uuid, addr: Tuple[str, int], interval: float = settings.BEACON_INTERVAL):
         self.uuid = uuid
         self.addr = addr
-        self.expires_at = None
-        self.is_alive()
+        self.last_seen = time.time()
+        self.intervals: Deque[float] = deque()
+        self.total = 0.0        # sum of intervals
+        self.squares = 0.0      # sum of squared intervals
+        self.load = None        # queued, in flight and capacity of last beacon
+        self.suspicions = 0     # consecutive checks the peer was suspected
+        # until beacons arrive, trust the interval announced
+        self._add_interval(interval)
+
+    def _add_interval(self, interval: float):
+        if len(self.intervals) == settings.PEER_HISTORY:
+            old = self.intervals.popleft()
+            self.total -= old
+            self.squares -= old * old
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
 
     def is_alive(self):
         """
-        Reset the peers expiry time.
+        Record a beacon of the peer.
         Call this method whenever we get any activity from a peer.
         """
-        self.expires_at = time.time() + settings.PEER_EXPIRY
+        now = time.time()
+        self._add_interval(now - self.last_seen)
+        self.last_seen = now
+        self.suspicions = 0
+
+    def phi(self, now: float = None) -> float:
+        """
+        Suspicion level that the peer failed, 8 means a chance of 1e-8
+        of being wrong.
+        """
+        now = time.time() if now is None else now
+        n = len(self.intervals)
+        mean = self.total / n + settings.PEER_ACCEPTABLE_PAUSE
+        variance = max(self.squares / n - (self.total / n) ** 2, 0.0)
+        std = max(math.sqrt(variance), settings.PEER_MIN_STD)
+
+        # probability of a normal interval being longer than the silence
+        later = 0.5 * math.erfc((now - self.last_seen - mean) / (std * math.sqrt(2)))
+        return -math.log10(max(later, 1e-300))
+
+    def is_suspected(self, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        return (
+            now - self.last_seen > settings.PEER_EXPIRY or
+            self.phi(now) > settings.PEER_PHI_THRESHOLD
+        )
+
+    def is_failed(self, now: float = None) -> bool:
+        """
+        Check if the peer was suspected `PEER_SUSPICIONS` times in a row,
+        so beacons queued while this process was stalled are read first.
+        """
+        if not self.is_suspected(now):
+            self.suspicions = 0
+            return False
+        self.suspicions += 1
+        return self.suspicions >= settings.PEER_SUSPICIONS
 
     def update(self, new_addr):
         self.addr = new_addr
 
     def __eq__(self, other: Peer):
+        if not isinstance(other, Peer):
+            return NotImplemented
         return self.uuid == other.uuid
 
     def __hash__(self):
         return hash(self.uuid)
 
     def __str__(self):
-        return f'({self.uuid}::{self.addr}, {self.expires_at})'
+        return f'({self.uuid}::{self.addr}, {self.last_seen})'
 
     def __repr__(self):
         return f'Peer{self.__str__()}'
 
 
 class DiscoveringInterface:
+    """
+    Track the peers beaconing with `flag` in a multicast group and pass
+    to the pipe when they are added, change address or load, or are
+    suspected to have failed and deleted.
+    """
+    flag = None
 
     def __init__(self, inter_ip: str, mcast_addr: str, beacon_size: int, pipe: zmq.Socket):
         self.pipe_sock = pipe
@@ -66,7 +139,7 @@ class DiscoveringInterface:
         self.loop.add_handler(
             self.udp.sock.fileno(), self.handle_beacon, IOLoop.READ)
 
-        reaper = PeriodicCallback(self.reap_peers, 1000)
+        reaper = PeriodicCallback(self.reap_peers, settings.PEER_REAP_INTERVAL * 1000)
         reaper.start()
 
         self.loop.start()
@@ -75,7 +148,7 @@ class DiscoveringInterface:
         now = time.time()
         for p in dict(self.peers):
             peer = self.peers[p]
-            if peer.expires_at < now:
+            if peer.is_failed(now):
                 self.peers.pop(peer.uuid)
                 self.pipe_sock.send_json(
                     {
@@ -85,4 +158,45 @@ class DiscoveringInterface:
                 )
 
     def handle_beacon(self, fd, event):
-        raise NotImplementedError()
+        beacon, addr = self.udp.recv()
+        if beacon is None or beacon.flag != self.flag:
+            return
+
+        pid = beacon.id
+        addr = [addr[0], beacon.port]
+        load = beacon.load
+        peer = self.peers.get(pid)
+
+        if peer is None:
+            peer = self.peers[pid] = Peer(pid, tuple(addr), beacon.interval)
+            peer.load = load
+            self.pipe_sock.send_json(
+                {
+                    'action': 'add',
+                    'peer': pid,
+                    'addr': addr,
+                    'load': load,
+                }
+            )
+            return
+
+        peer.is_alive()
+        if peer.addr != tuple(addr):
+            peer.update(tuple(addr))
+            self.pipe_sock.send_json(
+                {
+                    'action': 'update',
+                    'peer': pid,
+                    'addr': addr,
+                }
+            )
+        if peer.load != load:
+            peer.load = load
+            self.pipe_sock.send_json(
+                {
+                    'action': 'load',
+                    'peer': pid,
+                    'addr': addr,
+                    'load': load,
+                }
+            )
@@ -0,0 +1,208 @@
+"""
+Name resolution cache for worker nodes.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+import heapq
+import ipaddress
+import logging
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from src import settings
+
+
+class Resolver:
+    """
+    Process wide cache of host name resolutions.
+
+    Lookups run in a small thread pool, so prefetching hosts never blocks
+    the caller and concurrent lookups of the same host share one query.
+    Successful resolutions are kept for `ttl` seconds and failures for
+    `negative_ttl` seconds. `getaddrinfo` doesn't expose the TTL of DNS
+    records, so both are fixed by settings.
+
+    Only connections of the sessions returned by `session` go through
+    the cache, the rest of the process resolves as usual.
+    """
+
+    def __init__(
+        self,
+        ttl: float = settings.DNS_TTL,
+        negative_ttl: float = settings.DNS_NEGATIVE_TTL,
+        workers: int = settings.DNS_WORKERS
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='Resolver')
+        self.lock = threading.Lock()
+        self.cache: Dict[str, Tuple[float, object]] = {}    # host -> (expiry, addrs | error)
+        self.expiries: List[Tuple[float, str]] = []         # heap of (expiry, host)
+        self.pending: Dict[str, Future] = {}
+        self.pool_classes = _pool_classes(self)
+
+    def _lookup(self, host: str):
+        try:
+            addrs = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            result, ttl = e, self.negative_ttl
+            logging.info(f'Could not resolve {host}: {e}')
+        else:
+            result, ttl = addrs, self.ttl
+
+        with self.lock:
+            expiry = time.time() + ttl
+            self.cache[host] = (expiry, result)
+            heapq.heappush(self.expiries, (expiry, host))
+            self.pending.pop(host, None)
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _evict_expired(self, now: float):
+        """
+        Remove the expired hosts, a host resolved again is kept until
+        its last expiry.
+        """
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, host = heapq.heappop(self.expiries)
+            if self.cache.get(host, (None, ))[0] == expiry:
+                del self.cache[host]
+
+    def resolve(self, host: str) -> Future:
+        """
+        Return a future with the addresses of host, starting a lookup
+        only if host isn't cached nor already being resolved.
+        """
+        with self.lock:
+            now = time.time()
+            self._evict_expired(now)
+            try:
+                expiry, result = self.cache[host]
+            except KeyError:
+                pass
+            else:
+                future = Future()
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                return future
+
+            if host not in self.pending:
+                self.pending[host] = self.executor.submit(self._lookup, host)
+            return self.pending[host]
+
+    def prefetch(self, host: str):
+        """
+        Start resolving a host, with port or not, if it isn't cached.
+        Called when a request is enqueued, so the lookup overlaps with
+        the cache lookup and the wait for its turn to be fetched.
+        """
+        host = urlparse('//' + host).hostname
+        if host and not self._is_ip(host):
+            self.resolve(host)
+
+    @staticmethod
+    def _is_ip(host: str) -> bool:
+        try:
+            ipaddress.ip_address(host)
+            return True
+        except ValueError:
+            return False
+
+    def addresses(self, host: str, timeout: float = settings.DNS_TIMEOUT) -> List[str]:
+        """
+        Return the ips of a host name, waiting up to `timeout` seconds
+        for its lookup. Raise `socket.gaierror` if it can't be resolved.
+        """
+        try:
+            addrs = self.resolve(host.lower()).result(timeout)
+        except TimeoutError:
+            raise socket.gaierror(socket.EAI_AGAIN, f'Timed out resolving {host}')
+
+        ips = []
+        for *_, sockaddr in addrs:
+            if sockaddr[0] not in ips:
+                ips.append(sockaddr[0])
+        return ips
+
+    def session(self) -> requests.Session:
+        """
+        Return a session whose connections resolve hosts with this cache.
+        Sessions aren't thread safe, use one per thread.
+        """
+        session = requests.Session()
+        adapter = ResolvingAdapter(self)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+class _ResolvedConnection:
+    """
+    Open the socket of an urllib3 connection to the addresses cached by
+    `resolver`, trying each in turn. The host name is still used for the
+    Host header and TLS.
+    """
+    resolver: Resolver = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        if self.resolver._is_ip(host.strip('[]')):
+            return super()._new_conn()
+
+        try:
+            ips = self.resolver.addresses(host)
+        except socket.gaierror as e:
+            raise NewConnectionError(self, f'Failed to establish a new connection: {e}')
+
+        error = NewConnectionError(self, f'No address of {host}')
+        try:
+            for ip in ips:
+                self._dns_host = ip
+                try:
+                    return super()._new_conn()
+                except NewConnectionError as e:
+                    error = e
+        finally:
+            self._dns_host = host
+        raise error
+
+
+def _pool_classes(resolver: Resolver) -> Dict[str, type]:
+    """
+    Return urllib3 pool classes by scheme whose connections resolve
+    hosts with resolver.
+    """
+    classes = {}
+    for scheme, pool, conn in (
+        ('http', HTTPConnectionPool, HTTPConnection),
+        ('https', HTTPSConnectionPool, HTTPSConnection),
+    ):
+        conn_class = type(conn.__name__, (_ResolvedConnection, conn), {'resolver': resolver})
+        classes[scheme] = type(pool.__name__, (pool, ), {'ConnectionCls': conn_class})
+    return classes
+
+
+class ResolvingAdapter(HTTPAdapter):
+    """
+    Transport adapter of `requests` that resolves hosts with a `Resolver`.
+    """
+
+    def __init__(self, resolver: Resolver, **kwargs):
+        self.resolver = resolver
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.resolver.pool_classes
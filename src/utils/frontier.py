@@ -0,0 +1,105 @@
+"""
+Types for frontier nodes.
+"""
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+from collections import deque
+import heapq
+import itertools
+import time
+
+from src import settings
+from src.utils.checkpoint import Checkpoint
+
+
+class UrlFrontier:
+    """
+    Urls of a crawl shared by clients.
+
+    Each url is queued once, with the depth it was first found at, and
+    handed out in leases. A leased url goes back to the front of the
+    queue if its lease expires before it's reported done, so the pages
+    of a dead client are crawled by others. Urls found and crawled are
+    saved to `checkpoint`, if given.
+    """
+
+    def __init__(self, lease_time: float = settings.FRONTIER_LEASE_TIME, checkpoint: Optional[Checkpoint] = None):
+        self.lease_time = lease_time
+        self.checkpoint = checkpoint
+        self.seen: Dict[str, int] = {}      # url -> depth it was found at
+        self.queue: Deque[str] = deque()
+        self.leases: Dict[int, Tuple[str, float]] = {}     # lease id -> (url, expires at)
+        self.expiries: List[Tuple[float, int]] = []        # heap of (expires at, lease id)
+        self.lids = itertools.count()
+        self.expired = 0
+
+    def add(self, url: str, depth: int = 0) -> bool:
+        """
+        Queue an url not seen before. Return False if it was seen.
+        """
+        if url in self.seen:
+            return False
+
+        self.seen[url] = depth
+        self.queue.append(url)
+        if self.checkpoint is not None:
+            self.checkpoint.add(url, depth)
+        return True
+
+    def restore(self):
+        """
+        Load the urls found from checkpoint and queue those not crawled.
+        """
+        self.seen, done = self.checkpoint.load()
+        self.queue.extend(url for url in self.seen if url not in done)
+
+    def lease(self, n: int) -> List[Tuple[int, str, int]]:
+        """
+        Lease up to n queued urls, return their lease ids, urls and depths.
+        """
+        self.expire()
+        expires_at = time.time() + self.lease_time
+        leases = []
+        while self.queue and len(leases) < n:
+            url = self.queue.popleft()
+            lid = next(self.lids)
+            self.leases[lid] = (url, expires_at)
+            heapq.heappush(self.expiries, (expires_at, lid))
+            leases.append((lid, url, self.seen[url]))
+        return leases
+
+    def done(self, lid: int, links: Iterable[str] = ()) -> bool:
+        """
+        Release a crawled url and queue the links found in it. Return
+        False if its lease already expired, then the url was queued again
+        and its links will be reported by the next lease.
+        """
+        try:
+            url, _ = self.leases.pop(lid)
+        except KeyError:
+            return False
+
+        if self.checkpoint is not None:
+            self.checkpoint.done(url)
+        depth = self.seen[url] + 1
+        for link in links:
+            self.add(link, depth)
+        return True
+
+    def expire(self) -> int:
+        """
+        Queue again the urls of expired leases, return how many.
+        """
+        now, urls = time.time(), []
+        while self.expiries and self.expiries[0][0] <= now:
+            _, lid = heapq.heappop(self.expiries)
+            lease = self.leases.pop(lid, None)
+            if lease is not None:
+                urls.append(lease[0])
+
+        # keep the order they were leased
+        self.queue.extendleft(reversed(urls))
+        self.expired += len(urls)
+        return len(urls)
+
+    def __len__(self):
+        return len(self.queue) + len(self.leases)
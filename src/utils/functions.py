@@ -2,7 +2,8 @@
 Utils functions for nodes.
 """
 from __future__ import annotations
-from typing import Tuple
+from typing import List, Optional, Tuple
+import json
 import uuid
 import string
 import random
@@ -24,6 +25,26 @@ def pipe(ctx: zmq.Context) -> Tuple[zmq.Socket, zmq.Socket]:
     return p0, p1
 
 
+def pack_msg(header: dict, body: Optional[bytes] = None) -> List[bytes]:
+    """
+    Return the frames of a message with a json header and an optional
+    raw body, so page contents travel as bytes.
+    """
+    frames = [json.dumps(header).encode('utf8')]
+    if body is not None:
+        frames.append(body)
+    return frames
+
+
+def unpack_msg(frames: List[bytes]) -> Tuple[dict, Optional[bytes]]:
+    """
+    Return the json header and the body (None if absent) of a message.
+    """
+    header = json.loads(frames[0])
+    body = frames[1] if len(frames) > 1 else None
+    return header, body
+
+
 def random_id(length=4):
     """
     Generate a case sensitive random string.
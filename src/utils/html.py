@@ -1,3 +1,5 @@
+from typing import Optional
+import codecs
 import re
 from urllib.parse import urlparse
 
@@ -12,6 +14,91 @@ class HTMLParser:
         return list(matchs)
 
 
+class CharsetDetector:
+    """
+    Detect the charset of an html body while it's downloaded.
+
+    The charset declared in `Content-Type` wins, then a BOM or a `<meta>`
+    declaration in the first `prescan_size` bytes. If none is declared
+    the body is checked as utf8 as it arrives, falling back to cp1252.
+    """
+    prescan_size = 1024
+    meta_regex = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)', re.I)
+    boms = (
+        (codecs.BOM_UTF8, 'utf-8'),
+        (codecs.BOM_UTF16_LE, 'utf-16-le'),
+        (codecs.BOM_UTF16_BE, 'utf-16-be'),
+    )
+    fallback = 'cp1252'
+
+    def __init__(self, content_type: str = ''):
+        self.charset = None
+        self.head = b''         # bytes received before charset is known
+        self.decoder = None     # utf8 decoder checking a guessed charset
+
+        match = re.search(r'charset\s*=\s*["\']?([^\s;"\']+)', content_type or '', re.I)
+        if match:
+            self.charset = self._known(match.group(1))
+
+    @staticmethod
+    def _known(charset: str) -> Optional[str]:
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            return None
+
+    def _prescan(self):
+        for bom, charset in self.boms:
+            if self.head.startswith(bom):
+                self.charset = charset
+                return
+        match = self.meta_regex.search(self.head)
+        if match:
+            self.charset = self._known(match.group(1).decode('ascii'))
+
+    def _check(self, data: bytes, final: bool = False):
+        try:
+            self.decoder.decode(data, final)
+        except UnicodeDecodeError:
+            self.charset, self.decoder = self.fallback, None
+
+    def feed(self, chunk: bytes):
+        """
+        Process the next chunk of the body.
+        """
+        if self.decoder is not None:
+            self._check(chunk)
+            return
+        if self.charset is not None:
+            return
+
+        self.head += chunk
+        if len(self.head) < self.prescan_size:
+            return
+
+        self._prescan()
+        if self.charset is None:
+            self.charset = 'utf-8'
+            self.decoder = codecs.getincrementaldecoder('utf-8')()
+            self._check(self.head)
+        self.head = b''
+
+    def finish(self) -> str:
+        """
+        Return the charset of the body once it was completely fed.
+        """
+        if self.charset is None:
+            self._prescan()
+            if self.charset is None:
+                self.charset = 'utf-8'
+                self.decoder = codecs.getincrementaldecoder('utf-8')()
+                self._check(self.head)
+        if self.decoder is not None:
+            self._check(b'', True)
+
+        return self.charset
+
+
 class URLParser:
     @staticmethod
     def same_domain(url1: str, url2 :str) -> bool:
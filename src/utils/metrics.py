@@ -0,0 +1,195 @@
+"""
+Metrics of nodes, exported in Prometheus text format.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+import bisect
+import threading
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    pairs = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f'{self.name}{_format_labels(k)} {v}' for k, v in values]
+
+
+class Gauge(Metric):
+    """
+    Gauge set by hand or read from a function on each scrape.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+        self.functions: Dict[Labels, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[_labels(labels)] = value
+
+    def track(self, function: Callable[[], float], **labels):
+        with self.lock:
+            self.functions[_labels(labels)] = function
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+            functions = list(self.functions.items())
+        for key, function in functions:
+            values[key] = function()
+        return [f'{self.name}{_format_labels(k)} {v}' for k, v in values.items()]
+
+
+def log_buckets(low: float, high: float, per_double: int = 2) -> List[float]:
+    """
+    Return bucket bounds growing geometrically from low to high, with
+    `per_double` buckets each time the value doubles, so the relative
+    error of any quantile is bounded as in an HDR histogram.
+    """
+    bounds, factor = [low], 2 ** (1 / per_double)
+    while bounds[-1] < high:
+        bounds.append(bounds[-1] * factor)
+    return [float(f'{b:.6g}') for b in bounds]
+
+
+LATENCY_BUCKETS = log_buckets(0.0005, 120)   # seconds
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: List[float] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.bounds = buckets
+        self.values: Dict[Labels, list] = {}     # labels -> [counts, sum]
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.bounds) + 1), 0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = [(k, list(counts), total) for k, (counts, total) in self.values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip([*self.bounds, '+Inf'], counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_format_labels(key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """
+    Metrics of a node process.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, **kwargs) -> Metric:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: List[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+    def serve(self, ip: str, port: int):
+        """
+        Serve the metrics at http://ip:port/metrics from a daemon thread.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((ip, port), Handler)
+        threading.Thread(
+            target=server.serve_forever,
+            name='Metrics',
+            daemon=True
+        ).start()
+        return server
+
+
+REGISTRY = Registry()   # metrics of this process
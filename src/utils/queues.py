@@ -0,0 +1,71 @@
+"""
+Bounded queues for nodes.
+"""
+from typing import Any, Deque, Optional
+from collections import deque
+import logging
+
+
+class BoundedQueue:
+    """
+    FIFO queue holding at most `maxlen` items.
+
+    When full, appending drops the oldest item (policy 'drop_oldest') or
+    the new one (policy 'reject'), counting it in `dropped`. Producers
+    that can wait should check `full` before reading more input, so the
+    pressure moves to the sockets instead of to memory. Crossing the
+    high-water mark is logged once until the queue drains to its half.
+    """
+
+    def __init__(self, name: str, maxlen: int, hwm: int = None, policy: str = 'drop_oldest'):
+        self.name = name
+        self.maxlen = maxlen
+        self.hwm = hwm or maxlen
+        self.policy = policy
+        self.items: Deque[Any] = deque()
+        self.dropped = 0
+        self._warned = False
+
+    @property
+    def full(self) -> bool:
+        return len(self.items) >= self.hwm
+
+    def append(self, item) -> bool:
+        """
+        Enqueue an item. Return False if an item was dropped.
+        """
+        dropped = False
+        if len(self.items) >= self.maxlen:
+            self.dropped += 1
+            dropped = True
+            if self.policy == 'reject':
+                return False
+            self.items.popleft()
+
+        self.items.append(item)
+        if not self._warned and len(self.items) >= self.hwm:
+            self._warned = True
+            logging.warning(
+                f'Queue {self.name} reached its high-water mark ({self.hwm}), '
+                f'{self.dropped} items dropped so far'
+            )
+        return not dropped
+
+    def popleft(self) -> Optional[Any]:
+        """
+        Dequeue the oldest item, None if the queue is empty.
+        """
+        try:
+            item = self.items.popleft()
+        except IndexError:
+            return None
+
+        if self._warned and len(self.items) < self.hwm // 2:
+            self._warned = False
+        return item
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
@@ -0,0 +1,436 @@
+"""
+Result sinks for client nodes.
+"""
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from datetime import datetime, timezone
+from http.client import responses
+import gzip
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+from src import settings
+
+
+Result = Tuple[str, bytes, dict]    # url, content, meta
+
+
+def _result_name(url: str) -> str:
+    filename = re.sub('https?://', '', url)
+    return re.sub(r'\?|/', '_', filename)
+
+
+class FileSink:
+    """
+    Write each result in its own file, one file per url, named after it.
+    """
+
+    def __init__(self, folder: str = 'result'):
+        self.path = f'./{folder}'
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def write(self, batch: List[Result]):
+        for url, content, _ in batch:
+            path = os.path.join(self.path, _result_name(url))
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as fd:
+                fd.write(content)
+            os.replace(tmp_path, path)
+
+    def __contains__(self, url: str) -> bool:
+        return os.path.exists(os.path.join(self.path, _result_name(url)))
+
+    def close(self):
+        pass
+
+
+class SegmentSink:
+    """
+    Pack results in rolling segment files.
+
+    Each record is a header line `<url> <length>` followed by `length`
+    bytes of content and a blank line. A new segment is opened when the
+    current one reaches `max_size` bytes.
+    """
+    extension = '.seg'
+
+    def __init__(self, folder: str = 'result', max_size: int = settings.RESULT_SEGMENT_SIZE):
+        self.path = f'./{folder}'
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.max_size = max_size
+        self.urls = set()       # urls already written
+        self.segment = None     # file object of current segment
+        self.number = len(
+            [f for f in os.listdir(self.path) if f.endswith(self.extension)])
+
+    def _open(self):
+        name = f'segment-{self.number:05d}{self.extension}'
+        self.segment = open(os.path.join(self.path, name), 'ab')
+        self.number += 1
+
+    def _record(self, url: str, content: bytes, meta: dict) -> bytes:
+        return f'{url} {len(content)}\n'.encode('utf8') + content + b'\n\n'
+
+    def _written(self, url: str, meta: dict, offset: int, length: int):
+        """
+        Called after a record is appended to current segment.
+        """
+        self.urls.add(url)
+
+    def write(self, batch: List[Result]):
+        if self.segment is None or self.segment.tell() >= self.max_size:
+            if self.segment is not None:
+                self.segment.close()
+            self._open()
+
+        for url, content, meta in batch:
+            offset = self.segment.tell()
+            self.segment.write(self._record(url, content, meta))
+            self._written(url, meta, offset, self.segment.tell() - offset)
+        self.segment.flush()
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.urls
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+
+def _warc_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _target_uri(url: str) -> str:
+    return url if url.startswith('http') else 'http://' + url
+
+
+class WarcSink(SegmentSink):
+    """
+    Pack results in rolling gzip compressed WARC files.
+
+    Each record is its own gzip member so any record can be decompressed
+    alone. Fetched pages are written as `response` records with their http
+    status and headers, pages without them (e.g. cache hits) as `resource`
+    records. Every record is indexed in `index.cdx` with the file, offset
+    and compressed length needed to read it back.
+    """
+    extension = '.warc.gz'
+
+    # headers that don't describe the decoded body stored in the record
+    skip_headers = ('content-encoding', 'transfer-encoding', 'content-length')
+
+    def __init__(self, folder: str = 'result', max_size: int = settings.RESULT_SEGMENT_SIZE):
+        super().__init__(folder, max_size)
+        self.index = CdxIndex(os.path.join(self.path, CdxIndex.filename))
+        self.urls.update(self.index.urls())
+
+    def _open(self):
+        super()._open()
+        self.segment.write(self._warcinfo())
+
+    def _warcinfo(self) -> bytes:
+        fields = (
+            'software: brood-scrapper\r\n'
+            'format: WARC File Format 1.0\r\n'
+        ).encode('utf8')
+        return self._compress(self._envelope(
+            'warcinfo', None, time.time(), 'application/warc-fields', fields))
+
+    @staticmethod
+    def _compress(data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=settings.RESULT_WARC_COMPRESSION)
+
+    @staticmethod
+    def _envelope(type_: str, url: Optional[str], timestamp: float, content_type: str, block: bytes) -> bytes:
+        head = [
+            'WARC/1.0',
+            f'WARC-Type: {type_}',
+            f'WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>',
+            f'WARC-Date: {_warc_date(timestamp)}',
+        ]
+        if url is not None:
+            head.append(f'WARC-Target-URI: {url}')
+        head += [
+            f'Content-Type: {content_type}',
+            f'Content-Length: {len(block)}',
+        ]
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('utf8') + block + b'\r\n\r\n'
+
+    def _record(self, url: str, content: bytes, meta: dict) -> bytes:
+        body = content
+        timestamp = meta.get('fetched_at') or time.time()
+        status = meta.get('status')
+
+        if status is None:
+            charset = meta.get('charset')
+            content_type = f'text/html; charset={charset}' if charset else 'text/html'
+            return self._compress(self._envelope(
+                'resource', _target_uri(url), timestamp, content_type, body))
+
+        lines = [f'HTTP/1.1 {status} {responses.get(status, "")}'.rstrip()]
+        for name, value in (meta.get('headers') or {}).items():
+            if name.lower() not in self.skip_headers:
+                lines.append(f'{name}: {value}')
+        lines.append(f'Content-Length: {len(body)}')
+        block = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf8') + body
+
+        return self._compress(self._envelope(
+            'response', _target_uri(url), timestamp,
+            'application/http; msgtype=response', block))
+
+    def _written(self, url: str, meta: dict, offset: int, length: int):
+        super()._written(url, meta, offset, length)
+        self.index.add(
+            url,
+            meta.get('fetched_at') or time.time(),
+            meta.get('status'),
+            (meta.get('headers') or {}).get('Content-Type', 'text/html'),
+            os.path.basename(self.segment.name),
+            offset,
+            length
+        )
+
+    def write(self, batch: List[Result]):
+        super().write(batch)
+        self.index.flush()
+
+    def close(self):
+        super().close()
+        self.index.close()
+
+
+class CdxIndex:
+    """
+    CDX style index of WARC records, one line per record:
+    `<url> <timestamp> <status> <mime> <length> <offset> <file>`
+    """
+    filename = 'index.cdx'
+    header = ' CDX a b s m S V g\n'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+        self.lines: List[str] = []
+
+    def add(self, url: str, timestamp: float, status: Optional[int], mime: str, file: str, offset: int, length: int):
+        date = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%d%H%M%S')
+        mime = mime.split(';')[0].strip().replace(' ', '') or '-'
+        self.lines.append(
+            f'{url} {date} {status or "-"} {mime} {length} {offset} {file}\n')
+
+    def flush(self):
+        if self.fd is None:
+            new = not os.path.exists(self.path)
+            self.fd = open(self.path, 'a', encoding='utf8')
+            if new:
+                self.fd.write(self.header)
+        self.fd.write(''.join(self.lines))
+        self.fd.flush()
+        self.lines.clear()
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def entries(self) -> Iterator[List[str]]:
+        try:
+            with open(self.path, encoding='utf8') as fd:
+                for line in fd:
+                    if not line.startswith(' CDX'):
+                        yield line.split()
+        except FileNotFoundError:
+            return
+
+    def urls(self) -> Iterator[str]:
+        for entry in self.entries():
+            yield entry[0]
+
+
+class WarcReader:
+    """
+    Read back the records written by a `WarcSink`.
+
+    Records can be iterated in file order or looked up by url through
+    the CDX index.
+    """
+
+    def __init__(self, folder: str = 'result'):
+        self.path = f'./{folder}'
+        self.index: Dict[str, Tuple[str, int, int]] = {}
+
+        for url, *_, length, offset, file in CdxIndex(os.path.join(self.path, CdxIndex.filename)).entries():
+            self.index[url] = (file, int(offset), int(length))
+
+    @staticmethod
+    def parse(record: bytes) -> Tuple[Dict[str, str], bytes]:
+        """
+        Split an uncompressed record in its WARC headers and block.
+        """
+        head, _, rest = record.partition(b'\r\n\r\n')
+        headers = {}
+        for line in head.decode('utf8').split('\r\n')[1:]:
+            name, _, value = line.partition(': ')
+            headers[name] = value
+        return headers, rest[:int(headers.get('Content-Length', 0))]
+
+    def get(self, url: str) -> Optional[Tuple[Dict[str, str], bytes]]:
+        """
+        Return the last record stored for url, None if there isn't.
+        """
+        try:
+            file, offset, length = self.index[url]
+        except KeyError:
+            return None
+
+        with open(os.path.join(self.path, file), 'rb') as fd:
+            fd.seek(offset)
+            return self.parse(gzip.decompress(fd.read(length)))
+
+    def __iter__(self) -> Iterator[Tuple[Dict[str, str], bytes]]:
+        """
+        Iterate over all records in file order, decompressing as a stream.
+        """
+        files = sorted(f for f in os.listdir(self.path) if f.endswith(WarcSink.extension))
+        for file in files:
+            with gzip.open(os.path.join(self.path, file), 'rb') as fd:
+                while line := fd.readline():
+                    if not line.strip():
+                        continue
+                    head = line
+                    while (line := fd.readline()) not in (b'\r\n', b''):
+                        head += line
+                    headers, _ = self.parse(head + b'\r\n')
+                    yield headers, fd.read(int(headers['Content-Length']))
+
+
+class ResultWriter:
+    """
+    Write results in a background thread so receiving never waits on disk.
+
+    Results are queued in a bounded queue and the writer thread drains it
+    in batches of at most `batch_size` items, flushing after
+    `flush_interval` seconds at the latest. `on_written` is called from
+    the writer thread with the urls of each batch once it's written.
+    """
+
+    def __init__(
+        self,
+        sink,
+        max_queue: int = settings.RESULT_QUEUE_SIZE,
+        batch_size: int = settings.RESULT_BATCH_SIZE,
+        flush_interval: float = settings.RESULT_FLUSH_INTERVAL,
+        on_written: Callable[[List[str]], None] = None
+    ):
+        self.sink = sink
+        self.on_written = on_written
+        self.queue = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queued = set()     # urls waiting to be written
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run,
+            name='Result-Writer',
+            daemon=True
+        )
+        self.thread.start()
+
+    def put(self, url: str, content: bytes, meta: dict = None):
+        """
+        Enqueue a result to be written, `meta` may carry the http
+        `status`, `headers` and `fetched_at` of the response.
+        Only blocks if the writer is `max_queue` results behind.
+        """
+        item = (url, content, meta or {})
+        with self.lock:
+            self.queued.add(url)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            logging.warning('Result queue is full, waiting for writer...')
+            self.queue.put(item)
+
+    def close(self):
+        """
+        Write pending results and stop the writer thread.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.sink.close()
+
+    def __contains__(self, url: str) -> bool:
+        with self.lock:
+            if url in self.queued:
+                return True
+        return url in self.sink
+
+    def _next_batch(self) -> Tuple[List[Result], bool]:
+        """
+        Collect a batch from queue, return it and if writer should stop.
+        """
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch:
+                continue
+
+            urls = [url for url, *_ in batch]
+            try:
+                self.sink.write(batch)
+            except OSError as e:
+                logging.error(f'Error writing {len(batch)} results: {e}')
+            else:
+                if self.on_written is not None:
+                    self.on_written(urls)
+
+            with self.lock:
+                self.queued.difference_update(urls)
+
+
+def make_writer(
+    output: str,
+    folder: str = 'result',
+    on_written: Callable[[List[str]], None] = None
+) -> ResultWriter:
+    """
+    Return a result writer for the given output mode.
+    """
+    sinks = {
+        'files': FileSink,
+        'segments': SegmentSink,
+        'warc': WarcSink,
+    }
+    try:
+        return ResultWriter(sinks[output](folder), on_written=on_written)
+    except KeyError:
+        raise ValueError(f'Unknown output mode: {output}')
@@ -1,8 +1,17 @@
 """
 Tyes for storage nodes.
 """
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import hashlib
+import heapq
+import json
+import logging
 import os
-import re
+import random
+import threading
+import time
+
+from src.utils.url import url_key
 
 
 class Cache:
@@ -10,38 +19,374 @@ class Cache:
     Data structure to handle cache operations
 
     Operations:
-        get(filename: str) -> str | None
-        set(filename: str, content: str) -> None
+        get(filename: str) -> bytes | None
+        get_meta(filename: str) -> dict | None
+        get_entry(filename: str) -> (bytes, dict) | (None, None)
+        set(filename: str, content: bytes, meta: dict = None) -> bool
+        link(filename: str, digest: str, meta: dict = None) -> bool
+        touch(filename: str, meta: dict) -> bool
+        remove(filename: str) -> bool
+        evict() -> [(url, reason)]
+
+    Each entry is a `.meta` json file with the metadata of the page
+    (fetch time, `ETag`, `Last-Modified`, ...), its url and the digest
+    of its content. Contents are stored once in `bodies/<digest>`, no
+    matter how many urls have them, and removed when no entry points to
+    them. Entries are named by `key`, by default the hash of the
+    canonical url, so every form of an url hits the same entry.
+
+    Entries older than `ttl` seconds, or than the `ttl` in their meta,
+    are misses, and `evict()` removes them and, while contents take
+    more than `max_bytes` or there are more than `max_entries` entries,
+    the least recently used of a few sampled entries, down to
+    `low_watermark` of the limits. The names, times and sizes it needs
+    are kept in memory, so a lookup only adds its access time and
+    misses don't touch the disk.
+
+    Files are written to a temporary name and then renamed, so readers
+    in other threads never see a partially written entry. Writes are
+    serialized by a lock, reads don't wait for it.
     """
-    def __init__(self, cache_folder='cache'):
+    meta_extension = '.meta'
+    bodies_folder = 'bodies'
+
+    def __init__(
+        self,
+        cache_folder='cache',
+        key: Callable[[str], str] = url_key,
+        max_bytes: int = None,
+        max_entries: int = None,
+        ttl: float = None,
+        low_watermark: float = 0.9,
+        samples: int = 16
+    ):
         self.path = f'./{cache_folder}'
-        if not os.path.exists(self.path):
-            os.makedirs(self.path)
+        self.bodies_path = os.path.join(self.path, self.bodies_folder)
+        if not os.path.exists(self.bodies_path):
+            os.makedirs(self.bodies_path)
+        self._filename = key
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.low_watermark = low_watermark
+        self.samples = samples
+        self.lock = threading.Lock()
+
+        self.refs: Dict[str, int] = {}      # digest -> entries with it
+        self.sizes: Dict[str, int] = {}     # digest -> bytes of content
+        self.bytes = 0                      # bytes of all contents
+        self.names: List[str] = []          # entry names, to sample them
+        self.slots: Dict[str, int] = {}     # entry name -> index in names
+        self.stored_at: Dict[str, float] = {}
+        self.accessed: Dict[str, float] = {}
+        self.ttls: Dict[str, float] = {}    # entry name -> its own ttl
+        self.expiries: List[Tuple[float, str]] = []     # heap of entries with own ttl
+        self._load()
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    def _load(self):
+        """
+        Index the entries, count the entries of each body and remove
+        bodies without any and temporary files, left by interrupted
+        writes.
+        """
+        for file in os.listdir(self.path):
+            if file.endswith('.tmp'):
+                os.remove(os.path.join(self.path, file))
+
+        now = time.time()
+        for name, meta in self._entries():
+            digest = meta.get('digest')
+            if digest is not None:
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+                self._track(name, meta.get('stored_at', now), meta.get('ttl'))
+
+        for file in os.listdir(self.bodies_path):
+            path = os.path.join(self.bodies_path, file)
+            if file not in self.refs:
+                os.remove(path)
+            else:
+                self.sizes[file] = os.path.getsize(path)
+                self.bytes += self.sizes[file]
+
+    def _track(self, name: str, stored_at: float, ttl: float = None):
+        if name not in self.slots:
+            self.slots[name] = len(self.names)
+            self.names.append(name)
+            self.accessed.pop(name, None)
+        self.stored_at[name] = stored_at
+        if ttl is not None:
+            self.ttls[name] = ttl
+            heapq.heappush(self.expiries, (stored_at + ttl, name))
+        else:
+            self.ttls.pop(name, None)
+
+    def _untrack(self, name: str):
+        i = self.slots.pop(name)
+        last = self.names.pop()
+        if i < len(self.names):
+            self.names[i] = last
+            self.slots[last] = i
+        self.stored_at.pop(name, None)
+        self.accessed.pop(name, None)
+        self.ttls.pop(name, None)
+
+    def _expired(self, name: str, now: float) -> bool:
+        stored_at = self.stored_at.get(name)
+        ttl = self.ttls.get(name, self.ttl)
+        return stored_at is None or (ttl is not None and now - stored_at > ttl)
 
-    def get(self, filename: str) -> str:
-        filename = re.sub('https?://', '', filename)
-        filename = re.sub(r'\?|/', '_', filename)
+    def get(self, filename: str) -> Optional[bytes]:
+        return self.get_entry(filename)[0]
+
+    def get_meta(self, filename: str) -> Optional[dict]:
+        return self._get_meta(self._filename(filename))
+
+    def get_entry(self, filename: str) -> Tuple[Optional[bytes], Optional[dict]]:
+        """
+        Return the content and metadata of an entry, None's if missing
+        or expired.
+        """
+        name, now = self._filename(filename), time.time()
+        if self._expired(name, now):
+            return None, None
+
+        meta = self._get_meta(name)
+        content = self.body(meta.get('digest')) if meta is not None else None
+        if content is None:
+            return None, None
+        # evicted meanwhile entries aren't tracked again
+        if name in self.slots:
+            self.accessed[name] = now
+        return content, meta
+
+    def body(self, digest: Optional[str]) -> Optional[bytes]:
+        if digest is None:
+            return None
         try:
-            with open(os.path.join(self.path, filename), 'r') as fd:
+            with open(os.path.join(self.bodies_path, digest), 'rb') as fd:
                 return fd.read()
         except FileNotFoundError:
             return None
 
-    def set(self, filename: str, content: str):
-        filename = re.sub('https?://', '', filename)
-        filename = re.sub(r'\?|/', '_', filename)
-        with open(os.path.join(self.path, filename), 'w') as fd:
-            fd.write(content)
+    def has_body(self, digest: str) -> bool:
+        return digest in self.refs
+
+    def digests(self) -> Iterator[str]:
+        return iter(list(self.refs))
+
+    def _get_meta(self, filename: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.path, filename + self.meta_extension), 'r') as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, filename: str, content: bytes, meta: dict = None) -> bool:
+        """
+        Store the content of an url. Return False if the same content
+        was already stored, then only the entry is written.
+        """
+        digest = self.digest(content)
+        with self.lock:
+            new = not self.has_body(digest)
+            body = os.path.join(self.bodies_folder, digest)
+            if new:
+                self._write(body, 'wb', lambda fd: fd.write(content))
+            try:
+                self._set_entry(filename, digest, meta)
+            except OSError:
+                if new:
+                    os.remove(os.path.join(self.path, body))
+                raise
+            if new:
+                self.sizes[digest] = len(content)
+                self.bytes += len(content)
+        return new
+
+    def link(self, filename: str, digest: str, meta: dict = None) -> bool:
+        """
+        Point the entry of an url to a stored content.
+        Return False if there is no such content.
+        """
+        with self.lock:
+            if not self.has_body(digest):
+                return False
+            self._set_entry(filename, digest, meta)
+            return True
+
+    def touch(self, filename: str, meta: dict) -> bool:
+        """
+        Replace the metadata of an entry keeping its content.
+        Return False if there is no such entry.
+        """
+        url, name = filename, self._filename(filename)
+        with self.lock:
+            old = self._get_meta(name)
+            if old is None or old.get('digest') not in self.refs:
+                return False
+            stored_at = time.time()
+            self._set_meta(
+                name, {**meta, 'url': url, 'digest': old['digest'], 'stored_at': stored_at})
+            self._track(name, stored_at, meta.get('ttl'))
+            return True
+
+    def remove(self, filename: str) -> bool:
+        """
+        Remove the entry of an url. Return False if there is no such entry.
+        """
+        with self.lock:
+            return self._remove(self._filename(filename)) is not None
 
-    def __iter__(self):
+    def _set_entry(self, filename: str, digest: str, meta: dict = None):
+        url, name = filename, self._filename(filename)
+        old = self._get_meta(name)
+        stored_at = time.time()
+        self._set_meta(
+            name, {**(meta or {}), 'url': url, 'digest': digest, 'stored_at': stored_at})
+        self._track(name, stored_at, (meta or {}).get('ttl'))
+
+        # count the new reference before dropping the old one
+        self.refs[digest] = self.refs.get(digest, 0) + 1
+        if old is not None and old.get('digest') in self.refs:
+            self._unref(old['digest'])
+
+    def _remove(self, name: str) -> Optional[str]:
+        """
+        Remove an entry by name and return its url, None if missing.
+        """
+        if name not in self.slots:
+            return None
+
+        meta = self._get_meta(name)
+        self._untrack(name)
+        try:
+            os.remove(os.path.join(self.path, name + self.meta_extension))
+        except FileNotFoundError:
+            pass
+        if meta is None:
+            return None
+        if meta.get('digest') in self.refs:
+            self._unref(meta['digest'])
+        return meta.get('url')
+
+    def _unref(self, digest: str):
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0:
+            return
+
+        del self.refs[digest]
+        self.bytes -= self.sizes.pop(digest, 0)
+        try:
+            os.remove(os.path.join(self.bodies_path, digest))
+        except FileNotFoundError:
+            logging.warning(f'Body {digest} was already removed')
+
+    def _over(self, watermark: float = 1.0) -> bool:
+        return (
+            (self.max_bytes is not None and self.bytes > self.max_bytes * watermark) or
+            (self.max_entries is not None and len(self.names) > self.max_entries * watermark)
+        )
+
+    def evict(self) -> List[Tuple[str, str]]:
+        """
+        Remove expired entries and, if over the limits, the least
+        recently used ones. Return the urls removed and why.
+        """
+        evicted = []
+        now = time.time()
+
+        # entries with their own ttl are removed in order of expiry
+        while True:
+            with self.lock:
+                if not self.expiries or self.expiries[0][0] > now:
+                    break
+                _, name = heapq.heappop(self.expiries)
+                if name in self.ttls and self._expired(name, now):
+                    self._evict(name, 'ttl', evicted)
+
+        # as expiring keys in redis: sample until few are expired,
+        # a batch at a time so writes don't wait long for the lock
+        while self.ttl is not None:
+            with self.lock:
+                if not self.names:
+                    break
+                sample = {random.choice(self.names) for _ in range(self.samples)}
+                expired = [name for name in sample if self._expired(name, now)]
+                for name in expired:
+                    self._evict(name, 'ttl', evicted)
+            if len(expired) * 4 < len(sample):
+                break
+
+        with self.lock:
+            if not self._over():
+                return evicted
+
+        while True:
+            with self.lock:
+                if not self.names or not self._over(self.low_watermark):
+                    break
+                sample = {random.choice(self.names) for _ in range(self.samples)}
+                name = min(sample, key=self._last_used)
+                self._evict(name, 'capacity', evicted)
+        return evicted
+
+    def _last_used(self, name: str) -> float:
+        return self.accessed.get(name, self.stored_at.get(name, 0))
+
+    def _evict(self, name: str, reason: str, evicted: List[Tuple[str, str]]):
+        url = self._remove(name)
+        if url is not None:
+            evicted.append((url, reason))
+
+    def shrink(self, factor: float):
+        """
+        Lower the limit of bytes to a factor of the bytes stored, when
+        the disk can't hold more.
+        """
+        self.max_bytes = int(self.bytes * factor)
+
+    def _set_meta(self, filename: str, meta: dict):
+        self._write(filename + self.meta_extension, 'w', lambda fd: json.dump(meta, fd))
+
+    def _write(self, filename: str, mode: str, write):
+        path = os.path.join(self.path, filename)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, mode) as fd:
+                write(fd)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _entries(self) -> Iterator[Tuple[str, dict]]:
         for file in os.listdir(self.path):
-            with open(f'{self.path}/{file}') as fd:
-                content = fd.read()
-                yield (file, content)
+            if not file.endswith(self.meta_extension):
+                continue
+            name = file[:-len(self.meta_extension)]
+            meta = self._get_meta(name)
+            if meta is not None and 'url' in meta:
+                yield name, meta
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        """
+        Iterate over the url and metadata of every entry, read the
+        content with `body(meta['digest'])`.
+        """
+        for _, meta in self._entries():
+            yield meta['url'], meta
+
+    def __len__(self):
+        return len(self.names)
 
 
 if __name__ == '__main__':
     cache = Cache()
 
-    for file, content in cache:
-        print(file, content)
+    for url, meta in cache:
+        print(url, meta)
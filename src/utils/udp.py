@@ -1,11 +1,78 @@
 """
 UDP multicast groups comunication interfaces.
 """
-from typing import List, Tuple
+from __future__ import annotations
+from typing import Callable, Optional, Tuple
 import struct
 import socket
 import time
 
+from src import settings
+
+
+class Beacon:
+    """
+    Beacon of a node: its kind (flag), id, port and load.
+
+    Packed in binary as a fixed header followed by the id in utf8, so
+    ids aren't truncated:
+        magic, version, flag, port, sequence number, interval in ms,
+        queued requests, requests in flight, capacity (0 if unbounded),
+        length of id
+    """
+    __slots__ = ('flag', 'id', 'port', 'seq', 'interval', 'queued', 'inflight', 'capacity')
+
+    header = struct.Struct('!2sBcHIHIIIB')
+    magic = b'BR'
+    version = 1
+
+    def __init__(
+        self,
+        flag: str,
+        id: str,
+        port: int,
+        seq: int = 0,
+        interval: float = settings.BEACON_INTERVAL,
+        queued: int = 0,
+        inflight: int = 0,
+        capacity: int = 0
+    ):
+        self.flag = flag
+        self.id = id
+        self.port = port
+        self.seq = seq
+        self.interval = interval
+        self.queued = queued
+        self.inflight = inflight
+        self.capacity = capacity
+
+    def pack(self) -> bytes:
+        uid = self.id.encode('utf8')
+        return self.header.pack(
+            self.magic, self.version, self.flag.encode('ascii'), self.port,
+            self.seq & 0xffffffff, int(self.interval * 1000), self.queued, self.inflight,
+            self.capacity, len(uid)
+        ) + uid
+
+    @classmethod
+    def unpack(cls, data: bytes) -> Optional[Beacon]:
+        """
+        Return the beacon packed in data, None if it isn't a beacon.
+        """
+        try:
+            magic, version, flag, port, seq, interval, queued, inflight, capacity, length = \
+                cls.header.unpack_from(data)
+            uid = data[cls.header.size:cls.header.size + length].decode('utf8')
+        except (struct.error, UnicodeDecodeError):
+            return None
+        if magic != cls.magic or version != cls.version or len(uid) == 0:
+            return None
+        return cls(flag.decode('ascii'), uid, port, seq, interval / 1000, queued, inflight, capacity)
+
+    @property
+    def load(self) -> dict:
+        return {'queued': self.queued, 'inflight': self.inflight, 'capacity': self.capacity}
+
 
 class UDPReceiver:
     """
@@ -29,34 +96,35 @@ class UDPReceiver:
         )
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
-    def recv(self) -> Tuple[List[str], Tuple[str, int]]:
+    def recv(self) -> Tuple[Optional[Beacon], Tuple[str, int]]:
         data, addr = self.sock.recvfrom(self.beacon_size)
-        data = data.decode('utf8').split(' ')
-
-        return data, addr
+        return Beacon.unpack(data), addr
 
 
 class UDPSender:
     """
     Class for send beacons in a multicast group.
+    `load` returns the (queued, in flight, capacity) sent in each beacon.
     """
 
-    def __init__(self, flag, id, port, inter_ip, mcast_addr):
+    def __init__(self, flag, id, port, inter_ip, mcast_addr, load: Callable[[], Tuple[int, int, int]] = None):
         self.flag = flag
         self.id = id
         self.port = port
         self.inter_ip = inter_ip
         self.mcast_addr = mcast_addr
+        self.load = load
 
-    def start(self, interval=1):
+    def start(self, interval=settings.BEACON_INTERVAL):
         sock = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         sock.setsockopt(
             socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
 
+        beacon = Beacon(self.flag, self.id, self.port, interval=interval)
         while True:
-            sock.sendto(
-                f'{self.flag} {self.id} {self.port}'.encode('utf8'),
-                self.mcast_addr
-            )
+            if self.load is not None:
+                beacon.queued, beacon.inflight, beacon.capacity = self.load()
+            sock.sendto(beacon.pack(), self.mcast_addr)
+            beacon.seq += 1
             time.sleep(interval)
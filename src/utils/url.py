@@ -0,0 +1,100 @@
+"""
+Canonical form of urls, shared by all nodes.
+"""
+from urllib.parse import urlsplit, urlunsplit
+import hashlib
+import re
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+PERCENT_RE = re.compile('%([0-9a-fA-F]{2})')
+
+
+def _percent(match) -> str:
+    """
+    Decode an escaped unreserved char, uppercase any other escape.
+    """
+    char = chr(int(match.group(1), 16))
+    return char if char in UNRESERVED else '%' + match.group(1).upper()
+
+
+def _path(path: str) -> str:
+    """
+    Remove the dot segments of a path, as in RFC 3986.
+    """
+    if not path:
+        return '/'
+
+    segments = []
+    for segment in path.split('/')[1:]:
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment != '.':
+            segments.append(segment)
+
+    # a path ending in a dot segment names a folder
+    if path.endswith(('/.', '/..')):
+        segments.append('')
+    return '/' + '/'.join(segments)
+
+
+def canonicalize(url: str) -> str:
+    """
+    Return the canonical form of an url: http scheme if it has none,
+    scheme and host lowercased, default port, fragment and dot segments
+    removed, `/` as empty path, escapes normalized and query params
+    sorted by key, repeated keys in their order. Raise ValueError if it
+    has no host.
+
+    Escaped unreserved chars are decoded before removing dot segments,
+    as in RFC 3986 6.2.2, so the canonical form is canonical again:
+
+    >>> canonicalize('HTTP://Example.com:80/%7euser/%2e%2e/x?b=1&a=%7e#top')
+    'http://example.com/x?a=~&b=1'
+    >>> canonicalize('example.com/?b=2&a=1&a=0')
+    'http://example.com/?a=1&a=0&b=2'
+    >>> u = 'example.com/a/./b/%2E%2e/%2e/c%2f'
+    >>> canonicalize(canonicalize(u)) == canonicalize(u)
+    True
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urlsplit(url)
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if not host:
+        raise ValueError(f'Url without host: {url}')
+    if ':' in host:     # ipv6
+        host = f'[{host}]'
+    port = parts.port
+    netloc = host if port is None or port == DEFAULT_PORTS.get(scheme) else f'{host}:{port}'
+    if parts.username is not None:
+        userinfo = parts.username + (f':{parts.password}' if parts.password is not None else '')
+        netloc = f'{userinfo}@{netloc}'
+
+    path = _path(PERCENT_RE.sub(_percent, parts.path))
+    # the order of values of a key may be meaningful, sorting is stable
+    query = '&'.join(sorted(
+        (PERCENT_RE.sub(_percent, param) for param in parts.query.split('&') if param),
+        key=lambda param: param.split('=', 1)[0]
+    ))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def url_key(url: str) -> str:
+    """
+    Return a fixed width key of an url, the hex blake2b digest of its
+    canonical form.
+    """
+    return hashlib.blake2b(canonicalize(url).encode('utf8'), digest_size=16).hexdigest()
+
+
+def url_host(url: str) -> str:
+    """
+    Return the host of an url, with its port if it isn't the default.
+    """
+    return urlsplit(canonicalize(url)).netloc.rpartition('@')[2]
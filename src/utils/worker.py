@@ -2,9 +2,18 @@
 Types for worker node.
 """
 from __future__ import annotations
-from typing import Optional, Dict, Tuple
-from collections import OrderedDict
+from typing import Callable, Optional, Dict, List, Set, Tuple, Deque
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+import heapq
+import itertools
 import logging
+import math
+import random
+import sys
 import threading
 import time
 
@@ -13,7 +22,11 @@ import requests
 from requests import Response
 
 from src import settings
-from src.utils.common import DiscoveringInterface, Peer
+from src.utils.common import DiscoveringInterface
+from src.utils.html import CharsetDetector
+from src.utils.functions import pack_msg
+from src.utils.metrics import REGISTRY
+from src.utils.url import url_host
 
 
 logging.basicConfig(
@@ -22,66 +35,264 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+QUEUE_SECONDS = REGISTRY.histogram(
+    'worker_queue_seconds', 'Time requests spent in each queue of the worker')
+FETCHES = REGISTRY.counter('worker_fetches_total', 'Page fetches by result')
+FETCH_SECONDS = REGISTRY.histogram('worker_fetch_seconds', 'Page fetch latency by host')
+BYTES_IN = REGISTRY.counter('worker_bytes_in_total', 'Bytes of pages downloaded')
+LOOKUP_SECONDS = REGISTRY.histogram(
+    'worker_lookup_seconds', 'Latency of cache lookups by storage')
+COALESCED = REGISTRY.counter(
+    'worker_coalesced_total', 'Requests attached to a request of the same url in course')
+
 
 class StorageDisc(DiscoveringInterface):
+    flag = 's'
 
     def __init__(self, inter_ip: str, pipe: zmq.Socket):
         super().__init__(
             inter_ip,
             settings.STORAGE_MCAST_ADDR,
-            settings.STORAGE_PING_SIZE,
+            settings.BEACON_MAX_SIZE,
             pipe
         )
 
-    def handle_beacon(self, fd, event):
-        data, addr = self.udp.recv()
-        flag, sid, sport = data
-        addr = (addr[0], int(sport))
 
-        if flag != 's':
-            return
+class LatencyTracker:
+    """
+    Latency percentiles over the most recent samples.
+    """
+
+    def __init__(self, size: int = settings.WORKER_LATENCY_SAMPLES):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.sorted: List[float] = []
+        self.dirty = False
+
+    def add(self, latency: float):
+        self.samples.append(latency)
+        self.dirty = True
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        Return the `p` percentile (0-100), None without enough samples.
+        """
+        if len(self.samples) < settings.WORKER_LATENCY_MIN_SAMPLES:
+            return None
+        if self.dirty:
+            self.sorted = sorted(self.samples)
+            self.dirty = False
+        return self.sorted[min(len(self.sorted) - 1, int(len(self.sorted) * p / 100))]
+
+
+class StorageConn:
+    """
+    Connection of a worker to a storage node and its lookups latency.
+
+    Besides percentiles it keeps a peak-sensitive EWMA of latency that
+    decays with time, which with the number of outstanding lookups and
+    the load in the beacons of the storage gives the score used to
+    choose among storages.
+    """
+
+    def __init__(self, sid: str, sock: zmq.Socket, addr: Tuple[str, int]):
+        self.sid = sid
+        self.sock = sock
+        self.addr = addr
+        self.latency = LatencyTracker()
+        self.sent: Dict[int, float] = {}    # lookups waiting reply
+        self.ewma = settings.WORKER_EWMA_INITIAL
+        self.ewma_at = time.time()
+        self.load = 0.0     # lookups queued and read by storage, per its capacity
 
-        if sid in self.peers:
-            self.peers[sid].is_alive()
-
-            if self.peers[sid].addr != addr:
-                self.peers[sid].update(addr)
-                self.pipe_sock.send_json(
-                    {
-                        'action': 'update',
-                        'peer': sid,
-                        'addr': addr,
-                    }
-                )
+    def connect(self, addr: Tuple[str, int]):
+        if self.addr is not None:
+            self.sock.disconnect('tcp://%s:%d' % self.addr)
+        self.sock.connect('tcp://%s:%d' % addr)
+        self.addr = addr
+
+    def close(self):
+        self.sock.close(linger=0)
+
+    def set_load(self, load: dict):
+        """
+        Take the load announced in a beacon of the storage.
+        """
+        busy = load['queued'] + load['inflight']
+        self.load = busy / load['capacity'] if load['capacity'] else 0.0
+
+    def deadline(self) -> float:
+        """
+        Time to wait for a lookup reply before scrapping, derived from
+        recent latencies.
+        """
+        p99 = self.latency.percentile(99)
+        if p99 is None:
+            return settings.WORKER_REQ_EXPIRY
+        return min(
+            max(p99 * settings.WORKER_DEADLINE_FACTOR, settings.WORKER_MIN_REQ_EXPIRY),
+            settings.WORKER_REQ_EXPIRY
+        )
+
+    def hedge_delay(self) -> float:
+        """
+        Time to wait for a lookup reply before asking another storage.
+        """
+        p95 = self.latency.percentile(95)
+        if p95 is None:
+            return settings.WORKER_REQ_EXPIRY / 2
+        return min(p95, self.deadline())
+
+    def lookup(self, rid: int, url: str):
+        self.sock.send_multipart(pack_msg(
+            {
+                "rid": rid,
+                "url": url,
+            }
+        ))
+        self.sent[rid] = time.time()
+
+    def _observe(self, latency: float):
+        self.latency.add(latency)
+        LOOKUP_SECONDS.observe(latency, storage=self.sid)
+
+        now = time.time()
+        if latency > self.ewma:
+            self.ewma = latency
         else:
-            self.peers[sid] = Peer(sid, (addr[0], int(sport)))
-            self.pipe_sock.send_json(
-                {
-                    'action': 'add',
-                    'peer': sid,
-                    'addr': [addr[0], int(sport)],
-                }
-            )
+            w = math.exp(-(now - self.ewma_at) / settings.WORKER_EWMA_DECAY)
+            self.ewma = self.ewma * w + latency * (1 - w)
+        self.ewma_at = now
+
+    @property
+    def outstanding(self) -> int:
+        return len(self.sent)
+
+    def score(self) -> float:
+        """
+        Expected cost of sending a lookup now, lower is better.
+        """
+        return self.ewma * (self.outstanding + 1) * (1 + self.load)
+
+    def replied(self, rid: int):
+        sent_at = self.sent.pop(rid, None)
+        if sent_at is not None:
+            self._observe(time.time() - sent_at)
+
+    def expire(self):
+        """
+        Forget lookups never replied, counting them as slow as the
+        max expiry time.
+        """
+        limit = time.time() - settings.WORKER_REQ_EXPIRY
+        for rid, sent_at in list(self.sent.items()):
+            if sent_at < limit:
+                self.sent.pop(rid)
+                self._observe(settings.WORKER_REQ_EXPIRY)
+
+
+def choose_storage(conns: List[StorageConn], turn: int, policy: str = settings.WORKER_STORAGE_POLICY) -> StorageConn:
+    """
+    Choose the storage for next lookup.
+
+    Policies:
+        round_robin: take turns.
+        least_outstanding: fewer lookups waiting reply.
+        ewma: lower latency EWMA times outstanding lookups, raised by
+            the load the storage announces.
+
+    The last two compare two random storages (power of two choices) so
+    workers don't all rush to the same node.
+    """
+    if len(conns) == 1 or policy == 'round_robin':
+        return conns[turn % len(conns)]
+
+    a, b = random.sample(conns, 2)
+    if policy == 'least_outstanding':
+        return a if a.outstanding <= b.outstanding else b
+    return a if a.score() <= b.score() else b
 
 
 class Request:
     """
     Class that represents a request handled by a worker.
+    A worker may queue lots of them, so attributes live in slots.
     """
 
-    hit: bool = None
-    content: str = None
-    expiry: int = None
-    client_conn: bytes = None
+    __slots__ = (
+        'client_conn',
+        'client_rid',       # id of the request given by client
+        'url',              # canonical url
+        'host',             # netloc of url
+        'max_age',          # max age of a cached copy, None for any
+        'expiry',
+        'storage',          # id of the storage asked first
+        'hedge_at',         # when to ask a second storage
+        'hedged',           # a second storage was asked
+        'attempts',         # failed fetches so far
+        'hit',
+        'content',
+        'cached',           # stale cached content to be revalidated
+        'revalidated',      # origin confirmed cached content is fresh
+        'meta',             # metadata of content, None until it's known
+        'queued_at',        # when request entered its current queue
+        'prefetch',         # (depth, budget) of links to prefetch, None for none
+        'error',            # why the url failed, None if it didn't
+        'waiters',          # (conn, client rid) of requests of the same url, answered with it
+    )
+
+    # fields of the metadata stored with the content in cache
+    meta_fields = ('status', 'headers', 'fetched_at', 'etag', 'last_modified', 'charset', 'error')
 
-    def __init__(self, conn: bytes):
+    def __init__(self, conn: bytes, client_rid: int, url: str, max_age: float = None, prefetch: tuple = None):
         self.client_conn = conn
+        self.client_rid = client_rid
+        self.url = url
+        self.host = sys.intern(HostScheduler.host(url))
+        self.max_age = max_age
+        self.expiry = None
+        self.storage = None
+        self.hedge_at = None
+        self.hedged = False
+        self.attempts = 0
+        self.hit = None
+        self.content = None
+        self.cached = None
+        self.revalidated = False
+        self.meta = None
+        self.queued_at = time.time()
+        self.prefetch = prefetch
+        self.error = None
+        self.waiters = None
+
+    def attach(self, conn: bytes, client_rid: int, max_age: float = None, prefetch: tuple = None) -> bool:
+        """
+        Answer a request of the same url with this one, return False if
+        this one may serve an older copy than max age allows.
+        """
+        if max_age is not None and (self.max_age is None or self.max_age > max_age):
+            return False
+        if conn is not None:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append((conn, client_rid))
+        # links are prefetched as deep as any of them asked
+        if prefetch is not None and (self.prefetch is None or prefetch[0] > self.prefetch[0]):
+            self.prefetch = prefetch
+        return True
+
+    def clients(self) -> List[Tuple[bytes, int]]:
+        """
+        Return (conn, client rid) of every client to answer, none for a
+        prefetch nobody asked for.
+        """
+        clients = [(self.client_conn, self.client_rid)] if self.client_conn is not None else []
+        return clients + (self.waiters or [])
 
-    def start_timer(self):
+    def start_timer(self, timeout: float = settings.WORKER_REQ_EXPIRY):
         """
         Set expiry time for a request to cache.
         """
-        self.expiry = time.time() + settings.WORKER_REQ_EXPIRY
+        self.expiry = time.time() + timeout
 
     def is_hit(self, hit: bool):
         """
@@ -100,24 +311,402 @@ class Request:
 
         return False
 
+    def set_meta(self, meta: dict):
+        """
+        Load the metadata of a cached copy.
+        """
+        self.meta = {field: meta.get(field) for field in self.meta_fields}
+
+    def get_meta(self, field: str):
+        """
+        Return a field of the metadata, None if unknown.
+        """
+        return self.meta.get(field) if self.meta is not None else None
+
+    def is_fresh(self, meta: dict) -> bool:
+        """
+        Check if a cached copy with given metadata satisfies max age.
+        """
+        if self.max_age is None:
+            return True
+
+        fetched_at = meta.get('fetched_at')
+        return fetched_at is not None and time.time() - fetched_at <= self.max_age
+
+    def fail(self, error: str, status: int = None):
+        """
+        Mark request as failed, its metadata is the negative entry
+        cached for its url.
+        """
+        self.error = error
+        self.content = None
+        self.meta = {
+            'status': status,
+            'fetched_at': time.time(),
+            'error': error,
+            'ttl': settings.WORKER_NEGATIVE_TTL,
+        }
+
+    def conditional_headers(self) -> dict:
+        """
+        Headers to revalidate the cached copy against the origin.
+        """
+        headers = {}
+        if self.cached is not None:
+            etag, last_modified = self.get_meta('etag'), self.get_meta('last_modified')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
     def __eq__(self, other: Request):
-        return self.cid == other.cid and self.url == other.url
+        if not isinstance(other, Request):
+            return NotImplemented
+        return self.client_conn == other.client_conn and self.client_rid == other.client_rid
+
+    def __hash__(self):
+        return hash((self.client_conn, self.client_rid))
+
+
+class NegativeCache:
+    """
+    Metadata of urls that failed lately, so requests for them are
+    answered with their error instead of being fetched again.
+    Only the main thread of the worker uses it.
+    """
 
-    def hash(self):
-        return hash(self.cid + self.url)
+    def __init__(self, size: int = settings.WORKER_NEGATIVE_SIZE):
+        self.size = size
+        self.entries: Dict[str, Tuple[float, dict]] = OrderedDict()   # url -> (expires at, meta)
+
+    def add(self, url: str, meta: dict):
+        ttl = meta.get('ttl', settings.WORKER_NEGATIVE_TTL)
+        self.entries.pop(url, None)
+        self.entries[url] = (meta.get('fetched_at', time.time()) + ttl, meta)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, url: str, max_age: float = None) -> Optional[dict]:
+        """
+        Return the metadata of a failed url, None if it didn't fail,
+        expired or is older than `max_age`.
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+
+        expires_at, meta = entry
+        now = time.time()
+        if expires_at < now:
+            del self.entries[url]
+            return None
+        if max_age is not None and now - meta.get('fetched_at', 0) > max_age:
+            return None
+        return meta
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class HostLabels:
+    """
+    Bounded values of the host label of metrics: the `size` hosts with
+    most fetches get their own label, the rest share `other`.
+
+    Fetches are counted by Space-Saving in `4 * size` counters, and a
+    label once given is kept, as its series can't be removed.
+    """
+
+    def __init__(self, size: int = settings.WORKER_METRICS_HOSTS, min_count: int = 10):
+        self.size = size
+        self.min_count = min_count      # fetches before a host may get a label
+        self.counts: Dict[str, int] = {}
+        self.labelled: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, host: str) -> str:
+        with self.lock:
+            if host in self.labelled:
+                return host
+            if len(self.labelled) >= self.size:
+                return 'other'
+
+            if host in self.counts:
+                self.counts[host] += 1
+            elif len(self.counts) < 4 * self.size:
+                self.counts[host] = 1
+            else:
+                # the new host takes the counter of the least counted
+                least = min(self.counts, key=self.counts.get)
+                self.counts[host] = self.counts.pop(least) + 1
+
+            free = self.size - len(self.labelled)
+            if (
+                self.counts[host] >= self.min_count and
+                host in heapq.nlargest(free, self.counts, key=self.counts.get)
+            ):
+                self.labelled.add(host)
+                del self.counts[host]
+                if len(self.labelled) >= self.size:
+                    self.counts.clear()
+                return host
+            return 'other'
+
+
+FETCH_HOSTS = HostLabels()
+
+
+class SkippedContent(Exception):
+    """
+    The response isn't a page to be cached: not html or too large.
+    """
+
+
+class RetryPolicy:
+    """
+    Retry policy for a class of fetch errors, with exponential
+    backoff and full jitter.
+    """
+
+    def __init__(self, max_retries: int, base: float, cap: float):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, min_delay: float = 0) -> Optional[float]:
+        """
+        Seconds to wait before retrying a request that already failed
+        `attempt` times, None if it shouldn't be retried.
+        """
+        if attempt >= self.max_retries:
+            return None
+        return max(min_delay, random.uniform(0, min(self.cap, self.base * 2 ** attempt)))
+
+    @staticmethod
+    def error_class(error: Exception = None, status: int = None) -> Optional[str]:
+        """
+        Return the class of a fetch error or http status, None if it
+        isn't retriable.
+        """
+        if isinstance(error, requests.exceptions.Timeout):
+            return 'timeout'
+        if isinstance(error, requests.exceptions.ConnectionError):
+            return 'connect'
+        if status in (429, 503):
+            return 'throttled'
+        if status is not None and status >= 500:
+            return 'server'
+        return None
+
+
+RETRY_POLICIES = {
+    error_class: RetryPolicy(*policy)
+    for error_class, policy in settings.WORKER_RETRY_POLICIES.items()
+}
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of fetches to a host.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def next_allowed(self, now: float) -> float:
+        """
+        Time when a token will be available.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def pause(self, now: float, delay: float):
+        """
+        Make next token available not before `delay` seconds.
+        """
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+
+class HostScheduler:
+    """
+    Politeness scheduler of requests to be scrapped.
+
+    Requests are queued per host and each host has a token bucket. Hosts
+    with queued requests wait in a ready-queue ordered by the time their
+    bucket allows the next fetch, and only one fetch per host is in
+    flight, so a throttled host never holds requests for other hosts.
+    Requests to be retried wait in a delayed queue until they are due.
+    """
+
+    def __init__(
+        self,
+        rate: float = settings.WORKER_HOST_RATE,
+        burst: float = settings.WORKER_HOST_BURST
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.cond = threading.Condition()
+        self.queues: Dict[str, Deque[int]] = {}     # queued requests per host
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.delays: Dict[str, Optional[float]] = {}    # robots.txt crawl-delay per host
+        self.active: Set[str] = set()                   # hosts being fetched
+        self.ready = []     # heap of (next allowed time, seq, host)
+        self.delayed = []   # heap of (due time, seq, rid, host)
+        self.seq = 0
+
+    @staticmethod
+    def host(url: str) -> str:
+        return url_host(url)
+
+    def _bucket(self, host: str) -> TokenBucket:
+        try:
+            return self.buckets[host]
+        except KeyError:
+            delay = self.delays.get(host)
+            if delay:
+                bucket = TokenBucket(1 / delay, 1)
+            else:
+                bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[host] = bucket
+            return bucket
+
+    def _schedule(self, host: str):
+        self.seq += 1
+        at = self._bucket(host).next_allowed(time.time())
+        heapq.heappush(self.ready, (at, self.seq, host))
+        self.cond.notify()
+
+    def _enqueue(self, rid: int, host: str):
+        queue = self.queues.setdefault(host, deque())
+        queue.append(rid)
+        if len(queue) == 1 and host not in self.active:
+            self._schedule(host)
+
+    def push(self, rid: int, host: str, delay: float = 0):
+        """
+        Queue a request to host to be scrapped after `delay` seconds.
+        """
+        with self.cond:
+            if delay > 0:
+                self.seq += 1
+                heapq.heappush(self.delayed, (time.time() + delay, self.seq, rid, host))
+                self.cond.notify()
+            else:
+                self._enqueue(rid, host)
+
+    def pop(self, timeout: float = 1) -> Optional[int]:
+        """
+        Wait up to `timeout` seconds for a request whose host
+        is allowed to be fetched.
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, rid, host = heapq.heappop(self.delayed)
+                    self._enqueue(rid, host)
+
+                if self.ready and self.ready[0][0] <= now:
+                    _, _, host = heapq.heappop(self.ready)
+                    self._bucket(host).take(now)
+                    self.active.add(host)
+                    return self.queues[host].popleft()
+
+                wait = min(
+                    self.ready[0][0] if self.ready else deadline,
+                    self.delayed[0][0] if self.delayed else deadline,
+                    deadline
+                ) - now
+                if wait <= 0:
+                    return None
+                self.cond.wait(wait)
+
+    def done(self, host: str):
+        """
+        Mark the fetch of a request to host as finished.
+        """
+        with self.cond:
+            self.active.discard(host)
+            if self.queues.get(host):
+                self._schedule(host)
+            else:
+                self.queues.pop(host, None)
+                bucket = self.buckets.get(host)
+                if bucket is not None and bucket.is_full(time.time()):
+                    self.buckets.pop(host)
+
+    def backoff(self, host: str, delay: float):
+        """
+        Don't fetch from host for the next `delay` seconds.
+        """
+        with self.cond:
+            self._bucket(host).pause(time.time(), delay)
+
+    def needs_robots(self, host: str) -> bool:
+        """
+        Check if the crawl-delay of host is still unknown.
+        """
+        with self.cond:
+            return host not in self.delays
+
+    def set_delay(self, host: str, delay: Optional[float]):
+        """
+        Set the robots.txt crawl-delay of host, None if it has none.
+        """
+        with self.cond:
+            self.delays[host] = delay
+            if delay:
+                self.buckets[host] = TokenBucket(1 / delay, 1)
+                self.buckets[host].take(time.time())   # fetch in course
 
 
 class RequestsMonitor:
     """
     Class for keeping track of received requests from clients.
     """
-    RequestsDict = Dict[Tuple[str, str], Request]
+    RequestsDict = Dict[int, Request]
 
     lock = threading.Lock()
     new: RequestsDict = OrderedDict()           # new requests to be processed
     caching: RequestsDict = OrderedDict()       # requests passed to cache
     scrapping: RequestsDict = OrderedDict()     # rqueests didn't hit
     ready: RequestsDict = OrderedDict()         # requests ready with content
+    in_course: Dict[str, Request] = {}          # url -> request until it's delivered
+
+    def __init__(self, on_new: Callable[[str], None] = None):
+        self.scheduler = HostScheduler()    # order of scrapping requests
+        self.rids = itertools.count()       # ids of requests in worker
+        self.on_new = on_new                # called with the host of each new request
+
+    @staticmethod
+    def _left(queue: str, req: Request):
+        now = time.time()
+        QUEUE_SECONDS.observe(now - req.queued_at, queue=queue)
+        req.queued_at = now
+
+    def _to_scrapping(self, rid: int, req: Request):
+        self.scrapping[rid] = req
+        self.scheduler.push(rid, req.host)
 
     def prune_caching(self):
         """
@@ -126,73 +715,160 @@ class RequestsMonitor:
         """
         while True:
             with self.lock:
-                for id_url in list(self.caching):
-                    if self.caching[id_url].is_expired:
-                        req_expired = self.caching.pop(id_url)
+                for rid in list(self.caching):
+                    if self.caching[rid].is_expired:
+                        req_expired = self.caching.pop(rid)
+                        self._left('caching', req_expired)
                         req_expired.is_hit(False)
-                        self.scrapping[id_url] = req_expired
-                        logging.info(f'Timed out cache response for {id_url[1]}')
+                        self._to_scrapping(rid, req_expired)
+                        logging.debug('Timed out cache response for %s', req_expired.url)
 
             time.sleep(0.25)
 
-    def _first(self, dict_: OrderedDict, popit: bool) -> Tuple[Tuple[str, str], Request]:
+    def _first(self, dict_: OrderedDict, popit: bool) -> Tuple[int, Request]:
         """
         Return first item in an ordered dict.
         """
         try:
-            id_url, req = next(iter(dict_.items()))
+            rid, req = next(iter(dict_.items()))
         except StopIteration:
             return None, None
 
         if popit:
-            dict_.pop(id_url)
+            dict_.pop(rid)
 
-        return id_url, req
+        return rid, req
 
-    def new_next(self) -> Optional[Tuple[str, str]]:
+    def new_next(self, storage: StorageConn) -> Tuple[int, Request]:
         """
         Pop and return next request ready to be checked in cache.
-        Request is queued in caching queue.
+        Request is queued in caching queue, with expiry and hedge
+        times given by the storage that will be asked.
         """
         with self.lock:
-            id_url, req = self._first(self.new, True)
-            if id_url is not None and req is not None:
-                req.start_timer()
-                self.caching[id_url] = req
-                return id_url
-            else:
-                return None
+            rid, req = self._first(self.new, True)
+            if rid is not None and req is not None:
+                self._left('new', req)
+                req.start_timer(storage.deadline())
+                req.storage = storage.sid
+                req.hedge_at = time.time() + storage.hedge_delay()
+                self.caching[rid] = req
+            return rid, req
+
+    def caching_to_hedge(self) -> List[Tuple[int, Request]]:
+        """
+        Return requests in caching that should be asked to a second
+        storage, marking them as hedged.
+        """
+        now = time.time()
+        with self.lock:
+            to_hedge = [
+                (rid, req) for rid, req in self.caching.items()
+                if not req.hedged and req.hedge_at is not None and req.hedge_at <= now
+            ]
+            for _, req in to_hedge:
+                req.hedged = True
+            return to_hedge
 
-    def scrapping_next(self) -> Optional[Tuple[str, str]]:
+    def extend_timer(self, rid: int, timeout: float):
         """
-        Return next request ready to be scrapped.
+        Give a request in caching at least `timeout` more seconds.
         """
         with self.lock:
-            id_url, req = self._first(self.scrapping, False)
-            return id_url
+            req = self.caching.get(rid)
+            if req is not None:
+                req.expiry = max(req.expiry, time.time() + timeout)
 
-    def scrapping_pop(self) -> None:
+    def scrapping_next(self, timeout: float = 1) -> Optional[int]:
         """
-        Pop the first element in scrapping queue, this should be called
-        in case of resolving name failure.
+        Wait up to `timeout` seconds for next request ready to be scrapped.
+        """
+        return self.scheduler.pop(timeout)
+
+    def retry_later(self, rid: int, delay: float):
+        """
+        Keep a failed request in scrapping queue to be fetched again
+        after `delay` seconds.
         """
         with self.lock:
-            self._first(self.scrapping, True)
+            req = self.scrapping.get(rid)
+            if req is None:
+                return
+            req.attempts += 1
+            self.scheduler.done(req.host)
+            self.scheduler.push(rid, req.host, delay)
 
-    def ready_next(self) -> Tuple[Tuple[str, str], Request]:
+    def ready_next(self) -> Tuple[int, Request]:
         """
         Pop and return next request ready to be delivered to client.
         """
         with self.lock:
-            id_url, req = self._first(self.ready, True)
-            return id_url, req
+            rid, req = self._first(self.ready, True)
+            if req is not None:
+                self._left('ready', req)
+                # later requests of the url start again
+                if self.in_course.get(req.url) is req:
+                    del self.in_course[req.url]
+            return rid, req
+
+    def depths(self) -> Dict[str, int]:
+        """
+        Return the number of requests in each queue.
+        """
+        with self.lock:
+            return {
+                'new': len(self.new),
+                'caching': len(self.caching),
+                'scrapping': len(self.scrapping),
+                'ready': len(self.ready),
+            }
 
-    def add_new(self, id_url: Tuple[str, str], conn: bytes):
+    def __len__(self):
+        return sum(self.depths().values())
+
+    def scrapping_get(self, rid: int) -> Optional[Request]:
+        """
+        Return a request in scrapping queue.
+        """
+        with self.lock:
+            return self.scrapping.get(rid)
+
+    def add_new(
+        self, conn: bytes, client_rid: int, url: str, max_age: float = None, prefetch: tuple = None
+    ) -> Optional[int]:
         """
-        Add a new request to be processed.
+        Add a new request to be processed and return its id in worker,
+        or None if it was attached to a request of the same url in
+        course. Requests without conn are prefetches, not answered to
+        any client.
         """
         with self.lock:
-            self.new[id_url] = Request(conn)
+            in_course = self.in_course.get(url)
+            if in_course is not None and in_course.attach(conn, client_rid, max_age, prefetch):
+                COALESCED.inc()
+                return None
+
+            req = Request(conn, client_rid, url, max_age, prefetch)
+            rid = next(self.rids)
+            self.new[rid] = req
+            self.in_course[url] = req
+        if self.on_new is not None:
+            self.on_new(req.host)
+        return rid
+
+    def add_failed(self, conn: bytes, client_rid: int, url: str, meta: dict) -> int:
+        """
+        Add a request for an url known to fail, ready to be answered
+        with its error.
+        """
+        req = Request(conn, client_rid, url)
+        req.is_hit(True)
+        req.set_meta(meta)
+        req.error = meta.get('error')
+        with self.lock:
+            rid = next(self.rids)
+            self.ready[rid] = req
+        return rid
 
     def move_new_to_scrapping(self):
         """
@@ -200,78 +876,296 @@ class RequestsMonitor:
         be done if no cache servers are detected.
         """
         with self.lock:
-            id_url, req = self._first(self.new, True)
-            if id_url is not None and req is not None:
+            rid, req = self._first(self.new, True)
+            if rid is not None and req is not None:
+                self._left('new', req)
                 req.is_hit(False)
-                self.scrapping[id_url] = req
+                self._to_scrapping(rid, req)
 
-    def move_caching_to_scrapping(self, id_url: Tuple[str, str]):
+    def move_caching_to_scrapping(self, rid: int):
         """
         Move request to scrapping queue as a consequence it didn't
         hitted cache.
         """
         with self.lock:
-            req = self.caching.pop(id_url)
+            req = self.caching.pop(rid)
+            self._left('caching', req)
             req.is_hit(False)
-            self.scrapping[id_url] = req
+            self._to_scrapping(rid, req)
 
-    def move_caching_to_ready(self, id_url: Tuple[str, str], content: str):
+    def move_caching_to_ready(self, rid: int, content: bytes, meta: dict = None):
         """
         Move request from caching queue to ready queue as
-        consequence it was a hit.
+        consequence it was a hit. If the cached copy is older than
+        request's max age it's moved to scrapping to be revalidated.
         """
+        meta = meta or {}
         with self.lock:
-            req = self.caching.pop(id_url)
-            req.is_hit(True)
-            req.content = content
-            self.ready[id_url] = req
+            req = self.caching.pop(rid)
+            self._left('caching', req)
+            req.set_meta(meta)
+            # negative entries have an error and no content
+            error = meta.get('error')
+            if req.is_fresh(meta):
+                req.is_hit(True)
+                if error is not None:
+                    req.error = error
+                else:
+                    req.content = content
+                self.ready[rid] = req
+            else:
+                req.is_hit(False)
+                if error is None:
+                    req.cached = content
+                self._to_scrapping(rid, req)
 
-    def move_scrapping_to_ready(self, id_url: Tuple[str, str], content: str):
+    def move_scrapping_to_ready(
+        self,
+        rid: int,
+        content: bytes,
+        charset: str = None,
+        status: int = None,
+        headers: dict = None
+    ):
         """
         Move a request from scrapping queue to ready queue after it
         was succesfuly scrapped.
         """
         with self.lock:
-            req = self.scrapping.pop(id_url)
+            req = self.scrapping.pop(rid)
+            self._left('scrapping', req)
+            self.scheduler.done(req.host)
             req.content = content
-            self.ready[id_url] = req
+            lower = {k.lower(): v for k, v in (headers or {}).items()}
+            req.meta = {
+                'status': status,
+                'headers': headers,
+                'fetched_at': time.time(),
+                'etag': lower.get('etag'),
+                'last_modified': lower.get('last-modified'),
+                'charset': charset,
+            }
+            self.ready[rid] = req
             # print(req.content[:20])
             # print(len(self.ready))
 
+    def move_scrapping_to_failed(self, rid: int, error: str, status: int = None):
+        """
+        Move a request from scrapping queue to ready queue after its
+        fetch failed for good, to be answered with the error. A stale
+        cached copy being revalidated is served instead, and kept.
+        """
+        with self.lock:
+            req = self.scrapping.pop(rid, None)
+            if req is None:
+                return
+            self._left('scrapping', req)
+            self.scheduler.done(req.host)
+            if req.cached is not None:
+                logging.warning(f'Serving stale {req.url}: {error}')
+                req.content, req.cached = req.cached, None
+                req.is_hit(True)    # not updated in cache
+            else:
+                req.fail(error, status)
+            self.ready[rid] = req
+
+    def move_scrapping_to_revalidated(self, rid: int, headers: dict = None):
+        """
+        Move a request from scrapping queue to ready queue after the
+        origin confirmed its cached copy hasn't changed.
+        """
+        with self.lock:
+            req = self.scrapping.pop(rid)
+            self._left('scrapping', req)
+            self.scheduler.done(req.host)
+            req.content, req.cached = req.cached, None
+            req.revalidated = True
+            lower = {k.lower(): v for k, v in (headers or {}).items()}
+            req.meta = {
+                **(req.meta or {}),
+                'fetched_at': time.time(),
+                'etag': lower.get('etag', req.get_meta('etag')),
+                'last_modified': lower.get('last-modified', req.get_meta('last_modified')),
+            }
+            self.ready[rid] = req
+
 
 class Scrapper:
 
     @staticmethod
-    def _get(url: str, params: dict = {}, timeout: float = None) -> Response:
-        max_retries = 3
-        retries = 0
+    def _get(
+        session: requests.Session, url: str, params: dict = {}, headers: dict = None
+    ) -> Response:
+        """
+        Start a streamed request, raise `RequestException` on failure.
+        """
+        return session.get(
+            url, params=params,
+            headers=headers,
+            stream=True,
+            timeout=(settings.WORKER_CONNECT_TIMEOUT, settings.WORKER_READ_TIMEOUT)
+        )
+
+    @staticmethod
+    def _retry(
+        monitor: RequestsMonitor,
+        rid: int,
+        req: Request,
+        error_class: Optional[str],
+        reason: str,
+        min_delay: float = 0,
+        status: int = None
+    ):
+        """
+        Reschedule a failed request according to the policy of its error
+        class, or answer it with the error if it shouldn't be retried.
+        """
+        policy = RETRY_POLICIES.get(error_class)
+        delay = policy.delay(req.attempts, min_delay) if policy is not None else None
+
+        if delay is None:
+            logging.warning(f'Failed {req.url} after {req.attempts + 1} attempts: {reason}')
+            FETCHES.inc(result='failed')
+            monitor.move_scrapping_to_failed(rid, reason, status)
+            return
+
+        FETCHES.inc(result='retried')
+        if error_class == 'throttled':
+            monitor.scheduler.backoff(req.host, delay)
+        logging.info(f'Retrying {req.url} in {delay:.1f}s: {reason}')
+        monitor.retry_later(rid, delay)
+
+    @staticmethod
+    def _retry_after(res: Response) -> float:
+        """
+        Seconds requested by `Retry-After` header, as a number of seconds
+        or an http date, up to `WORKER_MAX_RETRY_AFTER`. 0 if absent or
+        invalid.
+        """
+        value = res.headers.get('Retry-After', '').strip()
+        if value.isdigit():
+            delay = float(value)
+        else:
+            try:
+                when = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return 0
+            # dates without zone are in gmt
+            if when.tzinfo is None:
+                when = when.replace(tzinfo=timezone.utc)
+            delay = (when - datetime.now(timezone.utc)).total_seconds()
+        return min(max(delay, 0), settings.WORKER_MAX_RETRY_AFTER)
+
+    @staticmethod
+    def _read(url: str, res: Response) -> Tuple[bytes, str]:
+        """
+        Download the body of a streamed response and detect its charset.
+        Raise `SkippedContent` if it isn't html or it's larger than
+        allowed, `RequestException` if download fails or takes too long.
+        """
+        content_type = res.headers.get('Content-Type', '')
+        mime = content_type.split(';')[0].strip().lower()
+        if mime and mime not in settings.WORKER_CONTENT_TYPES:
+            res.close()
+            raise SkippedContent(f'content type {mime}')
+
+        length = res.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > settings.WORKER_MAX_BODY_SIZE:
+            res.close()
+            raise SkippedContent(f'content length {length}')
+
+        body = bytearray()
+        detector = CharsetDetector(content_type)
+        deadline = time.time() + settings.WORKER_FETCH_DEADLINE
         try:
-            return requests.get(url, params, timeout=timeout).content.decode('utf8')
-        except requests.exceptions.ConnectionError:
-            logging.warning(f'Connection error to: {url}')
-            if retries == max_retries:
-                return None
-            else:
-                logging.info('Retrying...')
-                time.sleep(1)
-                retries += 1
-        except UnicodeDecodeError:
-            return 'Decode error!!!'
+            for chunk in res.iter_content(settings.WORKER_CHUNK_SIZE):
+                body += chunk
+                if len(body) > settings.WORKER_MAX_BODY_SIZE:
+                    raise SkippedContent(f'content larger than {len(body)}')
+                if time.time() > deadline:
+                    raise requests.exceptions.ReadTimeout(f'Download of {url} exceeded deadline')
+                detector.feed(chunk)
+        finally:
+            res.close()
+
+        return bytes(body), detector.finish()
+
+    @staticmethod
+    def _crawl_delay(session: requests.Session, url: str) -> Optional[float]:
+        """
+        Return the crawl-delay for us in robots.txt of url's host.
+        """
+        parsed = urlparse(url)
+        robots = RobotFileParser()
+        try:
+            res = session.get(
+                f'{parsed.scheme}://{parsed.netloc}/robots.txt',
+                timeout=settings.WORKER_ROBOTS_TIMEOUT
+            )
+        except requests.exceptions.RequestException:
+            return None
+        if res.status_code != 200:
+            return None
+
+        robots.parse(res.text.splitlines())
+        delay = robots.crawl_delay('*')
+        return float(delay) if delay is not None else None
 
     @staticmethod
-    def start_scrapper(monitor: RequestsMonitor):
+    def start_scrapper(monitor: RequestsMonitor, session: requests.Session = None):
         """
         Start scrapper that process requests from scrapping queue.
+        Several scrappers can share the same monitor, each one with its
+        own session.
         """
+        session = session or requests.Session()
         while True:
-            id_url = monitor.scrapping_next()
-            if id_url is not None:
-                url = 'http://' + id_url[1] if not id_url[1].startswith('http') else id_url[1]
-                logging.info(f'Scrapping: {url}')
-                content = Scrapper._get(url)
-                if content is not None:
-                    monitor.move_scrapping_to_ready(id_url, content)
-                    logging.info(
-                        f'Scrapped {url}, content length: {len(content)}')
-                else:
-                    monitor.scrapping_pop()
+            rid = monitor.scrapping_next()
+            if rid is not None:
+                req = monitor.scrapping_get(rid)
+                url = req.url
+                if settings.WORKER_ROBOTS and monitor.scheduler.needs_robots(req.host):
+                    monitor.scheduler.set_delay(req.host, Scrapper._crawl_delay(session, url))
+                logging.debug('Scrapping: %s', url)
+                started = time.time()
+                try:
+                    res = Scrapper._get(session, url, headers=req.conditional_headers())
+                    error_class = RetryPolicy.error_class(status=res.status_code)
+                    if error_class is not None or res.status_code >= 400:
+                        res.close()
+                        Scrapper._retry(
+                            monitor, rid, req, error_class,
+                            f'status {res.status_code}', Scrapper._retry_after(res),
+                            res.status_code)
+                        continue
+
+                    if res.status_code == 304 and req.cached is not None:
+                        res.close()
+                        monitor.move_scrapping_to_revalidated(rid, dict(res.headers))
+                        FETCHES.inc(result='not_modified')
+                        FETCH_SECONDS.observe(time.time() - started, host=FETCH_HOSTS(req.host))
+                        logging.debug('Revalidated %s, not modified', url)
+                        continue
+
+                    content, charset = Scrapper._read(url, res)
+                except requests.exceptions.RequestException as e:
+                    Scrapper._retry(monitor, rid, req, RetryPolicy.error_class(e), str(e))
+                    continue
+                except SkippedContent as e:
+                    logging.warning(f'Skipped {url}: {e}')
+                    FETCHES.inc(result='skipped')
+                    monitor.move_scrapping_to_failed(rid, str(e), res.status_code)
+                    continue
+                except Exception as e:
+                    # the client is answered and the scrapper keeps running
+                    logging.exception(f'Failed scrapping {url}')
+                    FETCHES.inc(result='error')
+                    monitor.move_scrapping_to_failed(rid, str(e))
+                    continue
+
+                monitor.move_scrapping_to_ready(
+                    rid, content, charset, res.status_code, dict(res.headers))
+                FETCHES.inc(result='ok')
+                FETCH_SECONDS.observe(time.time() - started, host=FETCH_HOSTS(req.host))
+                BYTES_IN.inc(len(content))
+                logging.debug('Scrapped %s, content length: %d', url, len(content))
@@ -1,12 +1,27 @@
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
+import itertools
 import logging
+import multiprocessing
+import queue
+import tempfile
 import threading
+import time
 
 import zmq
 
 from src import settings
 from src.utils.udp import UDPSender
-from src.utils.worker import StorageDisc, RequestsMonitor, Scrapper
-from src.utils.functions import random_id, pipe
+from src.utils.worker import (
+    StorageDisc, RequestsMonitor, Request, Scrapper, StorageConn, HostScheduler, NegativeCache,
+    choose_storage
+)
+from src.utils.dns import Resolver
+from src.utils.html import HTMLParser
+from src.utils.url import canonicalize
+from src.utils.queues import BoundedQueue
+from src.utils.metrics import REGISTRY
+from src.utils.functions import random_id, pipe, pack_msg, unpack_msg
 
 logging.basicConfig(
     # format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
@@ -14,38 +29,65 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+REQUESTS = REGISTRY.counter('worker_requests_total', 'Requests received from clients')
+RESPONSES = REGISTRY.counter('worker_responses_total', 'Responses sent to clients by cache hit')
+FAILURES = REGISTRY.counter('worker_failures_total', 'Error responses sent to clients by cache hit')
+BYTES_OUT = REGISTRY.counter('worker_bytes_out_total', 'Bytes of pages sent to clients')
+PREFETCHES = REGISTRY.counter('worker_prefetches_total', 'Links of pages queued to prefetch')
+
 
 class Worker:
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, front: str = None, metrics_port: int = None):
         self.id = random_id()
         self.address = (ip, port)
+        self.front = front          # endpoint of the front when run as a child process
+        self.metrics_port = metrics_port
         self.ctx = zmq.Context()
 
         self.cli_sock = None        # talk to clients
         self.ping_sender = None     # send beacons to workers mcast group
 
-        self.st_sock = None     # talk to storage
         self.disc_sock = None   # recv updates of storages up and down
 
         self.discoverer = None  # storage discovering service
-        self.storages = {}      # storages discovered so far
-
-        self.monitor = RequestsMonitor()
-        self.pendant_updates = []
+        self.storages = {}      # connections to storages discovered so far
+        self.storage_turn = itertools.count()
+
+        self.resolver = Resolver()  # cache of host names resolutions
+        # new requests start resolving their host while looked up in cache
+        self.monitor = RequestsMonitor(on_new=self.resolver.prefetch)
+        # updates to send to storages, oldest are dropped if none is available
+        self.pendant_updates = BoundedQueue('pendant-updates', settings.WORKER_UPDATES_QUEUE)
+        self.prefetched = OrderedDict()     # urls prefetched lately
+        # pages to extract links from out of the main loop, and links found
+        self.prefetch_pages = queue.Queue(settings.WORKER_PREFETCH_PAGES)
+        self.prefetch_found: Deque[Tuple[List[str], float, tuple]] = deque()
+        self.negatives = NegativeCache()    # urls failed lately
 
     def start(self):
         """
         Start worker services and bind its interfaces.
         """
-        # start scrapper thread
+        if self.metrics_port is not None:
+            self._serve_metrics()
+
+        # start scrapper threads, resolving hosts through cache
+        for i in range(settings.WORKER_SCRAPPERS):
+            threading.Thread(
+                target=Scrapper.start_scrapper,
+                args=(self.monitor, self.resolver.session()),
+                name=f'Scrapper-{i}',
+                daemon=True
+            ).start()
+        logging.info(f'{settings.WORKER_SCRAPPERS} scrappers started...')
+
+        # start link extractor thread for prefetches
         threading.Thread(
-            target=Scrapper.start_scrapper,
-            args=(self.monitor, ),
-            name='Scrapper',
+            target=self._extract_links,
+            name='Link-Extractor',
             daemon=True
         ).start()
-        logging.info('Scrapper started...')
 
         # start caching pruner thread
         threading.Thread(
@@ -54,9 +96,6 @@ class Worker:
             daemon=True
         ).start()
 
-        # start sock to talk with storage
-        self.st_sock = self.ctx.socket(zmq.DEALER)
-
         # start storage discovering service
         self.disc_sock, pipe_sock = pipe(self.ctx)
         self.discoverer = StorageDisc(self.address[0], pipe_sock)
@@ -67,34 +106,22 @@ class Worker:
         ).start()
         logging.info('Storage discovering serivce started...')
 
-        # start sock to talk with clients
-        self.cli_sock = self.ctx.socket(zmq.ROUTER)
-        self.cli_sock.bind('tcp://%s:%d' % self.address)
-        logging.info(f'Binded to {self.address}\tID: {self.id}')
-
-        # start ping to clients service
-        self.ping_sender = UDPSender(
-            'w',
-            self.id,
-            self.address[1],
-            self.address[0],
-            settings.WORKER_MCAST_ADDR
-        )
-        threading.Thread(
-            target=self.ping_sender.start,
-            name='Ping-Workers',
-            daemon=True
-        ).start()
-        logging.info('Ping service started...')
+        if self.front is None:
+            self._bind_clients()
+        else:
+            self._connect_front()
 
         # create a poller for handling events in sockets
         poller = zmq.Poller()
         poller.register(self.disc_sock, zmq.POLLIN)
-        poller.register(self.st_sock, zmq.POLLIN | zmq.POLLOUT)
         poller.register(self.cli_sock, zmq.POLLIN | zmq.POLLOUT)
+        expired_at = time.time()
 
         while True:
-            socks = dict(poller.poll())
+            # stop reading clients while there are too many requests in course
+            accepting = len(self.monitor) < settings.WORKER_MAX_REQUESTS
+            poller.register(self.cli_sock, zmq.POLLOUT | (zmq.POLLIN if accepting else 0))
+            socks = dict(poller.poll(settings.WORKER_POLL_TIMEOUT))
 
             # =============================================
 
@@ -114,101 +141,447 @@ class Worker:
 
                 # storage is not longer accessible, close the connection
                 if action == 'delete':
-                    self.st_sock.disconnect('tcp://%s:%d' % self.storages[sid])
-                    self.storages.pop(sid)
+                    conn = self.storages.pop(sid)
+                    poller.unregister(conn.sock)
+                    conn.close()
                     logging.info(f'Removed storage {sid}')
 
                 # new worker, establish a connection
                 elif action == 'add':
-                    self.st_sock.connect('tcp://%s:%d' % addr)
-                    self.storages[sid] = addr
+                    conn = StorageConn(sid, self.ctx.socket(zmq.DEALER), None)
+                    conn.connect(addr)
+                    conn.set_load(msg['load'])
+                    poller.register(conn.sock, zmq.POLLIN | zmq.POLLOUT)
+                    self.storages[sid] = conn
                     logging.info(f'Added storage {sid}: {addr}')
 
                 # worker changed his interface, update the conection
-                elif action == 'update':  # TODO: breaking with 2+ storages
-                    self.st_sock.disconnect('tcp://%s:%d' % self.storages[sid])
-                    self.st_sock.connect('tcp://%s:%d' % addr)
-                    old_addr, self.storages[sid] = self.storages[sid], addr
+                elif action == 'update':
+                    conn = self.storages[sid]
+                    old_addr = conn.addr
+                    conn.connect(addr)
                     logging.info(f'Updated storage {sid}: {old_addr} -> {addr}')
 
+                # storage announced its load
+                elif action == 'load':
+                    self.storages[sid].set_load(msg['load'])
+
             # =============================================
 
             if not self.storages:
                 self.monitor.move_new_to_scrapping()
 
-            # send/receive messages to/from storage
-            elif self.st_sock in socks:
-                # receive response from storage
-                if socks[self.st_sock] in (zmq.POLLIN, zmq.POLLIN | zmq.POLLOUT):
-                    res = self.st_sock.recv_json(zmq.DONTWAIT)
+            # receive responses from storages
+            for conn in self.storages.values():
+                if socks.get(conn.sock, 0) & zmq.POLLIN:
+                    res, content = unpack_msg(conn.sock.recv_multipart(zmq.DONTWAIT))
 
                     try:
-                        id_url = (res['id'], res['url'])
+                        rid = res['rid']
+                        conn.replied(rid)
                         if res['hit']:
-                            self.monitor.move_caching_to_ready(id_url, res['content'])
+                            self.monitor.move_caching_to_ready(
+                                rid, content, res.get('meta'))
                         else:
-                            self.monitor.move_caching_to_scrapping(id_url)
-                    except KeyError:
-                        logging.warning('Bad response from cache')
-
-                # send update/request to storage
-                if socks[self.st_sock] in (zmq.POLLOUT, zmq.POLLIN | zmq.POLLOUT):
-                    # send updates if there is someone
-                    while self.pendant_updates:
-                        url, content = self.pendant_updates.pop(0)
-                        self.st_sock.send_json(
-                            {
-                                "url": url,
-                                "content": content,
-                                "spread": True,
-                            }
-                        )
-                        logging.info(f'Updated cache: {url}')
-
-                    # send request to cache if there is in queue
-                    id_url = self.monitor.new_next()
-                    if id_url is not None:
-                        self.st_sock.send_json(
-                            {
-                                "id": id_url[0],
-                                "url": id_url[1],
-                            }
-                        )
-                        # logging.info(f'Requested to cache: {id_url[1]}')
+                            self.monitor.move_caching_to_scrapping(rid)
+                    except KeyError:    # bad response or already answered
+                        pass
+
+            # send updates/requests to storages
+            conn = self._next_storage()
+            if conn is not None and socks.get(conn.sock, 0) & zmq.POLLOUT:
+                # send updates if there is someone
+                while self.pendant_updates:
+                    url, content, meta = self.pendant_updates.popleft()
+                    # without content only meta is refreshed
+                    conn.sock.send_multipart(pack_msg(
+                        {
+                            "url": url,
+                            "meta": meta,
+                            "spread": True,
+                        },
+                        content
+                    ))
+                    logging.debug('Updated cache: %s', url)
+
+                # send request to cache if there is in queue
+                rid, req = self.monitor.new_next(conn)
+                if rid is not None:
+                    conn.lookup(rid, req.url)
+                    # logging.info(f'Requested to cache: {req.url}')
+
+            # ask another storage for lookups taking longer than usual
+            if settings.WORKER_HEDGE and len(self.storages) > 1:
+                for rid, req in self.monitor.caching_to_hedge():
+                    conn = self._next_storage(exclude=req.storage)
+                    conn.lookup(rid, req.url)
+                    self.monitor.extend_timer(rid, conn.deadline())
+                    logging.info(f'Hedged lookup of {req.url} to storage {conn.sid}')
+
+            # forget lookups never answered
+            if time.time() - expired_at > settings.WORKER_REQ_EXPIRY:
+                for conn in self.storages.values():
+                    conn.expire()
+                expired_at = time.time()
 
             # =============================================
 
+            self._prefetch_links()
+
             # send/receive messages to/from clients
             if self.cli_sock in socks:
                 # receive request from client
                 if socks[self.cli_sock] in (zmq.POLLIN, zmq.POLLIN | zmq.POLLOUT):
-                    conn_id = self.cli_sock.recv(zmq.DONTWAIT)
-                    req = self.cli_sock.recv_json(zmq.DONTWAIT)
+                    conn_id, *frames = self.cli_sock.recv_multipart(zmq.DONTWAIT)
+                    req, _ = unpack_msg(frames)
 
                     try:
-                        self.monitor.add_new((req['id'], req['url']), conn_id)
-                        logging.info(f'Enqueued request from {conn_id}: {req["url"]}')
-                    except KeyError:
+                        url = canonicalize(req['url'])
+                        # urls failed lately are answered with their error
+                        negative = self.negatives.get(url, req.get('max_age'))
+                        if negative is not None:
+                            self.monitor.add_failed(conn_id, req['rid'], url, negative)
+                        else:
+                            self.monitor.add_new(
+                                conn_id, req['rid'], url, req.get('max_age'),
+                                self._prefetch_hint(req.get('prefetch')))
+                        REQUESTS.inc()
+                        logging.debug('Enqueued request from %s: %s', conn_id, req['url'])
+                    except (KeyError, ValueError):
                         logging.warning(f'Bad request from {conn_id}')
+                        # the front counts every request until it's answered
+                        if self.front is not None:
+                            self.cli_sock.send(settings.WORKER_DROPPED)
 
                 # send response to client
                 if socks[self.cli_sock] in (zmq.POLLOUT, zmq.POLLIN | zmq.POLLOUT):
-                    id_url, req = self.monitor.ready_next()
-                    if id_url is not None and req is not None:
-                        self.cli_sock.send(req.client_conn, zmq.SNDMORE)
-                        self.cli_sock.send_json(
-                            {
-                                "url": id_url[1],
-                                "hit": req.hit,
-                                "content": req.content,
-                            }
-                        )
-                        logging.info(
-                            f'Served request from {req.client_conn}: {id_url[1]} '
-                            f'{"[hit]" if req.hit else "[not hit]"}'
-                        )
-                        if not req.hit:
-                            self.pendant_updates.append((id_url[1], req.content))
+                    rid, req = self.monitor.ready_next()
+                    if rid is not None and req is not None:
+                        # prefetches are only cached, unless a client asked meanwhile
+                        for client_conn, client_rid in req.clients():
+                            if req.error is not None:
+                                self.cli_sock.send_multipart([client_conn, *pack_msg(
+                                    {
+                                        "rid": client_rid,
+                                        "hit": req.hit,
+                                        "status": req.get_meta('status'),
+                                        "fetched_at": req.get_meta('fetched_at'),
+                                        "error": req.error,
+                                    }
+                                )])
+                                FAILURES.inc(hit=bool(req.hit))
+                                logging.debug('Failed request from %s: %s %s', client_conn, req.url, req.error)
+                            else:
+                                self.cli_sock.send_multipart([client_conn, *pack_msg(
+                                    {
+                                        "rid": client_rid,
+                                        "hit": req.hit,
+                                        "status": req.get_meta('status'),
+                                        "headers": req.get_meta('headers'),
+                                        "fetched_at": req.get_meta('fetched_at'),
+                                        "charset": req.get_meta('charset'),
+                                    },
+                                    req.content
+                                )])
+                                RESPONSES.inc(hit=bool(req.hit))
+                                BYTES_OUT.inc(len(req.content) if req.content is not None else 0)
+                                logging.debug(
+                                    'Served request from %s: %s %s',
+                                    client_conn, req.url, '[hit]' if req.hit else '[not hit]'
+                                )
+                        if req.prefetch is not None:
+                            self._parse_links(req)
+                        if req.error is not None:
+                            # negative entries are cached without content
+                            self.negatives.add(req.url, req.meta)
+                            if not req.hit:
+                                self.pendant_updates.append((req.url, b'', req.meta))
+                        elif req.revalidated:
+                            self.pendant_updates.append((req.url, None, req.meta))
+                        elif not req.hit:
+                            self.pendant_updates.append((req.url, req.content, req.meta))
+
+    @staticmethod
+    def _prefetch_hint(hint) -> Optional[tuple]:
+        """
+        Return (depth, budget) of the prefetch asked by a client, capped
+        by settings, or None if there is nothing to prefetch.
+        """
+        try:
+            depth, budget = int(hint['depth']), int(hint['budget'])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+        budget = min(budget, settings.WORKER_PREFETCH_BUDGET)
+        return (depth, budget) if depth > 0 and budget > 0 else None
+
+    def _parse_links(self, req: Request):
+        """
+        Pass a page to the link extractor if its links may be prefetched.
+        """
+        # prefetches only fill up to half of the requests held
+        room = settings.WORKER_MAX_REQUESTS // 2 - len(self.monitor)
+        if req.prefetch[0] <= 0 or not req.content or room <= 0:
+            return
+        try:
+            self.prefetch_pages.put_nowait(req)
+        except queue.Full:
+            logging.debug('Too many pages to extract links, not prefetching %s', req.url)
+
+    def _extract_links(self):
+        """
+        Find the links of pages to the same host, up to their budget.
+        Parsing a page takes long, so it's done in its own thread and
+        the main loop only queues the links found.
+        """
+        while True:
+            req = self.prefetch_pages.get()
+            depth, budget = req.prefetch
+            text = req.content.decode(req.get_meta('charset') or 'utf8', 'replace')
+            links = []
+            try:
+                for link in HTMLParser.links(text):
+                    if len(links) >= budget:
+                        break
+                    try:
+                        link = canonicalize(link)
+                    except ValueError:
+                        continue
+                    if link in self.prefetched or link in links or HostScheduler.host(link) != req.host:
+                        continue
+                    links.append(link)
+            except Exception:
+                # a bad page is not prefetched, the extractor keeps running
+                logging.exception(f'Failed extracting links of {req.url}')
+                continue
+
+            if links:
+                self.prefetch_found.append((links, req.max_age, (depth - 1, budget)))
+                logging.debug('Found %d links to prefetch in %s', len(links), req.url)
+
+    def _prefetch_links(self):
+        """
+        Queue the links found by the extractor so they are fetched and
+        cached before the client asks for them.
+        """
+        while self.prefetch_found:
+            links, max_age, hint = self.prefetch_found.popleft()
+            room = settings.WORKER_MAX_REQUESTS // 2 - len(self.monitor)
+            queued = 0
+            for link in links[:max(room, 0)]:
+                if link in self.prefetched:
+                    continue
+                self.prefetched[link] = None
+                if len(self.prefetched) > settings.WORKER_PREFETCH_SEEN:
+                    self.prefetched.popitem(last=False)
+                # links already in course are only prefetched deeper
+                if self.monitor.add_new(None, None, link, max_age, hint) is not None:
+                    queued += 1
+
+            if queued:
+                PREFETCHES.inc(queued)
+
+    def _serve_metrics(self):
+        """
+        Export the queues of the worker and serve its metrics.
+        """
+        depth = REGISTRY.gauge('worker_queue_depth', 'Requests in each queue of the worker')
+        for queue in ('new', 'caching', 'scrapping', 'ready'):
+            depth.track(lambda queue=queue: self.monitor.depths()[queue], queue=queue)
+        depth.track(lambda: len(self.pendant_updates), queue='pendant_updates')
+        REGISTRY.gauge(
+            'worker_dropped_updates', 'Cache updates dropped because no storage took them'
+        ).track(lambda: self.pendant_updates.dropped)
+        REGISTRY.gauge('worker_storages', 'Storages discovered').track(lambda: len(self.storages))
+        REGISTRY.gauge('worker_negatives', 'Failed urls remembered').track(lambda: len(self.negatives))
+
+        REGISTRY.serve(self.address[0], self.metrics_port)
+        logging.info(f'Metrics served at {self.address[0]}:{self.metrics_port}')
+
+    def _bind_clients(self):
+        """
+        Bind the sock to talk with clients and start pinging them.
+        """
+        self.cli_sock = self.ctx.socket(zmq.ROUTER)
+        self.cli_sock.bind('tcp://%s:%d' % self.address)
+        logging.info(f'Binded to {self.address}\tID: {self.id}')
+
+        self.ping_sender = UDPSender(
+            'w',
+            self.id,
+            self.address[1],
+            self.address[0],
+            settings.WORKER_MCAST_ADDR,
+            self._load
+        )
+        threading.Thread(
+            target=self.ping_sender.start,
+            name='Ping-Workers',
+            daemon=True
+        ).start()
+        logging.info('Ping service started...')
+
+    def _load(self) -> Tuple[int, int, int]:
+        """
+        Requests queued, fetches in flight and requests held at most,
+        announced in beacons.
+        """
+        inflight = len(self.monitor.scheduler.active)
+        return max(len(self.monitor) - inflight, 0), inflight, settings.WORKER_MAX_REQUESTS
+
+    def _connect_front(self):
+        """
+        Talk with clients through the front of a multi-process worker.
+        Its messages keep the framing of a ROUTER: [conn_id, *frames].
+        """
+        self.cli_sock = self.ctx.socket(zmq.DEALER)
+        self.cli_sock.setsockopt_string(zmq.IDENTITY, self.id)
+        self.cli_sock.connect(self.front)
+        self.cli_sock.send(settings.WORKER_READY)
+        logging.info(f'Connected to front {self.front}\tID: {self.id}')
+
+    def _next_storage(self, exclude: str = None) -> Optional[StorageConn]:
+        """
+        Return the storage to send next lookup or update to.
+        """
+        conns = [conn for sid, conn in self.storages.items() if sid != exclude]
+        if not conns:
+            return None
+        return choose_storage(conns, next(self.storage_turn))
+
+
+def run_child(ip: str, front: str, wid: str, metrics_port: int = None):
+    """
+    Entry point of a child process of a multi-process worker.
+    """
+    worker = Worker(ip, None, front, metrics_port)
+    worker.id = wid
+    worker.start()
+
+
+class WorkerFront:
+    """
+    Front of a multi-process worker.
+
+    Owns the port and the beacon seen by clients, so they see a single
+    worker, and dispatches their requests over ipc to child `Worker`
+    processes, each one with its own scrappers and storage connections.
+    Requests go to the child with fewer outstanding requests and dead
+    children are respawned.
+    """
+
+    def __init__(self, ip, port, processes: int = settings.WORKER_PROCESSES, metrics_port: int = None):
+        self.id = random_id()
+        self.address = (ip, port)
+        self.processes = processes
+        self.metrics_port = metrics_port    # children serve theirs on next ports
+        self.endpoint = f'ipc://{tempfile.gettempdir()}/worker-{self.id}.ipc'
+        self.mp = multiprocessing.get_context('spawn')
+        self.ctx = zmq.Context()
+
+        self.cli_sock = None        # talk to clients
+        self.back_sock = None       # talk to child workers
+        self.ping_sender = None     # send beacons to workers mcast group
+
+        self.children: Dict[int, multiprocessing.Process] = {}
+        self.outstanding: Dict[bytes, int] = {}     # requests of ready children
+
+    def _wid(self, i: int) -> bytes:
+        return f'{self.id}-{i}'.encode()
+
+    def _spawn(self, i: int):
+        metrics_port = self.metrics_port + 1 + i if self.metrics_port is not None else None
+        proc = self.mp.Process(
+            target=run_child,
+            args=(self.address[0], self.endpoint, self._wid(i).decode(), metrics_port),
+            name=f'Worker-{i}',
+            daemon=True
+        )
+        proc.start()
+        self.children[i] = proc
+
+    def _respawn_dead(self):
+        for i, proc in self.children.items():
+            if not proc.is_alive():
+                self.outstanding.pop(self._wid(i), None)
+                logging.warning(f'Child {i} died with code {proc.exitcode}, respawning')
+                self._spawn(i)
+
+    def start(self):
+        """
+        Start child workers and route messages between them and clients.
+        """
+        if self.metrics_port is not None:
+            REGISTRY.gauge(
+                'worker_outstanding', 'Requests dispatched to children and not answered'
+            ).track(lambda: sum(self.outstanding.values()))
+            REGISTRY.serve(self.address[0], self.metrics_port)
+
+        self.back_sock = self.ctx.socket(zmq.ROUTER)
+        self.back_sock.setsockopt(zmq.ROUTER_HANDOVER, 1)    # respawned children reuse ids
+        self.back_sock.bind(self.endpoint)
+
+        for i in range(self.processes):
+            self._spawn(i)
+        logging.info(f'{self.processes} child workers started...')
+
+        self.cli_sock = self.ctx.socket(zmq.ROUTER)
+        self.cli_sock.bind('tcp://%s:%d' % self.address)
+        logging.info(f'Binded to {self.address}\tID: {self.id}')
+
+        # requests dispatched to children are in flight
+        self.ping_sender = UDPSender(
+            'w',
+            self.id,
+            self.address[1],
+            self.address[0],
+            settings.WORKER_MCAST_ADDR,
+            lambda: (
+                0, sum(self.outstanding.values()), settings.WORKER_MAX_REQUESTS * len(self.children))
+        )
+        threading.Thread(
+            target=self.ping_sender.start,
+            name='Ping-Workers',
+            daemon=True
+        ).start()
+        logging.info('Ping service started...')
+
+        poller = zmq.Poller()
+        poller.register(self.back_sock, zmq.POLLIN)
+        checked_at = time.time()
+
+        while True:
+            # take requests from clients only when some child is ready and not overloaded
+            accepting = (
+                self.outstanding
+                and min(self.outstanding.values()) < settings.WORKER_MAX_REQUESTS
+            )
+            poller.register(self.cli_sock, zmq.POLLIN if accepting else 0)
+            socks = dict(poller.poll(settings.WORKER_RESPAWN_INTERVAL * 1000))
+
+            # pass responses of children to clients
+            if self.back_sock in socks:
+                wid, *frames = self.back_sock.recv_multipart(zmq.DONTWAIT)
+                if frames == [settings.WORKER_READY]:
+                    self.outstanding[wid] = 0
+                    logging.info(f'Child {wid.decode()} ready')
+                else:
+                    # answered or dropped, the request is no longer outstanding
+                    if self.outstanding.get(wid):
+                        self.outstanding[wid] -= 1
+                    if frames != [settings.WORKER_DROPPED]:
+                        self.cli_sock.send_multipart(frames)
+
+            # dispatch requests of clients to the least loaded child
+            if self.cli_sock in socks:
+                frames = self.cli_sock.recv_multipart(zmq.DONTWAIT)
+                wid = min(self.outstanding, key=self.outstanding.get)
+                self.outstanding[wid] += 1
+                self.back_sock.send_multipart([wid, *frames])
+
+            if time.time() - checked_at > settings.WORKER_RESPAWN_INTERVAL:
+                self._respawn_dead()
+                checked_at = time.time()
 
 
 if __name__ == '__main__':